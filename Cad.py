@@ -48,6 +48,14 @@ class Cad(QObject):
         # CadPaintWidget : this widget displays graphical informations in front of the mapCanvas
         self.paintwidget = CadPaintWidget(self.iface, self.inputwidget, self.eventFilter)
 
+        # The snap index is built in the background, the inputwidget displays its progress
+        self.eventFilter.snapper.index.progressChanged.connect( self.inputwidget.setIndexProgress )
+        self.eventFilter.snapper.prepareLater()
+
+        # The traverses entered in the inputwidget are computed and committed by the eventFilter (which knows the last clicked points)
+        self.inputwidget.traverseRequested.connect( self.eventFilter.traverse )
+        self.inputwidget.traverseImportRequested.connect( self.eventFilter.importTraverse )
+
 
 
         #We need the canvas's viewport to track the mouse for mouseMoveEvents to happen
@@ -72,6 +80,9 @@ class Cad(QObject):
         self.iface.mapCanvas().viewport().removeEventFilter( self.eventFilter )
         self.iface.mapCanvas().removeEventFilter( self.eventFilter )
 
+        #we restore the project's snapping and remove the technical layer
+        self.eventFilter.unload()
+
         #and we remove the widgets also
         self.inputwidget.deleteLater()
         self.paintwidget.deleteLater()
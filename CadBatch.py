@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# This module has no Qt nor QGIS dependency, it is run from the command line :
+#     python CadBatch.py fieldbooks/ -o traverses.gpkg --workers 8
+
+import os
+import io
+import sys
+import time
+import fnmatch
+import argparse
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    from osgeo import ogr
+except ImportError:
+    #without GDAL, only CSV can be written
+    ogr = None
+
+from CadTraverse import parseLegs, iterTraverse
+
+
+def processFile(path, options):
+    """
+    Computes the traverse of one file (run in the worker processes).
+    Returns (path, xs, ys, seconds, error), error being None on success.
+    """
+    start = time.time()
+    (xs, ys) = (array('d'), array('d'))
+    try:
+        with io.open(path, encoding='utf-8', errors='replace') as lines:
+            for (x, y) in iterTraverse(options.previous, options.start, parseLegs(lines, None, options.metersPerUnit, options.polar), options.polar, options.relative, options.relative, options.relative):
+                xs.append(x)
+                ys.append(y)
+    except (IOError, OSError, ValueError) as e:
+        return (path, None, None, time.time()-start, str(e))
+    except Exception as e:
+        #unexpected errors (such as a RecursionError on a pathological expression) only fail this file
+        return (path, None, None, time.time()-start, "%s: %s" % (type(e).__name__, e))
+    return (path, xs, ys, time.time()-start, None)
+
+
+class CsvWriter():
+    """
+    Writes the vertices as file,vertex,x,y rows
+    """
+
+    def __init__(self, path):
+        self.output = io.open(path, 'w', encoding='utf-8')
+        self.output.write(u"file,vertex,x,y\n")
+
+    def write(self, path, start, xs, ys):
+        path = u'"%s"' % path.replace(u'"', u'""')
+        rows = [u"%s,%d,%r,%r\n" % (path, 0, start[0], start[1])]
+        rows.extend( u"%s,%d,%r,%r\n" % (path, i+1, xs[i], ys[i]) for i in range(len(xs)) )
+        self.output.writelines(rows)
+
+    def close(self):
+        self.output.close()
+
+
+class GeoPackageWriter():
+    """
+    Writes one linestring per file, in one single transaction
+    """
+
+    def __init__(self, path):
+        if ogr is None:
+            raise RuntimeError("GDAL's python bindings are needed to write a GeoPackage")
+        driver = ogr.GetDriverByName("GPKG")
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        self.dataSource = driver.CreateDataSource(path)
+        self.layer = self.dataSource.CreateLayer("traverses", geom_type=ogr.wkbLineString)
+        self.layer.CreateField( ogr.FieldDefn("file", ogr.OFTString) )
+        self.layer.CreateField( ogr.FieldDefn("vertices", ogr.OFTInteger) )
+        self.layer.StartTransaction()
+
+    def write(self, path, start, xs, ys):
+        geometry = ogr.Geometry(ogr.wkbLineString)
+        geometry.AddPoint_2D(start[0], start[1])
+        for i in range(len(xs)):
+            geometry.AddPoint_2D(xs[i], ys[i])
+        feature = ogr.Feature( self.layer.GetLayerDefn() )
+        feature.SetField("file", path)
+        feature.SetField("vertices", len(xs)+1)
+        feature.SetGeometry(geometry)
+        self.layer.CreateFeature(feature)
+
+    def close(self):
+        self.layer.CommitTransaction()
+        self.dataSource = None
+
+
+def openWriter(path):
+    """
+    Returns the writer of the output file, according to its extension (raises RuntimeError if its dependencies are missing)
+    """
+    if path.lower().endswith(".gpkg"):
+        return GeoPackageWriter(path)
+    return CsvWriter(path)
+
+
+def inputFiles(paths, pattern):
+    """
+    Yields the files given on the command line, and the files matching the pattern in the given directories
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for (directory, subdirectories, names) in os.walk(path):
+                for name in sorted(fnmatch.filter(names, pattern)):
+                    yield os.path.join(directory, name)
+        else:
+            yield path
+
+
+def run(options, report=None):
+    """
+    Computes the traverses of all the input files across a process pool. The results are written as they
+    complete by this process (so that they are only pickled once, from the worker to here), while the workers go on.
+    Reports the timing of each file, and returns the number of failed files.
+    """
+    report = report or sys.stdout
+    writer = openWriter(options.output)
+
+    failures = 0
+    count = 0
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=options.workers) as executor:
+            futures = [executor.submit(processFile, path, options) for path in inputFiles(options.inputs, options.pattern)]
+            try:
+                for future in as_completed(futures):
+                    (path, xs, ys, seconds, error) = future.result()
+                    count += 1
+                    if error is None:
+                        writer.write( path, options.start, xs, ys )
+                        report.write("%s\tok\t%d vertices\t%.3fs\n" % (path, len(xs), seconds))
+                    else:
+                        failures += 1
+                        report.write("%s\tFAILED\t%s\t%.3fs\n" % (path, error, seconds))
+            except:
+                # the files not started yet are not computed for nothing
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        writer.close()
+
+    report.write("%d files, %d failed, %.3fs\n" % (count, failures, time.time()-start))
+    return failures
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Computes the traverses of many field book files (see CadTraverse for their format)")
+    parser.add_argument("inputs", nargs="+", help="files or directories")
+    parser.add_argument("-o", "--output", required=True, help="output file (.csv or .gpkg)")
+    parser.add_argument("--pattern", default="*.txt", help="pattern of the files in the directories (default *.txt)")
+    parser.add_argument("--cartesian", dest="polar", action="store_false", help="legs are x y pairs (default : d a pairs)")
+    parser.add_argument("--absolute", dest="relative", action="store_false", help="angles (or x and y) are absolute (default : relative)")
+    parser.add_argument("--start", nargs=2, type=float, default=(0.0, 0.0), metavar=("X", "Y"), help="start point of the traverses")
+    parser.add_argument("--previous", nargs=2, type=float, default=None, metavar=("X", "Y"), help="point before the start, for the first relative angle (default : the start point, i.e. relative to the x axis)")
+    parser.add_argument("--meters-per-unit", dest="metersPerUnit", type=float, default=1.0, help="length of the output's unit in meters, for the m and ft suffixes (default : 1.0)")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="number of worker processes (default : number of cores)")
+    options = parser.parse_args(arguments)
+    options.start = tuple(options.start)
+    options.previous = options.start if options.previous is None else tuple(options.previous)
+
+    try:
+        return 1 if run(options) else 0
+    except (RuntimeError, EnvironmentError) as e:
+        # the output can't be written (or the pool broke) : the failures of single files don't get here
+        sys.stderr.write("%s\n" % e)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Import the PyQt and QGIS libraries
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from qgis.core import *
+from qgis.gui import *
+
+
+class CadCommitter(QObject):
+    """
+    This class commits the constrained points at model precision, directly in map units.
+
+    The CadEventFilter otherwise has to send a synthetic mouse event (at pixel precision) and to
+    rely on a temporary point in the technical layer for QGIS to snap back to the exact coordinate.
+
+    A point can be committed directly :
+    - to map tools which accept map points, i.e. which have an addVertex(QgsPoint) method
+    - to the edit buffer of the current point layer, when the add feature tool is active
+    Other tools (the capture tools of QGIS for lines and polygons don't expose their geometry to Python)
+    still go through the synthetic events.
+    """
+
+    def __init__(self, iface):
+        QObject.__init__(self)
+        self.iface = iface
+
+    def accepts(self, button):
+        """
+        Returns True if a click of the given button can be committed directly to the current map tool
+        """
+        if button != Qt.LeftButton:
+            return False
+        return self._toolAddsVertices() or self._editedPointLayer() is not None
+
+    def commitPoint(self, point):
+        """
+        Adds the point (in map coordinates) to the current map tool's geometry or, for the add feature tool, to the current layer.
+        Returns True if the point was committed.
+        """
+        if self._toolAddsVertices():
+            self.iface.mapCanvas().mapTool().addVertex( QgsPoint(point) )
+            return True
+
+        layer = self._editedPointLayer()
+        if layer is None:
+            return False
+        self.addFeature( layer, self.geometry(layer, [point]), "Feature added" )
+        return True
+
+    def geometry(self, layer, points):
+        """
+        Returns the geometry made of the points (in map coordinates) in the layer's coordinates and type
+        """
+        renderer = self.iface.mapCanvas().mapRenderer()
+        points = [renderer.mapToLayerCoordinates(layer, QgsPoint(point)) for point in points]
+        multi = QGis.isMultiType( layer.wkbType() )
+
+        if layer.geometryType() == QGis.Point:
+            if multi:
+                return QgsGeometry.fromMultiPoint( points )
+            return QgsGeometry.fromPoint( points[0] )
+        elif layer.geometryType() == QGis.Line:
+            if multi:
+                return QgsGeometry.fromMultiPolyline( [points] )
+            return QgsGeometry.fromPolyline( points )
+        else:
+            if multi:
+                return QgsGeometry.fromMultiPolygon( [[points+points[:1]]] )
+            return QgsGeometry.fromPolygon( [points+points[:1]] )
+
+    def commitPoints(self, start, points, title):
+        """
+        Commits several points (in map coordinates) at once, the previous point being start :
+        - map tools accepting map points receive them one after the other
+        - else they are added to the current layer being edited, as one single edit command : as one feature per point
+          for point layers, or as one feature going through start and the points for line and polygon layers
+        Returns True if the points were committed (or if the user cancelled the attribute form).
+        """
+        if self._toolAddsVertices():
+            for point in points:
+                self.iface.mapCanvas().mapTool().addVertex( QgsPoint(point) )
+            return True
+
+        layer = self.iface.mapCanvas().currentLayer()
+        if not isinstance(layer, QgsVectorLayer) or not layer.isEditable() or not layer.hasGeometryType():
+            return False
+        if layer.geometryType() == QGis.Point:
+            geometries = [self.geometry(layer, [point]) for point in points]
+        else:
+            geometries = [self.geometry(layer, [start]+points)]
+        return self.addFeatures( layer, geometries, title, len(geometries) == 1 ) is not None
+
+    def addFeature(self, layer, geometry, title):
+        """
+        Adds a feature with the given geometry to the layer's edit buffer, as one undoable edit command,
+        once its attribute form is accepted (unless the user disabled the form).
+        Returns the feature, or None if it was not added.
+        """
+        features = self.addFeatures( layer, [geometry], title, True )
+        return features[0] if features else None
+
+    def addFeatures(self, layer, geometries, title, openForm=False):
+        """
+        Adds features with the given geometries to the layer's edit buffer, as one single undoable edit command.
+        With openForm, the attribute forms are opened first (unless the user disabled them) : if one is cancelled, nothing is added.
+        Returns the features, an empty list if a form was cancelled, or None if they could not be added.
+        """
+        template = self._template(layer)
+        features = []
+        for geometry in geometries:
+            feature = QgsFeature( template )
+            feature.setGeometry( geometry )
+            features.append( feature )
+
+        if openForm and not QSettings().value("/qgis/digitizing/disable_enter_attribute_values_dialog", False, type=bool):
+            for feature in features:
+                #the form only edits the feature's attributes, the feature is added below
+                if not self.iface.openFeatureForm( layer, feature, True ):
+                    return []
+
+        layer.beginEditCommand( title )
+        for feature in features:
+            if not layer.addFeature( feature, True ):
+                layer.destroyEditCommand()
+                return None
+        layer.endEditCommand()
+        layer.triggerRepaint()
+        return features
+
+    def commitPointStream(self, start, points, title, chunkSize=1000):
+        """
+        Commits the points of an iterable (of (x, y) tuples in map coordinates, the previous point being start) to the current layer
+        being edited, as one single edit command, without opening any attribute form :
+        - for point layers, the points are consumed lazily and added in chunks of chunkSize features, so that the memory stays bounded
+        - for line and polygon layers, they make one feature going through start and the points (which has to hold all of them)
+        Map tools having an addVertex method get the points once the whole iterable is read (the tool holds all of them anyway).
+        If the iterable raises, nothing is committed (the edit command is reverted) and the exception propagates.
+        Returns the number of committed points, or None if there is no layer being edited.
+        """
+        if self._toolAddsVertices():
+            #the tool can't take vertices back : all the points are read (and validated) before the first one is sent
+            vertices = [QgsPoint(x, y) for (x, y) in points]
+            for vertex in vertices:
+                self.iface.mapCanvas().mapTool().addVertex( vertex )
+            return len(vertices)
+
+        layer = self.iface.mapCanvas().currentLayer()
+        if not isinstance(layer, QgsVectorLayer) or not layer.isEditable() or not layer.hasGeometryType():
+            return None
+
+        template = self._template(layer)
+        count = 0
+        layer.beginEditCommand( title )
+        try:
+            if layer.geometryType() == QGis.Point:
+                chunk = []
+                for (x, y) in points:
+                    feature = QgsFeature( template )
+                    feature.setGeometry( self.geometry(layer, [QgsPoint(x, y)]) )
+                    chunk.append( feature )
+                    if len(chunk) >= chunkSize:
+                        count += self._addChunk(layer, chunk)
+                        chunk = []
+                count += self._addChunk(layer, chunk)
+            else:
+                vertices = [QgsPoint(x, y) for (x, y) in points]
+                if vertices:
+                    feature = QgsFeature( template )
+                    feature.setGeometry( self.geometry(layer, [start]+vertices) )
+                    count = self._addChunk(layer, [feature]) and len(vertices)
+        except:
+            layer.destroyEditCommand()
+            raise
+        layer.endEditCommand()
+        layer.triggerRepaint()
+        return count
+
+    def _addChunk(self, layer, features):
+        if features and not layer.addFeatures( features, False ):
+            raise RuntimeError("the features could not be added to "+layer.name())
+        return len(features)
+
+    def _template(self, layer):
+        """
+        Returns a feature holding the default values of the layer's fields
+        """
+        fields = layer.pendingFields()
+        template = QgsFeature( fields )
+        for i in range( fields.count() ):
+            template.setAttribute( i, layer.dataProvider().defaultValue(i) )
+        return template
+
+    def _toolAddsVertices(self):
+        """
+        Map tools having an addVertex method receive the committed points directly
+        """
+        mapTool = self.iface.mapCanvas().mapTool()
+        return mapTool is not None and callable( getattr(mapTool, 'addVertex', None) )
+
+    def _editedPointLayer(self):
+        """
+        Returns the current layer if it is a point layer being edited with the add feature tool, else None
+        """
+        mapTool = self.iface.mapCanvas().mapTool()
+        layer = self.iface.mapCanvas().currentLayer()
+        if mapTool is None or mapTool.action() is None or mapTool.action() != self.iface.actionAddFeature():
+            return None
+        if not isinstance(layer, QgsVectorLayer) or not layer.isEditable() or layer.geometryType() != QGis.Point:
+            return None
+        return layer
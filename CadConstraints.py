@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# This module has no Qt nor QGIS dependency
+
+import math
+
+
+# The constraint maths of CadInput, working on plain (x, y) tuples.
+#
+# The model is a CadInputModel (or any object having the same attributes) : its locked values constrain the point,
+# and its unlocked values are updated from the constrained point. The snapped segment (if any) is given as its
+# (start, end) points : the constrained point is magnetized to the intersection of that segment and the locked value.
+
+parallelTolerance = 0.0001 # in degrees, lines closer to parallel are not intersected
+
+def constrain(model, p1, p2, p3, segment=None):
+    """
+    Returns the point p3 constrained by the model's locked values, p2 being the last click and p1 the previous one
+    (used for relative values), and updates the model's unlocked values.
+    """
+    (x2, y2) = p2
+    (x, y) = p3
+
+    #X
+    if model.lx:
+        x = lockedCoordinate(model.x, x2, model.rx)
+
+        if segment is not None and not model.ly:
+            # we will magnetize to the intersection of that segment and the lockedX !
+            y = magnetizeToX(x, y, segment)
+    else:
+        model.x = relativeCoordinate(x, x2, model.rx)
+
+    #Y
+    if model.ly:
+        y = lockedCoordinate(model.y, y2, model.ry)
+
+        if segment is not None and not model.lx:
+            # we will magnetize to the intersection of that segment and the lockedY !
+            x = magnetizeToY(x, y, segment)
+    else:
+        model.y = relativeCoordinate(y, y2, model.ry)
+
+    #A
+    # We compute the angle relative to the last segment if ra (0° is aligned with last segment)
+    lastA = lastAngle(p1, p2) if model.ra else 0.0
+
+    if model.la:
+        direction = headingDirection( heading(model.a, lastA) )
+        (x, y) = projectOnLine( p2, direction, (x, y) )
+
+        if segment is not None and not model.ld:
+            # we will magnetize to the intersection of that segment and the lockedAngle !
+            intersection = lineIntersection( p2, direction, segment )
+            if intersection is not None:
+                (x, y) = intersection
+    else:
+        model.a = relativeAngle( p2, (x, y), lastA )
+
+    #D
+    if model.ld:
+        (x, y) = pointAtDistance( p2, (x, y), model.d )
+
+        if segment is not None and not model.la:
+            # we will magnetize to the intersection of that segment and the lockedDistance !
+            intersection = circleIntersection( p2, model.d, segment, (x, y) )
+            if intersection is not None:
+                (x, y) = intersection
+    else:
+        model.d = distance( p2, (x, y) )
+
+    return (x, y)
+
+# The kernel of the maths, shared by constrain, the plans and the traverses (see CadTraverse).
+# The arithmetic ones (lockedCoordinate, relativeCoordinate, heading, polarPoint) also work on numpy arrays.
+
+def lockedCoordinate(value, origin, relative):
+    """
+    Returns the coordinate given by a locked value, relative to the origin's coordinate if relative
+    """
+    if relative:
+        return origin + value
+    return value
+
+def relativeCoordinate(coordinate, origin, relative):
+    """
+    Returns the value of a coordinate, relative to the origin's coordinate if relative (the inverse of lockedCoordinate)
+    """
+    if relative:
+        return coordinate - origin
+    return coordinate
+
+def lastAngle(p1, p2):
+    """
+    Returns the angle of the segment from p1 to p2 (in radians), the reference of the relative angles
+    """
+    return math.atan2(p2[1] - p1[1], p2[0] - p1[0])
+
+radiansPerDegree = math.pi / 180.0 # as math.radians, but also for numpy arrays
+
+def heading(a, lastA=0.0):
+    """
+    Returns the heading (in radians) of the angle a (in degrees), relative to lastA (in radians)
+    """
+    return a*radiansPerDegree + lastA
+
+def headingDirection(h):
+    """
+    Returns the unit vector of the heading h (in radians)
+    """
+    return (math.cos(h), math.sin(h))
+
+def relativeAngle(origin, p, lastA=0.0):
+    """
+    Returns the angle (in degrees) of the segment from origin to p, relative to lastA (in radians)
+    """
+    return math.degrees( math.atan2(p[1] - origin[1], p[0] - origin[0]) - lastA )
+
+def distance(origin, p):
+    """
+    Returns the distance from origin to p
+    """
+    dx = p[0] - origin[0]
+    dy = p[1] - origin[1]
+    return math.sqrt(dx*dx + dy*dy)
+
+def polarPoint(origin, direction, d):
+    """
+    Returns the point at the (signed) distance d from origin, along the unit vector direction
+    """
+    return (origin[0] + direction[0]*d, origin[1] + direction[1]*d)
+
+def projectOnLine(origin, direction, p):
+    """
+    Returns the projection of p on the line going through origin along the unit vector direction
+    """
+    return polarPoint( origin, direction, direction[0]*(p[0] - origin[0]) + direction[1]*(p[1] - origin[1]) )
+
+def pointAtDistance(origin, p, d):
+    """
+    Returns the point at the distance d from origin, in the direction of p (p itself if it is the origin)
+    """
+    length = distance(origin, p)
+    if length > 0:
+        vP = d / length
+        return (origin[0] + (p[0] - origin[0])*vP, origin[1] + (p[1] - origin[1])*vP)
+    return p
+
+def magnetizeToX(x, y, segment):
+    """
+    Returns the y of the segment's (unbounded) line at x, or y if the segment is vertical
+    """
+    ((sx1, sy1), (sx2, sy2)) = segment
+    dx = sx2 - sx1
+    dy = sy2 - sy1
+    if dy == 0:
+        return sy1
+    elif dx != 0:
+        return sy1 + (dy * (x-sx1)) / dx
+    return y
+
+def magnetizeToY(x, y, segment):
+    """
+    Returns the x of the segment's (unbounded) line at y
+    """
+    ((sx1, sy1), (sx2, sy2)) = segment
+    dx = sx2 - sx1
+    dy = sy2 - sy1
+    if dy == 0:
+        return sx1
+    return sx1 + (dx * (y-sy1)) / dy
+
+def alignToSegment(model, p1, p2, segment):
+    """
+    Returns the angle (in degrees, relative to the last segment if model.ra) which is parallel
+    (or perpendicular if model.per) to the segment, or None if there is no segment
+    """
+    if segment is None:
+        return None
+    ((sx1, sy1), (sx2, sy2)) = segment
+    angle = math.atan2(sy1 - sy2, sx1 - sx2)
+    if model.ra:
+        angle -= lastAngle(p1, p2)
+    if model.per:
+        angle += math.pi / 2.0
+    return math.degrees(angle)
+
+def lineIntersection(origin, direction, segment):
+    """
+    Returns the intersection of the line going through origin in the given direction and the (unbounded) segment's line,
+    or None if they are (nearly) parallel
+    """
+    (ox, oy) = origin
+    (ux, uy) = direction
+    ((sx1, sy1), (sx2, sy2)) = segment
+    (vx, vy) = (sx2 - sx1, sy2 - sy1)
+
+    cross = ux*vy - uy*vx
+    angle = math.degrees( math.atan2(cross, ux*vx + uy*vy) ) % 180.0
+    if angle < parallelTolerance or angle > 180.0 - parallelTolerance:
+        return None
+
+    t = ((sx1 - ox)*vy - (sy1 - oy)*vx) / cross
+    return (ox + t*ux, oy + t*uy)
+
+def circleIntersection(center, r, segment, near):
+    """
+    Returns the intersection of the circle and the (unbounded) segment's line which is the nearest to near,
+    or None if they don't intersect (or are tangent)
+    Formula taken from http://mathworld.wolfram.com/Circle-LineIntersection.html
+    """
+    (xo, yo) = center
+    ((sx1, sy1), (sx2, sy2)) = segment
+    x1 = sx1 - xo
+    y1 = sy1 - yo
+    x2 = sx2 - xo
+    y2 = sy2 - yo
+
+    dx = x2 - x1
+    dy = y2 - y1
+    dr2 = dx*dx + dy*dy
+    d = x1*y2 - x2*y1
+
+    disc = r*r * dr2 - d*d
+    if disc <= 0:
+        #no intersection or tangent
+        return None
+    root = math.sqrt(disc)
+    sgn = -1 if dy < 0 else 1
+
+    #first possible point
+    ax = xo + (d*dy + sgn*dx*root) / dr2
+    ay = yo + (-d*dx + abs(dy)*root) / dr2
+
+    #second possible point
+    bx = xo + (d*dy - sgn*dx*root) / dr2
+    by = yo + (-d*dx - abs(dy)*root) / dr2
+
+    #we snap to the nearest intersection
+    (x, y) = near
+    if (ax-x)**2 + (ay-y)**2 >= (bx-x)**2 + (by-y)**2:
+        return (bx, by)
+    return (ax, ay)
+
+def planKey(model, p1, p2):
+    """
+    Returns everything a plan depends on (see compilePlan) : the plan has to be compiled again only when this changes
+    """
+    return (    model.lx, model.ly, model.la, model.ld, model.rx, model.ry, model.ra,
+                model.x if model.lx else None, model.y if model.ly else None,
+                model.a if model.la else None, model.d if model.ld else None,
+                p1, p2  )
+
+def compilePlan(model, p1, p2):
+    """
+    Returns a function plan(p3, segment) giving the same results as constrain(model, p1, p2, p3, segment),
+    specialised for the model's current locks, relative modes and locked values (see planKey).
+
+    The plan only chains the steps needed by the current combination of locks (built from the same kernel
+    functions as constrain), and what only depends on the model, p1 and p2 (the locked coordinates, the last
+    segment's angle, the locked angle's direction) is computed once, when the plan is built.
+    """
+    (x2, y2) = p2
+    lastA = lastAngle(p1, p2) if model.ra else 0.0
+
+    if model.lx:
+        stepX = lockedXStep( lockedCoordinate(model.x, x2, model.rx), not model.ly )
+    else:
+        stepX = freeXStep( model, x2, model.rx )
+
+    if model.ly:
+        stepY = lockedYStep( lockedCoordinate(model.y, y2, model.ry), not model.lx )
+    else:
+        stepY = freeYStep( model, y2, model.ry )
+
+    if model.la:
+        stepA = lockedAngleStep( p2, headingDirection(heading(model.a, lastA)), not model.ld )
+    else:
+        stepA = freeAngleStep( model, p2, lastA )
+
+    if model.ld:
+        stepD = lockedDistanceStep( p2, model.d, not model.la )
+    else:
+        stepD = freeDistanceStep( model, p2 )
+
+    def plan(p3, segment=None):
+        return stepD( stepA( stepY( stepX(p3, segment), segment ), segment ), segment )
+    return plan
+
+# The steps of the plans : each one takes the point and the snapped segment, and returns the point
+
+def lockedXStep(x, magnetize):
+    def step(p, segment):
+        if magnetize and segment is not None:
+            return (x, magnetizeToX(x, p[1], segment))
+        return (x, p[1])
+    return step
+
+def freeXStep(model, x2, relative):
+    def step(p, segment):
+        model.x = relativeCoordinate(p[0], x2, relative)
+        return p
+    return step
+
+def lockedYStep(y, magnetize):
+    def step(p, segment):
+        if magnetize and segment is not None:
+            return (magnetizeToY(p[0], y, segment), y)
+        return (p[0], y)
+    return step
+
+def freeYStep(model, y2, relative):
+    def step(p, segment):
+        model.y = relativeCoordinate(p[1], y2, relative)
+        return p
+    return step
+
+def lockedAngleStep(p2, direction, magnetize):
+    def step(p, segment):
+        if magnetize and segment is not None:
+            intersection = lineIntersection(p2, direction, segment)
+            if intersection is not None:
+                return intersection
+        return projectOnLine(p2, direction, p)
+    return step
+
+def freeAngleStep(model, p2, lastA):
+    def step(p, segment):
+        model.a = relativeAngle(p2, p, lastA)
+        return p
+    return step
+
+def lockedDistanceStep(p2, d, magnetize):
+    def step(p, segment):
+        p = pointAtDistance(p2, p, d)
+        if magnetize and segment is not None:
+            intersection = circleIntersection(p2, d, segment, p)
+            if intersection is not None:
+                return intersection
+        return p
+    return step
+
+def freeDistanceStep(model, p2):
+    def step(p, segment):
+        model.d = distance(p2, p)
+        return p
+    return step
@@ -25,8 +25,17 @@ from PyQt4.QtGui import *
 from qgis.core import *
 from qgis.gui import *
 
+import io
 import math
 import random
+from collections import deque
+
+from CadSnapper import CadSnapper
+from CadCommitter import CadCommitter
+from CadTraverse import traverse, iterTraverse, parseLegs
+from CadConstraints import alignToSegment, compilePlan, planKey
+from CadPoints import toQgsPoint, toPair
+import CadPoints
 
 class CadEventFilter(QObject):
     """
@@ -37,22 +46,48 @@ class CadEventFilter(QObject):
     according to the constrained mouse position.
     """
 
+    stateChanged = pyqtSignal() # emitted when the points or the snaps changed (so the CadPaintWidget repaints)
+
 
-    def __init__(self, iface, inputwidget):
+    def __init__(self, iface, inputwidget, snapper=None):
         QObject.__init__(self)
         self.iface = iface
         self.inputwidget = inputwidget
+        self.model = inputwidget.model # the constraint state, read and written directly on the mouse move path
 
-        #input coordinates
-        self.p1 = QgsPoint() # previous click, used for delta angles
-        self.p2 = QgsPoint() # last click, used for delta positions
-        self.p3 = QgsPoint() # current position
+        #input coordinates, as (x, y) pairs (converted to QgsPoints only where QGIS needs them, see CadPoints)
+        self.p1 = (0.0, 0.0) # previous click, used for delta angles
+        self.p2 = (0.0, 0.0) # last click, used for delta positions
+        self.p3 = (0.0, 0.0) # current position
         self.snapSegment = None # segment snapped at current position (if any)
         self.snapPoint = None # point snapped at current position (if any)
 
+        #debug mode : the QgsPoint conversions per mouse event are counted and logged
+        CadPoints.debug = QSettings().value("/CadInput/debugConversions", False, type=bool)
+        self.debugEvents = 0
+
+        #constraint plan, compiled for the current locks (see _constrain)
+        self.plan = None
+        self.planKey = None
+
+        #snapping (a snapper may be given, as by the CadHarness : it is unloaded with the event filter all the same)
+        self.snapper = snapper if snapper is not None else CadSnapper(self.iface)
+
+        #direct commit of the clicked points (at model precision), when the current map tool allows it
+        self.committer = CadCommitter(self.iface)
+
+        #mouse move coalescing : moves are processed at most once every moveInterval milliseconds (0 processes every move)
+        self.moveInterval = QSettings().value("/CadInput/moveInterval", 16, type=int)
+        self.pendingMove = None # (obj, pos, button, buttons, modifiers) of the latest move waiting to be processed
+        self.moveTimer = QTimer(self)
+        self.moveTimer.setSingleShot(True)
+        self.moveTimer.timeout.connect( self.flushMove )
+
         #snapping hack
-        self.storeOtherSnapping = None #holds the layer's snapping options when snapping is suspended or None if snappig is not suspended
-        self.otherSnappingStored = False
+        self.memoryLayer = None # the technical layer, holding one single point (see createSnappingPoint)
+        self.snapFeatureId = None
+        self.inputwidget.valueChanged.connect( self.updateSnappingSuspension )
+        self.updateSnappingSuspension()
 
 
     ############################
@@ -66,62 +101,16 @@ class CadEventFilter(QObject):
                     (  (event.type() == QEvent.MouseMove and event.button() != Qt.MidButton) or
                        (event.type() == QEvent.MouseButtonPress and event.button() != Qt.MidButton) or
                        (event.type() == QEvent.MouseButtonRelease and event.button() != Qt.MidButton) ) ):
-            
-            # Get the snaps
-            (self.snapPoint, self.snapSegment) = self._toMapSnap( event.pos() )
-
-            # Set the current mouse position (either from snapPoint, from snapSegment, or regular coordinate transform)
-            if self.snapPoint is not None:
-                p3 = QgsPoint(self.snapPoint)
-            elif self.snapSegment is not None:
-                p3 = self.snapSegment[0]
-            else:
-                p3 = self.iface.mapCanvas().getCoordinateTransform().toMapCoordinates( event.pos() )
-
-            self.p3 = self._constrain(p3)
-
-
-            # Depending on the mode...
-            if self.inputwidget.par or self.inputwidget.per:
-                #A. Set segment mode (we set the angle)
-                if event.type() == QEvent.MouseButtonPress:
-                    self._alignToSegment()
-                elif event.type() == QEvent.MouseButtonRelease and self.snapSegment:
-                    self.inputwidget.par = False
-                    self.inputwidget.per = False
 
+            if event.type() == QEvent.MouseMove and self.moveInterval > 0:
+                # Coalescing : we only keep the latest move, which will be processed when the moveTimer times out
+                self.pendingMove = (obj, QPoint(event.pos()), event.button(), event.buttons(), event.modifiers())
+                if not self.moveTimer.isActive():
+                    self.moveTimer.start(self.moveInterval)
             else:
-                #B. Input mode
-
-
-                if self.inputwidget.c:
-                    #B1. Construction mode
-                    pass
-
-                else:
-                    #B2. Normal input mode
-
-                    if event.type() == QEvent.MouseButtonPress or event.type() == QEvent.MouseButtonRelease:
-                        #B2a. Mouse press input mode
-                        self.createSnappingPoint()
-                        modifiedEvent = QMouseEvent( event.type(), self._toPixels(self.p3), event.button(), event.buttons(), event.modifiers() )
-                        QCoreApplication.sendEvent(obj,modifiedEvent)
-                        self.removeSnappingPoint()
-
-                    else:
-                        #B2B. Mouse move input mode
-                        modifiedEvent = QMouseEvent( event.type(), self._toPixels(self.p3), event.button(), event.buttons(), event.modifiers() )
-                        QCoreApplication.sendEvent(obj,modifiedEvent)
-
-                # We unlock all the inputs, since we don't want locking to stay for the next point (actually, sometimes we do, this could be an option)
-                if event.type() == QEvent.MouseButtonRelease:
-                    self.inputwidget.unlockAll()
-
-                if event.type() == QEvent.MouseButtonRelease:
-                    # In input mode (B), we register the last points for following relative calculation in case of mousePress
-                    self.p1 = self.p2
-                    self.p2 = self.p3
-
+                # The pending move must be processed first, so that clicks are never lost nor reordered
+                self.flushMove()
+                self._processMouseEvent(obj, event.type(), event.pos(), event.button(), event.buttons(), event.modifiers())
 
             # By returning True, we inform the eventSystem that the event must not be sent further (since a new event has been sent through QCoreApplication)
             return True
@@ -134,213 +123,209 @@ class CadEventFilter(QObject):
             #In case we don't manage this type of event, or if it was already treated (spontaneous==False), we return the normal implementation
             return QObject.eventFilter(self, obj, event)
 
-
-    ########################
-    ##### CONSTRAINING #####
-    ########################
-
-    def _constrain(self, p3):
+    def flushMove(self):
         """
-        This method returns a point constrained by the w's settings and, by the way, updates the w's displayed values.
+        Processes the pending mouse move (if any)
         """
+        self.moveTimer.stop()
+        if self.pendingMove is not None:
+            (obj, pos, button, buttons, modifiers) = self.pendingMove
+            self.pendingMove = None
+            self._processMouseEvent(obj, QEvent.MouseMove, pos, button, buttons, modifiers)
 
+    def _processMouseEvent(self, obj, eventType, pos, button, buttons, modifiers):
+        """
+        Snaps and constrains a mouse event, and sends the constrained event to obj
+        """
+            
+        # The mouse position in map coordinates (mapped once, for the snapper and as the default position)
+        mapPoint = toPair( self.iface.mapCanvas().getCoordinateTransform().toMapCoordinates( pos ) )
 
-        #X
-        if self.inputwidget.lx:
-            if self.inputwidget.rx:
-                p3.setX( self.p2.x() + self.inputwidget.x )
-            else:
-                p3.setX( self.inputwidget.x )
-   
-            if self.snapSegment is not None and not self.inputwidget.ly:
-                # we will magnietize to the intersection of that segment and the lockedX !
-                x = p3.x()
-
-                x1 = self.snapSegment[1].x()
-                y1 = self.snapSegment[1].y()
-                x2 = self.snapSegment[2].x()
-                y2 = self.snapSegment[2].y()
-
-                dx = x2 - x1
-                dy = y2 - y1
-
-                if dy==0:
-                    y = y1
-                else:
-                    y = y1+(dy * (x-x1) ) / dx
-
-                p3.setY( y )
+        # Get the snaps
+        (self.snapPoint, self.snapSegment) = self._toMapSnap( pos, mapPoint )
 
+        # Set the current mouse position (either from snapPoint, from snapSegment, or regular coordinate transform)
+        if self.snapPoint is not None:
+            p3 = self.snapPoint
+        elif self.snapSegment is not None:
+            p3 = self.snapSegment[0]
         else:
-            if self.inputwidget.rx:
-                self.inputwidget.x = p3.x()-self.p2.x()
-            else:
-                self.inputwidget.x = p3.x()
+            p3 = mapPoint
 
-        #Y
-        if self.inputwidget.ly:
-            if self.inputwidget.ry:
-                p3.setY( self.p2.y() + self.inputwidget.y )
-            else:
-                p3.setY( self.inputwidget.y )
+        self.p3 = self._constrain(p3)
 
-            if self.snapSegment is not None and not self.inputwidget.lx:  
-                # we will magnietize to the intersection of that segment and the lockedY !              
 
-                y = p3.y()
+        # Depending on the mode...
+        if self.model.par or self.model.per:
+            #A. Set segment mode (we set the angle)
+            if eventType == QEvent.MouseButtonPress:
+                self._alignToSegment()
+            elif eventType == QEvent.MouseButtonRelease and self.snapSegment:
+                self.inputwidget.par = False
+                self.inputwidget.per = False
 
-                x1 = self.snapSegment[1].x()
-                y1 = self.snapSegment[1].y()
-                x2 = self.snapSegment[2].x()
-                y2 = self.snapSegment[2].y()
+        else:
+            #B. Input mode
 
-                dx = x2 - x1
-                dy = y2 - y1
 
-                if dy==0:
-                    x = x1
-                else:
-                    x = x1+(dx * (y-y1) ) / dy
+            if self.model.c:
+                #B1. Construction mode
+                pass
 
-                p3.setX( x )
-        else:
-            if self.inputwidget.ry:
-                self.inputwidget.y = p3.y()-self.p2.y()
             else:
-                self.inputwidget.y = p3.y()
-
-        #A
-        dx =  p3.x()-self.p2.x()
-        dy =  p3.y()-self.p2.y()
-
-        if self.inputwidget.la:
-            a = self.inputwidget.a/180.0*math.pi
-            if self.inputwidget.ra:
-                # We compute the angle relative to the last segment (0° is aligned with last segment)
-                lastA = math.atan2(self.p2.y() - self.p1.y(), self.p2.x() - self.p1.x())
-                a = lastA+a
-
-            cosA = math.cos( a )
-            sinA = math.sin( a )
-            v1 = [ cosA, sinA ]
-            v2 = [ dx, dy ]
-            vP = v1[0]*v2[0]+v1[1]*v2[1]
-            p3.set( self.p2.x()+cosA*vP, self.p2.y()+sinA*vP)
-
-            if self.snapSegment is not None and not self.inputwidget.ld:  
-                # we will magnietize to the intersection of that segment and the lockedAngle !
-
-                l1 = QLineF(self.p2.x(), self.p2.y(), self.p2.x()+math.cos(a), self.p2.y()+math.sin(a))
-                l2 = QLineF(self.snapSegment[1].x(), self.snapSegment[1].y(), self.snapSegment[2].x() ,self.snapSegment[2].y())
-
-                intP = QPointF()
-                ang = l1.angleTo(l2)
-                t = 0.0001
-                # TODO : this may cause some accuracy problem ?
-                if l1.intersect(l2, intP) == QLineF.UnboundedIntersection and not (ang < t or ang > 360-t or (ang > 180-t and ang < 180+t) ):
-                    p3.setX( intP.x() )
-                    p3.setY( intP.y() )
+                #B2. Normal input mode
 
-        else:
-            if self.inputwidget.ra:
-                lastA = math.atan2(self.p2.y() - self.p1.y(), self.p2.x() - self.p1.x())
-                self.inputwidget.a = (math.atan2( dy, dx )-lastA)/math.pi*180
-            else:
-                self.inputwidget.a = math.atan2( dy, dx )/math.pi*180
+                if (eventType == QEvent.MouseButtonPress or eventType == QEvent.MouseButtonRelease) and self.committer.accepts(button):
+                    #B2a. Direct input mode : the point is committed on release, without any synthetic event
+                    if eventType == QEvent.MouseButtonRelease:
+                        self.committer.commitPoint( toQgsPoint(self.p3) )
 
+                elif eventType == QEvent.MouseButtonPress or eventType == QEvent.MouseButtonRelease:
+                    #B2b. Mouse press input mode (tools accepting map points read the exact point from the event, the others snap to the technical layer)
+                    technical = not self._acceptsMapPoints()
+                    if technical:
+                        self.createSnappingPoint()
+                    modifiedEvent = self._mouseEvent( eventType, button, buttons, modifiers )
+                    QCoreApplication.sendEvent(obj,modifiedEvent)
+                    if technical:
+                        self.removeSnappingPoint()
 
+                else:
+                    #B2c. Mouse move input mode
+                    modifiedEvent = self._mouseEvent( eventType, button, buttons, modifiers )
+                    QCoreApplication.sendEvent(obj,modifiedEvent)
 
-        #D
-        dx =  p3.x()-self.p2.x()
-        dy =  p3.y()-self.p2.y()
+            # We unlock all the inputs, since we don't want locking to stay for the next point (actually, sometimes we do, this could be an option)
+            if eventType == QEvent.MouseButtonRelease:
+                self.inputwidget.unlockAll()
 
-        if self.inputwidget.ld:
-            vP = self.inputwidget.d / math.sqrt( dx*dx + dy*dy )
-            p3.set( self.p2.x()+dx*vP,  self.p2.y()+dy*vP )
+            if eventType == QEvent.MouseButtonRelease:
+                # In input mode (B), we register the last points for following relative calculation in case of mousePress
+                self.p1 = self.p2
+                self.p2 = self.p3
 
-            if self.snapSegment is not None and not self.inputwidget.la:  
-                # we will magnietize to the intersection of that segment and the lockedDistance !
-                # formula taken from http://mathworld.wolfram.com/Circle-LineIntersection.html
+        self.inputwidget.scheduleSync()
+        self.stateChanged.emit()
 
-                xo = self.p2.x()
-                yo = self.p2.y()
+        if CadPoints.debug:
+            self.debugEvents += 1
+            if self.debugEvents == 1000:
+                QgsMessageLog.logMessage("%.2f QgsPoint conversions per mouse event" % (CadPoints.conversions/1000.0), "CadInput")
+                CadPoints.conversions = 0
+                self.debugEvents = 0
 
-                x1 = self.snapSegment[1].x()-xo
-                y1 = self.snapSegment[1].y()-yo
-                x2 = self.snapSegment[2].x()-xo
-                y2 = self.snapSegment[2].y()-yo
 
-                r = self.inputwidget.d
+    ####################
+    ##### TRAVERSE #####
+    ####################
 
-                dx = x2-x1
-                dy = y2-y1
-                dr = math.sqrt(dx**2+dy**2)
-                d = x1*y2-x2*y1
+    def traverse(self, legs, polar):
+        """
+        Computes the vertices of a traverse from the last clicked point (see CadTraverse.traverse), the angles and coordinates
+        being relative according to the inputwidget's relative modes, and commits them as one edit command.
+        Returns True if the vertices were committed.
+        """
+        vertices = traverse( self.p1, self.p2, legs, polar, self.model.ra, self.model.rx, self.model.ry )
+        if not vertices:
+            return False
 
-                def sgn(x): return -1 if x<0 else 1
+        points = [toQgsPoint(vertex) for vertex in vertices]
+        if not self.committer.commitPoints( toQgsPoint(self.p2), points, "Traverse added" ):
+            self.iface.messageBar().pushMessage("CadInput", "The traverse needs a layer in edit mode", QgsMessageBar.WARNING, 5)
+            return False
 
-                DISC = r**2 * dr**2 - d**2
+        # The traverse's last points are registered for following relative calculation, as if they had been clicked
+        self.p1 = vertices[-2] if len(vertices) > 1 else self.p2
+        self.p2 = vertices[-1]
+        self.p3 = vertices[-1]
+        self.inputwidget.scheduleSync()
+        self.stateChanged.emit()
+        return True
 
-                if DISC<=0:
-                    #no intersection or tangeant
-                    pass
-                else:
-                    #first possible point
-                    ax = xo  +  (d*dy+sgn(dy)*dx*math.sqrt(r**2*dr**2-d**2))/(dr**2)
-                    ay = yo  +  (-d*dx+abs(dy)*math.sqrt(r**2*dr**2-d**2))/(dr**2)
-
-                    #second possible point
-                    bx = xo  +  (d*dy-sgn(dy)*dx*math.sqrt(r**2*dr**2-d**2))/(dr**2)
-                    by = yo  +  (-d*dx-abs(dy)*math.sqrt(r**2*dr**2-d**2))/(dr**2)
-
-                    #we snap to the nearest intersection
-                    if (ax-p3.x())**2+(ay-p3.y())**2 >= (bx-p3.x())**2+(by-p3.y())**2:
-                        p3.setX( bx )
-                        p3.setY( by )
-                    else:
-                        p3.setX( ax )
-                        p3.setY( ay )
-                
-                
-        else:
-            self.inputwidget.d = math.sqrt( dx*dx + dy*dy )
 
-        return p3
-    def _alignToSegment(self):
+    def importTraverse(self, path, polar):
         """
-        Set's the CadWidget's angle value to be parrelel to self.snapSegment's angle
+        Imports the legs of a traverse from a (field book) text file, from the last clicked point.
+        The file is read lazily and the vertices are committed in chunks, as one single edit command (see CadCommitter.commitPointStream),
+        so that the memory stays bounded whatever the size of the file.
+        Returns True if the vertices were committed.
         """
+        lastPoints = deque( [self.p1, self.p2], 2 )
+        def tracked(vertices):
+            #keeps the last two vertices, for following relative calculation
+            for vertex in vertices:
+                lastPoints.append( vertex )
+                yield vertex
 
-        if self.snapSegment is not None:
+        try:
+            with io.open(path, encoding='utf-8', errors='replace') as lines:
+                vertices = iterTraverse( lastPoints[0], lastPoints[1], parseLegs(lines, self.inputwidget.expressionContext(), self.inputwidget.mapMetersPerUnit(), polar), polar, self.model.ra, self.model.rx, self.model.ry )
+                count = self.committer.commitPointStream( toQgsPoint(self.p2), tracked(vertices), "Traverse imported" )
+        except (IOError, ValueError, RuntimeError) as e:
+            self.iface.messageBar().pushMessage("CadInput", "The traverse could not be imported, "+str(e), QgsMessageBar.WARNING, 5)
+            return False
 
-            angle = math.atan2( self.snapSegment[1].y()-self.snapSegment[2].y(), self.snapSegment[1].x()-self.snapSegment[2].x() )
-            if self.inputwidget.ra:
-                lastangle = math.atan2(self.p2.y()-self.p1.y(),self.p2.x()-self.p1.x())
-                angle -= lastangle
+        if count is None:
+            self.iface.messageBar().pushMessage("CadInput", "The traverse needs a layer in edit mode", QgsMessageBar.WARNING, 5)
+            return False
 
-            if self.inputwidget.par:
-                pass
-            elif self.inputwidget.per:
-                angle += math.pi / 2.0
+        self.p1 = lastPoints[0]
+        self.p2 = lastPoints[1]
+        self.p3 = self.p2
+        self.inputwidget.scheduleSync()
+        self.stateChanged.emit()
+        return True
+
+
+    ########################
+    ##### CONSTRAINING #####
+    ########################
+
+    def _constrain(self, p3):
+        """
+        This method returns a point constrained by the w's settings and, by the way, updates the w's displayed values.
+        The maths are done by a CadConstraints plan, specialised for the current locks (see CadConstraints.compilePlan).
+        """
+        # The plan is only compiled again when the locks, the relative modes, the locked values, p1 or p2 change
+        key = planKey( self.model, self.p1, self.p2 )
+        if key != self.planKey:
+            self.plan = compilePlan( self.model, self.p1, self.p2 )
+            self.planKey = key
 
+        return self.plan( p3, self._segment() )
+
+    def _alignToSegment(self):
+        """
+        Set's the CadWidget's angle value to be parrelel to self.snapSegment's angle
+        """
+        angle = alignToSegment( self.model, self.p1, self.p2, self._segment() )
+        if angle is not None:
             self.inputwidget.la = True
-            self.inputwidget.a = math.degrees(angle)      
+            self.model.a = angle
+
+    def _segment(self):
+        """
+        Returns the snapped segment as a (start, end) tuple of (x, y) pairs, or None
+        """
+        if self.snapSegment is None:
+            return None
+        return self.snapSegment[1:]
     
 
     #####################################
     ##### COORDINATE TRANSFORMATIONS ####
     #####################################
 
-    def _toMapSnap(self, qpoint):
+    def _toMapSnap(self, qpoint, mapPoint):
         """
         returns the current snapped point (if any) and the current snapped segment (if any) in map coordinates
         The current snapped segment is returned as (snapped point on segment, startPoint, endPoint)
 
-        We will :
-        1) check if this snaps on a point of the current layer, if not :
-        2) check if this snaps on a point of a background layer, if not :
-        3) check if this snaps on a segment of the current layer, if not :
-        4) check if this snaps on a segment of the background layer
+        The snapping is resolved in one single query by CadSnapper, with the following priority :
+        1) a vertex of the current layer
+        2) a vertex of a background layer
+        3) a segment of the current layer
+        4) a segment of a background layer
 
         if 1 or 2) we, snap to that point, and set the segment to None
         if 3 or 4) we, we snap to that segment, and set the segment for advanced snap (if another constraint is set)
@@ -348,52 +333,35 @@ class CadEventFilter(QObject):
         if none, we simply map the point to the scene
         """
 
-        #1) Snap on current layer vertex
-        snapper = QgsMapCanvasSnapper(self.iface.mapCanvas())
-        (reval, snapped) = snapper.snapToCurrentLayer(qpoint,QgsSnapper.SnapToVertex)
-        if snapped != []:
-            point = QgsPoint(snapped[0].snappedVertex.x(), snapped[0].snappedVertex.y())
-            return (point, None)
-
-        #2) Snap on background vertex
-        self.disableBackgroundSnapping('vertex')        
-        (reval, snapped) = snapper.snapToBackgroundLayers(qpoint)
-        self.restoreBackgroundSnapping()
-        if snapped != []:
-            point = QgsPoint(snapped[0].snappedVertex.x(), snapped[0].snappedVertex.y())
-            return (point, None)
-
-        #3) Snap on current layer segments
-        snapper = QgsMapCanvasSnapper(self.iface.mapCanvas())
-        (reval, snapped) = snapper.snapToCurrentLayer(qpoint,QgsSnapper.SnapToSegment)
-        if snapped != []:
-            point = QgsPoint(snapped[0].snappedVertex.x(), snapped[0].snappedVertex.y())
-            prevPoint = QgsPoint(snapped[0].beforeVertex.x(), snapped[0].beforeVertex.y())
-            afterPoint = QgsPoint(snapped[0].afterVertex.x(), snapped[0].afterVertex.y())
-            return (None, (point,prevPoint,afterPoint))
-
-        #4) Snap on background segments
-        self.disableBackgroundSnapping('segment')        
-        (reval, snapped) = snapper.snapToBackgroundLayers(qpoint)
-        self.restoreBackgroundSnapping()
-        if snapped != []:
-            point = QgsPoint(snapped[0].snappedVertex.x(), snapped[0].snappedVertex.y())
-            prevPoint = QgsPoint(snapped[0].beforeVertex.x(), snapped[0].beforeVertex.y())
-            afterPoint = QgsPoint(snapped[0].afterVertex.x(), snapped[0].afterVertex.y())
-            return (None, (point,prevPoint,afterPoint))
-
-        return (None, None)
-
-    def _toPixels(self, qgspoint):
-        """
-        Given a point in project's coordinates, returns a point in screen (pixel) coordinates
+        return self.snapper.snap(qpoint, mapPoint)
+
+    def _toPixels(self, point):
         """
+        Given an (x, y) pair in project's coordinates, returns a point in screen (pixel) coordinates, as a QPointF (not rounded)
+        """
+        (x, y) = toPair( self.iface.mapCanvas().getCoordinateTransform().transform( point[0], point[1] ) )
+        return QPointF( x, y )
+
+    def _mouseEvent(self, eventType, button, buttons, modifiers):
+        """
+        Returns the mouse event to dispatch for the current position.
+        Qt4's mouse events only have integer positions, so the position is rounded to the nearest pixel, and the event
+        carries the exact position (in pixels and in map units) for the map tools which understand it.
+        """
+        exactPos = self._toPixels(self.p3)
         try:
-            p = self.iface.mapCanvas().getCoordinateTransform().transform( qgspoint )
-            return QPoint( int(p.x()), int(p.y()) )
+            pos = QPoint( int(round(exactPos.x())), int(round(exactPos.y())) )
         except ValueError:
             #this happens sometimes at loading, it seems the mapCanvas is not ready and returns a point at NaN;NaN
-            return QPoint()
+            pos = QPoint()
+        return CadMouseEvent( eventType, pos, button, buttons, modifiers, exactPos, self.p3 )
+
+    def _acceptsMapPoints(self):
+        """
+        Map tools declaring acceptsMapPoints read the exact point from the CadMouseEvent, they don't need the technical layer
+        """
+        mapTool = self.iface.mapCanvas().mapTool()
+        return mapTool is not None and getattr(mapTool, 'acceptsMapPoints', False)
 
 
     #########################
@@ -402,94 +370,75 @@ class CadEventFilter(QObject):
     
     def createSnappingPoint(self):
         """
-        This method creates a point that will be snapped by the next click so that the point will be at model precision and not at screen precision.
-        It also disables all the other layer's snapping so they won't interfere. Those are reset in rmeoveSnapping point.
+        This method moves the technical layer's point to the current position, so that the next click will be snapped to it and the point will be at model precision and not at screen precision.
+        The technical layer is created once, and its single feature is moved (rather than created and deleted at each click).
         """
-        activeLayer = self.iface.activeLayer()
-
-        #store and remove all the snapping options
-        self.disableBackgroundSnapping()
+        self.updateSnappingSuspension()
 
         try:
             provider = self.memoryLayer.dataProvider()
         except (RuntimeError, AttributeError):
             #RuntimeError : if the user removed the layer, the underlying c++ object will be deleted
-            #AttributeError : if self.memory is None
-            self.cleanLayers("(cadinput_techical_snap_layer)")
-            self.memoryLayer = QgsVectorLayer("point", "(cadinput_techical_snap_layer)", "memory")
-            QgsMapLayerRegistry.instance().addMapLayer(self.memoryLayer, False)
-            provider = self.memoryLayer.dataProvider()
-
-        QgsProject.instance().blockSignals(True) #we don't want to refresh the snapping UI
-        QgsProject.instance().setSnapSettingsForLayer(self.memoryLayer.id(),  True, QgsSnapper.SnapToVertex , QgsTolerance.Pixels, 20.0, False )
-        QgsProject.instance().blockSignals(False) #we don't want to refresh the snapping UI
-
-        feature = QgsFeature()
-        feature.setGeometry( QgsGeometry.fromPoint( self.p3 ) )
-        provider.addFeatures([feature])
+            #AttributeError : if self.memoryLayer is None
+            provider = self._createTechnicalLayer()
 
+        provider.changeGeometryValues( { self.snapFeatureId: QgsGeometry.fromPoint( toQgsPoint(self.p3) ) } )
         self.memoryLayer.updateExtents()
+        self._setTechnicalSnapping(True)
 
-        self.iface.setActiveLayer(activeLayer)
     def removeSnappingPoint(self):
         """
-        This methods empties the snapping layer.
-        It must be called after createSnappingPoint (once the snapping has been done), since it also reenables the other layer's snapping
+        Disables the technical layer's snapping once the click has been dispatched, so that the native tools
+        don't snap to the last clicked point on the following mouse moves
         """
+        self._setTechnicalSnapping(False)
 
-        #empty the layer
-        provider = self.memoryLayer.dataProvider()
-        features = provider.getFeatures( QgsFeatureRequest() )
-
-        for feature in features:
-            provider.deleteFeatures([feature.id()])
+    def _createTechnicalLayer(self):
+        """
+        Creates the technical layer with its single feature
+        """
+        activeLayer = self.iface.activeLayer()
 
-        #In 2.2, this will be  (untested):
-        #provider = self.memoryLayer.dataProvider()
-        #provider.deleteFeatures( self.memoryLayer.allFeatureIds() )
+        self.cleanLayers(self.snapper.technicalLayerName)
+        self.memoryLayer = QgsVectorLayer("point", self.snapper.technicalLayerName, "memory")
+        provider = self.memoryLayer.dataProvider()
+        feature = QgsFeature()
+        feature.setGeometry( QgsGeometry.fromPoint( toQgsPoint(self.p3) ) )
+        (ok, features) = provider.addFeatures([feature])
+        self.snapFeatureId = features[0].id()
+        QgsMapLayerRegistry.instance().addMapLayer(self.memoryLayer, False)
 
+        self.iface.setActiveLayer(activeLayer)
+        return provider
 
-        #restore the snapping options
-        self.restoreBackgroundSnapping()
+    def _setTechnicalSnapping(self, enabled):
+        try:
+            layerId = self.memoryLayer.id()
+        except (RuntimeError, AttributeError):
+            return
+        self.snapper.setSnapSettings( [(layerId, (True, enabled, QgsSnapper.SnapToVertex, QgsTolerance.Pixels, 20.0, False))] )
 
-    def disableBackgroundSnapping(self, keepSnapping=None):
+    def updateSnappingSuspension(self):
         """
-        Stores (for latter restoring) and then remove all the snapping options.
+        The project's snapping is suspended (once) while CadInput is active and enabled, so that the native tools only snap to the technical layer,
+        and restored as soon as CadInput is disabled or inactive.
         """
-
-
-        if self.otherSnappingStored:
-            QgsMessageLog.logMessage("WARNING : restoreBackgroundSnapping was not called before disableBackgroundSnapping ! We don't store it again...")
-        else:
-            self.otherSnappingStored = True
-            QgsProject.instance().blockSignals(True) #we don't want to refresh the snapping UI
-            self.storeOtherSnapping = dict()
-            for name in QgsMapLayerRegistry.instance().mapLayers():
-                layer = QgsMapLayerRegistry.instance().mapLayers()[name]
-                self.storeOtherSnapping[layer.id()] = QgsProject.instance().snapSettingsForLayer(layer.id())
-
-                if keepSnapping=='vertex':
-                    QgsProject.instance().setSnapSettingsForLayer(layer.id(),True,QgsSnapper.SnapToVertex, QgsTolerance.Pixels, 20,False)
-                elif keepSnapping=='segment':
-                    QgsProject.instance().setSnapSettingsForLayer(layer.id(),True,QgsSnapper.SnapToSegment, QgsTolerance.Pixels, 20,False)
-                else:
-                    QgsProject.instance().setSnapSettingsForLayer(layer.id(),False,0,0,0,False)
-
-            QgsProject.instance().blockSignals(False) #we don't want to refresh the snapping UI
-    def restoreBackgroundSnapping(self):
+        suspend = self.inputwidget.active and self.inputwidget.enabled
+        if suspend and not self.snapper.isSuspended():
+            self.snapper.suspendProjectSnapping()
+        elif not suspend and self.snapper.isSuspended():
+            self.snapper.restoreProjectSnapping()
+            self._setTechnicalSnapping(False)
+
+    def unload(self):
         """
-        Restores previously stored snapping options
+        Restores the project's snapping, stops the snapper (cancelling and waiting for its index builds) and removes the technical layer
         """
-
-        self.otherSnappingStored = False
-
-        QgsProject.instance().blockSignals(True) #we don't want to refresh the snapping UI
-
-        for layerId in self.storeOtherSnapping:
-            options = self.storeOtherSnapping[layerId]
-            QgsProject.instance().setSnapSettingsForLayer(layerId,options[1],options[2],options[3],options[4],options[5])
-
-        QgsProject.instance().blockSignals(False) #we don't want to refresh the snapping UI
+        self.moveTimer.stop()
+        self.snapper.restoreProjectSnapping()
+        self.snapper.unload()
+        self.cleanLayers(self.snapper.technicalLayerName)
+        self.memoryLayer = None
 
     def cleanLayers(self, layernameToClean):
         """
@@ -502,3 +451,22 @@ class CadEventFilter(QObject):
             if layer.name() == layernameToClean:
                 QgsMapLayerRegistry.instance().removeMapLayer(layer.id())
 
+
+class CadMouseEvent(QMouseEvent):
+    """
+    The mouse events dispatched by the CadEventFilter : they carry the constrained position at model precision.
+
+    Python map tools can read it with mapPoint() (in map units) or exactPos() (in pixels, not rounded), for instance :
+        point = event.mapPoint() if isinstance(event, CadMouseEvent) else self.toMapCoordinates(event.pos())
+    """
+
+    def __init__(self, eventType, pos, button, buttons, modifiers, exactPos, mapPoint):
+        QMouseEvent.__init__(self, eventType, pos, button, buttons, modifiers)
+        self._exactPos = exactPos
+        self._mapPoint = mapPoint
+
+    def exactPos(self):
+        return QPointF(self._exactPos)
+
+    def mapPoint(self):
+        return QgsPoint(self._mapPoint[0], self._mapPoint[1])
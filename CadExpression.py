@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# This module has no Qt nor QGIS dependency
+
+import re
+import math
+import ast
+import operator as op
+from collections import OrderedDict
+
+
+class Evaluator():
+    """
+    Evaluates the expressions entered in the fields, originally from http://stackoverflow.com/a/9558001/2615469
+
+    Each distinct expression is compiled once to a closure (kept in an LRU cache), so that evaluating
+    it again only costs the closure's calls. Supported are :
+    - numbers, parentheses, +, -, *, /, % and ** (or ^), unary - and +
+    - the constant pi and the functions sin, cos, tan (of degrees), asin, acos, atan (to degrees), sqrt and abs
+    - the unit suffixes m, ft (lengths, in map units) and °, gon, rad (angles, in degrees), as in 12ft or 100gon
+    - the current values x, y, a and d (given as the context)
+
+    Note that ^ is a power, as in most calculators (it used to be Python's xor, which only worked on integers).
+
+    Lengths are converted with the given metersPerUnit (the length of one map unit in meters) : without it,
+    as with geographic map units, length suffixes are rejected. Angle suffixes are rejected unless angles is True
+    (so that a length field doesn't take an angle). Non finite results (such as 1e400), and expressions too long
+    or too deeply nested to be compiled, are rejected as well.
+    """
+
+    # supported operators
+    operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul, ast.Div: op.truediv, ast.Mod: op.mod, ast.Pow: op.pow, ast.BitXor: op.pow}
+    unaryOperators = {ast.USub: op.neg, ast.UAdd: op.pos}
+
+    # supported names
+    functions = {   'sin': lambda v: math.sin(math.radians(v)),
+                    'cos': lambda v: math.cos(math.radians(v)),
+                    'tan': lambda v: math.tan(math.radians(v)),
+                    'asin': lambda v: math.degrees(math.asin(v)),
+                    'acos': lambda v: math.degrees(math.acos(v)),
+                    'atan': lambda v: math.degrees(math.atan(v)),
+                    'sqrt': math.sqrt,
+                    'abs': abs  }
+    constants = {'pi': math.pi}
+    variables = ('x', 'y', 'a', 'd')
+
+    # supported units (factor to meters or to degrees)
+    units = {u'm': 1.0, u'ft': 0.3048, u'°': 1.0, u'gon': 0.9, u'rad': 180.0/math.pi}
+    lengthUnits = (u'm', u'ft')
+    metersPerUnitName = '_metersPerUnit' # the name under which the lengths get metersPerUnit (it can't be typed)
+    unitPattern = re.compile(u'((?:\\d+\\.?\\d*|\\.\\d+)(?:[eE][-+]?\\d+)?)\\s*(ft|gon|rad|m|°)(?![A-Za-z_])', re.UNICODE)
+
+    # compiled expressions, the least recently used being dropped first
+    cacheSize = 256
+    cache = OrderedDict()
+
+    @staticmethod
+    def eval_expr(expr, context=None, metersPerUnit=None, angles=True):
+        """
+        Returns the value of expr (with x, y, a and d taken from the context dict), or None if it is not a valid expression
+        """
+        (function, lengths, hasAngles) = Evaluator.compile(expr)
+        if function is None or lengths and metersPerUnit is None or hasAngles and not angles:
+            return None
+        namespace = dict(context or {})
+        namespace[Evaluator.metersPerUnitName] = metersPerUnit
+        try:
+            value = float( function(namespace) )
+        except (KeyError, ValueError, TypeError, ZeroDivisionError, OverflowError, RuntimeError, MemoryError):
+            #RuntimeError : a RecursionError when evaluating very deep expressions
+            return None
+        if math.isinf(value) or math.isnan(value):
+            return None
+        return value
+
+    @staticmethod
+    def compile(expr):
+        """
+        Returns (closure computing expr from a namespace dict, whether it has length suffixes, whether it has angle suffixes),
+        the closure being None if the expression is not supported, using the cache
+        """
+        if expr in Evaluator.cache:
+            compiled = Evaluator.cache.pop(expr)
+        else:
+            kinds = set()
+            try:
+                if Evaluator.metersPerUnitName in expr:
+                    raise ValueError(expr)
+                source = Evaluator.unitPattern.sub(lambda match: Evaluator.convertUnit(match, kinds), expr).strip()
+                function = Evaluator.compile_( ast.parse(source, mode='eval').body )
+            except (SyntaxError, ValueError, TypeError, UnicodeError, RuntimeError, MemoryError):
+                #RuntimeError and MemoryError : a RecursionError or a MemoryError of the parser on very long or deep expressions
+                function = None
+            compiled = (function, 'length' in kinds, 'angle' in kinds)
+            if len(Evaluator.cache) >= Evaluator.cacheSize:
+                Evaluator.cache.popitem(last=False)
+        Evaluator.cache[expr] = compiled
+        return compiled
+
+    @staticmethod
+    def convertUnit(match, kinds):
+        """
+        Returns the source converting the value of a unit pattern match to map units (lengths) or degrees (angles),
+        and adds the kind of the unit ('length' or 'angle') to kinds
+        """
+        (value, unit) = match.groups()
+        if unit in Evaluator.lengthUnits:
+            kinds.add('length')
+            return u"(%s*%r/%s)" % (value, Evaluator.units[unit], Evaluator.metersPerUnitName)
+        kinds.add('angle')
+        return u"(%s*%r)" % (value, Evaluator.units[unit])
+
+    @staticmethod
+    def compile_(node):
+        """
+        Compiles an ast node to a closure taking the context dict (raises ValueError if the node is not supported)
+        """
+        if isinstance(node, getattr(ast, 'Constant', ())) or isinstance(node, getattr(ast, 'Num', ())): # <number>
+            value = node.value if hasattr(node, 'value') else node.n
+            if isinstance(value, bool) or not isinstance(value, (int, float)) and type(value).__name__ != 'long':
+                raise ValueError(value)
+            value = float(value)
+            return lambda context: value
+        elif isinstance(node, ast.BinOp) and type(node.op) in Evaluator.operators: # <left> <operator> <right>
+            operator = Evaluator.operators[type(node.op)]
+            left = Evaluator.compile_(node.left)
+            right = Evaluator.compile_(node.right)
+            return lambda context: operator(left(context), right(context))
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in Evaluator.unaryOperators: # <operator> <operand>
+            operator = Evaluator.unaryOperators[type(node.op)]
+            operand = Evaluator.compile_(node.operand)
+            return lambda context: operator(operand(context))
+        elif isinstance(node, ast.Name) and node.id in Evaluator.constants: # <constant>
+            value = Evaluator.constants[node.id]
+            return lambda context: value
+        elif isinstance(node, ast.Name) and (node.id in Evaluator.variables or node.id == Evaluator.metersPerUnitName): # <variable>
+            name = node.id
+            return lambda context: context[name]
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in Evaluator.functions and not node.keywords: # <function>(<arguments>)
+            function = Evaluator.functions[node.func.id]
+            arguments = [Evaluator.compile_(argument) for argument in node.args]
+            return lambda context: function(*[argument(context) for argument in arguments])
+        else:
+            raise ValueError(node)
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Import the PyQt and QGIS libraries
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from qgis.core import *
+from qgis.gui import *
+
+import struct
+
+try:
+    import numpy
+except ImportError:
+    #without numpy, the buffer is never ready and the current layer is snapped like the others
+    numpy = None
+
+
+class CadGeometryBuffer(QObject):
+    """
+    Columnar cache of the current layer's geometries around the visible extent (in layer coordinates).
+
+    The geometries are parsed straight from their WKB into one float64 coordinate array, plus
+    offset arrays telling where each ring (or linestring, or point) starts. Nearest vertex
+    and nearest segment queries then run as single vectorized NumPy operations over the whole window.
+
+    The window is twice the visible extent, so that small pans and zooms in do not need a rebuild. Edits are
+    patched into the buffer from the layer's edit signals. The buffer holds at most maxVertices vertices :
+    above, it is dropped (and not ready) until the user zooms in, and CadSnapper uses the CadSnapIndex instead.
+    """
+
+    def __init__(self, iface):
+        QObject.__init__(self)
+        self.iface = iface
+        self.layer = None
+        self.dirty = True
+        self.rebuildScheduled = False
+
+        #the buffer is dropped above maxVertices, and CadSnapper prefers a ready grid above gridVertices
+        self.maxVertices = QSettings().value("/CadInput/bufferMaxVertices", 50000, type=int)
+        self.gridVertices = QSettings().value("/CadInput/bufferGridVertices", 10000, type=int)
+
+        self.extent = None # the buffered window in layer coordinates
+        self.overflowWidth = None # the width of the visible extent for which maxVertices was exceeded, else None
+
+        self.coords = None # (n,2) float64 array of all the vertices
+        self.ringOffsets = None # (rings+1) index of the first vertex of each ring, and n
+        self.partOffsets = None # (parts+1) index of the first ring of each part, and the ring count
+        self.fids = None # (rings) feature id of each ring
+        self.segments = None # (x1, y1, dx, dy, squared length) arrays of all the non degenerated segments
+
+        if numpy is not None:
+            self.iface.currentLayerChanged.connect( self.setLayer )
+            self.iface.mapCanvas().extentsChanged.connect( self._extentsChanged )
+            self.setLayer( self.iface.mapCanvas().currentLayer() )
+
+    def unload(self):
+        if numpy is not None:
+            self.iface.currentLayerChanged.disconnect( self.setLayer )
+            self.iface.mapCanvas().extentsChanged.disconnect( self._extentsChanged )
+            self.setLayer( None )
+
+    def setLayer(self, layer):
+        if self.layer is not None:
+            try:
+                self.layer.featureAdded.disconnect( self._featureAdded )
+                self.layer.featureDeleted.disconnect( self._featureDeleted )
+                self.layer.geometryChanged.disconnect( self._geometryChanged )
+                self.layer.committedFeaturesAdded.disconnect( self.invalidate )
+                self.layer.editingStopped.disconnect( self.invalidate )
+            except (TypeError, RuntimeError):
+                #the layer may already have been deleted
+                pass
+
+        if isinstance(layer, QgsVectorLayer) and layer.hasGeometryType():
+            self.layer = layer
+            self.layer.featureAdded.connect( self._featureAdded )
+            self.layer.featureDeleted.connect( self._featureDeleted )
+            self.layer.geometryChanged.connect( self._geometryChanged )
+            #the temporary ids of the added features are replaced on commit
+            self.layer.committedFeaturesAdded.connect( self.invalidate )
+            self.layer.editingStopped.connect( self.invalidate )
+        else:
+            self.layer = None
+        self.overflowWidth = None
+        self.invalidate()
+
+    def invalidate(self, *args):
+        self.dirty = True
+        if not self.rebuildScheduled:
+            self.rebuildScheduled = True
+            QTimer.singleShot(0, self.rebuild)
+
+    def isReady(self, layer):
+        return not self.dirty and self.layer is not None and layer is not None and layer.id() == self.layer.id()
+
+    def isSmall(self):
+        """
+        Returns whether the buffer is small enough to be preferred to a ready SnapGrid
+        """
+        return len(self.coords) <= self.gridVertices
+
+    def _visibleExtent(self):
+        renderer = self.iface.mapCanvas().mapRenderer()
+        return renderer.mapToLayerCoordinates( self.layer, self.iface.mapCanvas().extent() )
+
+    def _extentsChanged(self):
+        """
+        Rebuilds the buffer only if the visible extent leaves the buffered window, or if the user zoomed in enough
+        for a buffer which was too large to be retried
+        """
+        if self.layer is None or self.rebuildScheduled:
+            return
+        try:
+            extent = self._visibleExtent()
+        except RuntimeError:
+            #the layer was deleted
+            self.layer = None
+            return
+        if self.overflowWidth is not None:
+            if extent.width() < self.overflowWidth/2:
+                self.invalidate()
+        elif self.extent is None or not self.extent.contains(extent):
+            self.invalidate()
+
+    def rebuild(self):
+        """
+        Parses the WKB of the current layer's features intersecting the buffered window
+        """
+        self.rebuildScheduled = False
+        if self.layer is None:
+            return
+
+        try:
+            visible = self._visibleExtent()
+        except RuntimeError:
+            #the layer was deleted
+            self.layer = None
+            return
+        extent = QgsRectangle(visible)
+        extent.scale(2.0)
+
+        chunks = []
+        ringLengths = []
+        partRings = []
+        fids = []
+        count = 0
+        request = QgsFeatureRequest().setFilterRect(extent).setSubsetOfAttributes([])
+        for feature in self.layer.getFeatures(request):
+            geometry = feature.geometry()
+            if geometry is None:
+                continue
+            rings = len(ringLengths)
+            if not self._parseFeature(feature.id(), geometry, chunks, ringLengths, partRings):
+                continue
+            fids.extend( [feature.id()]*(len(ringLengths)-rings) )
+            count += sum(ringLengths[rings:])
+            if count > self.maxVertices:
+                self._drop(visible.width())
+                return
+
+        self.extent = extent
+        self.overflowWidth = None
+        self._setRings(chunks, ringLengths, partRings, fids)
+        self.dirty = False
+
+    def _parseFeature(self, fid, geometry, chunks, ringLengths, partRings):
+        """
+        Appends the parsed geometry of a feature to the lists (see parseWkb). Returns False, leaving the lists
+        unchanged, if its WKB is not supported (it is then skipped and logged : it can't be snapped from the buffer)
+        """
+        (featureChunks, featureRings, featureParts) = ([], [], [])
+        try:
+            parseWkb(wkbOf(geometry), 0, featureChunks, featureRings, featureParts)
+        except (ValueError, struct.error) as e:
+            QgsMessageLog.logMessage("WARNING : feature %d of layer %s is not buffered for snapping (%s)" % (fid, self.layer.id(), e), "CadInput")
+            return False
+        chunks.extend( featureChunks )
+        ringLengths.extend( featureRings )
+        partRings.extend( featureParts )
+        return True
+
+    def _drop(self, overflowWidth):
+        """
+        Frees the buffer which exceeded maxVertices : it stays not ready until the visible extent is narrow enough
+        """
+        self.coords = self.ringOffsets = self.partOffsets = self.fids = self.segments = None
+        self.extent = None
+        self.overflowWidth = overflowWidth
+        self.dirty = True
+
+    def _setRings(self, chunks, ringLengths, partRings, fids):
+        """
+        Builds the coordinate, offset and segment arrays from the rings' coordinate arrays, vertex counts and feature ids,
+        and the parts' ring counts
+        """
+        if len(chunks):
+            self.coords = numpy.concatenate(chunks)
+        else:
+            self.coords = numpy.zeros((0,2))
+        self.ringOffsets = numpy.concatenate( ([0], numpy.cumsum(ringLengths, dtype=numpy.int64)) ).astype(numpy.int64)
+        self.partOffsets = numpy.concatenate( ([0], numpy.cumsum(partRings, dtype=numpy.int64)) ).astype(numpy.int64)
+        self.fids = numpy.array(fids, dtype=numpy.int64)
+
+        #a segment joins each vertex to the next one, unless the next one starts another ring
+        valid = numpy.ones(max(len(self.coords)-1, 0), dtype=bool)
+        valid[self.ringOffsets[1:-1]-1] = False
+        starts = numpy.nonzero(valid)[0]
+        x1 = self.coords[starts,0]
+        y1 = self.coords[starts,1]
+        dx = self.coords[starts+1,0]-x1
+        dy = self.coords[starts+1,1]-y1
+        length = dx*dx+dy*dy
+        keep = length > 0
+        self.segments = (x1[keep], y1[keep], dx[keep], dy[keep], length[keep])
+
+
+    ###############################
+    ##### INCREMENTAL UPDATES #####
+    ###############################
+
+    def _featureAdded(self, fid):
+        feature = QgsFeature()
+        request = QgsFeatureRequest(fid).setSubsetOfAttributes([])
+        if self.layer.getFeatures(request).nextFeature(feature):
+            self._replaceFeature(fid, feature.geometry())
+
+    def _featureDeleted(self, fid):
+        self._replaceFeature(fid, None)
+
+    def _geometryChanged(self, fid, geometry):
+        self._replaceFeature(fid, geometry)
+
+    def _replaceFeature(self, fid, geometry):
+        """
+        Patches the buffer : removes the rings of the feature, then appends those of its new geometry (if it intersects the window)
+        """
+        if self.dirty:
+            #a rebuild is pending (or the buffer was dropped) : it will read the edited features
+            return
+
+        ringLengths = numpy.diff(self.ringOffsets)
+        partRings = numpy.diff(self.partOffsets)
+        kept = self.fids != fid
+        if not kept.all():
+            vertexKept = numpy.repeat(kept, ringLengths)
+            #every part has a ring, the fid of a part is the one of its first ring
+            partKept = kept[self.partOffsets[:-1]]
+            chunks = [ self.coords[vertexKept] ]
+            ringLengths = list(ringLengths[kept])
+            partRings = list(partRings[partKept])
+            fids = list(self.fids[kept])
+        else:
+            chunks = [ self.coords ]
+            ringLengths = list(ringLengths)
+            partRings = list(partRings)
+            fids = list(self.fids)
+
+        if geometry is not None and geometry.intersects( self.extent ):
+            rings = len(ringLengths)
+            if self._parseFeature(fid, geometry, chunks, ringLengths, partRings):
+                fids.extend( [fid]*(len(ringLengths)-rings) )
+                if sum(ringLengths) > self.maxVertices:
+                    self._drop(self.extent.width()/2)
+                    return
+
+        self._setRings(chunks, ringLengths, partRings, fids)
+
+
+    ###################
+    ##### QUERIES #####
+    ###################
+
+    def nearestVertex(self, x, y, tolerance):
+        """
+        Returns the nearest vertex (x,y) within tolerance, or None
+        """
+        if len(self.coords) == 0:
+            return None
+        distances = (self.coords[:,0]-x)**2 + (self.coords[:,1]-y)**2
+        i = distances.argmin()
+        if distances[i] > tolerance*tolerance:
+            return None
+        return (float(self.coords[i,0]), float(self.coords[i,1]))
+
+    def perpendicularFeet(self, x, y):
+        """
+        Returns the feet of the perpendiculars from (x,y) to all the segments (clamped to the segments) and their squared distances to (x,y)
+        """
+        (x1, y1, dx, dy, length) = self.segments
+        t = numpy.clip( ((x-x1)*dx+(y-y1)*dy)/length, 0.0, 1.0 )
+        fx = x1+t*dx
+        fy = y1+t*dy
+        return (fx, fy, (fx-x)**2+(fy-y)**2)
+
+    def nearestSegment(self, x, y, tolerance):
+        """
+        Returns the nearest segment within tolerance as ((x,y) on segment, (x,y) of start, (x,y) of end), or None
+        """
+        if len(self.segments[0]) == 0:
+            return None
+        (fx, fy, distances) = self.perpendicularFeet(x, y)
+        i = distances.argmin()
+        if distances[i] > tolerance*tolerance:
+            return None
+        (x1, y1, dx, dy, length) = self.segments
+        return (    (float(fx[i]), float(fy[i])),
+                    (float(x1[i]), float(y1[i])),
+                    (float(x1[i]+dx[i]), float(y1[i]+dy[i]))  )
+
+
+###############
+##### WKB #####
+###############
+
+def wkbOf(geometry):
+    """
+    Returns the WKB of a QgsGeometry as a string of bytes (depending on the bindings, asWkb may return a sip.voidptr)
+    """
+    wkb = geometry.asWkb()
+    if hasattr(wkb, "asstring"):
+        wkb = wkb.asstring( geometry.wkbSize() )
+    return wkb
+
+def parseWkb(wkb, offset, chunks, ringLengths, partRings):
+    """
+    Parses the geometry starting at offset in the WKB : appends its (n,2) coordinate arrays to chunks,
+    the vertex count of each of its rings to ringLengths and the ring count of each of its parts to partRings
+    (empty polygons have no part, so that every part has a ring).
+    Points, linestrings and polygons (possibly multi, possibly 2.5D) are supported, ValueError (or struct.error
+    for a truncated WKB) is raised for the others.
+
+    Returns the offset following the geometry.
+    """
+    order = "<" if wkb[offset:offset+1] == b"\x01" else ">"
+    (wkbType,) = struct.unpack_from(order+"I", wkb, offset+1)
+    offset += 5
+
+    dims = 3 if wkbType & 0x80000000 else 2
+    wkbType &= 0xff
+    dtype = numpy.dtype(order+"f8")
+
+    def readPoints(offset, count):
+        points = numpy.frombuffer(wkb, dtype=dtype, count=count*dims, offset=offset).reshape(count, dims)
+        chunks.append( points[:,:2].astype(numpy.float64) )
+        ringLengths.append( count )
+        return offset+8*dims*count
+
+    if wkbType == 1: # point
+        offset = readPoints(offset, 1)
+        partRings.append(1)
+    elif wkbType == 2: # linestring
+        (count,) = struct.unpack_from(order+"I", wkb, offset)
+        offset = readPoints(offset+4, count)
+        partRings.append(1)
+    elif wkbType == 3: # polygon
+        (rings,) = struct.unpack_from(order+"I", wkb, offset)
+        offset += 4
+        for r in range(rings):
+            (count,) = struct.unpack_from(order+"I", wkb, offset)
+            offset = readPoints(offset+4, count)
+        if rings:
+            partRings.append(rings)
+    elif wkbType in (4, 5, 6): # multipoint, multilinestring, multipolygon
+        (parts,) = struct.unpack_from(order+"I", wkb, offset)
+        offset += 4
+        for p in range(parts):
+            offset = parseWkb(wkb, offset, chunks, ringLengths, partRings)
+    else:
+        raise ValueError("unsupported WKB type %d" % wkbType)
+
+    return offset
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Headless replay harness : runs CadEventFilter, CadInputWidget and CadPaintWidget without a QGIS window,
+# with a stub iface, a stub map canvas (with a configurable QgsMapToPixel) and the real CadSnapper over a memory layer of synthetic lines.
+# It only needs the qgis.core and qgis.gui bindings, for instance to benchmark or replay a recording :
+#     QT_QPA_PLATFORM=offscreen python CadHarness.py recording.txt
+# where each line of the recording is an event : "move x y", "press x y", "release x y" or "click x y" (in pixels).
+# The recording is replayed with each kind of map tool (see StubMapTool), through CadEventFilter.eventFilter.
+
+import os
+import sys
+import math
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+# Import the PyQt and QGIS libraries
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from qgis.core import *
+from qgis.gui import *
+
+from CadInputWidget import CadInputWidget
+from CadEventFilter import CadEventFilter
+from CadPaintWidget import CadPaintWidget
+from CadSnapper import CadSnapper
+
+
+class SpontaneousMouseEvent(QMouseEvent):
+    """
+    A mouse event passing for one generated by the OS : CadEventFilter.eventFilter only processes spontaneous events
+    (the events it dispatches itself are not)
+    """
+
+    def spontaneous(self):
+        return True
+
+
+class StubViewport(QWidget):
+    """
+    The canvas' viewport : it records the mouse events dispatched by the CadEventFilter, and forwards them to the map tool
+    """
+
+    def __init__(self, parent):
+        QWidget.__init__(self, parent)
+        self.received = []
+
+    def event(self, event):
+        if event.type() in (QEvent.MouseMove, QEvent.MouseButtonPress, QEvent.MouseButtonRelease):
+            self.received.append( (event.type(), event.pos(), getattr(event, 'mapPoint', lambda: None)()) )
+            tool = self.parent().mapTool()
+            if tool is not None:
+                handlers = {QEvent.MouseMove: 'canvasMoveEvent', QEvent.MouseButtonPress: 'canvasPressEvent', QEvent.MouseButtonRelease: 'canvasReleaseEvent'}
+                getattr(tool, handlers[event.type()])(event)
+            return True
+        return QWidget.event(self, event)
+
+
+class StubMapCanvas(QWidget):
+    """
+    A map canvas showing the extent starting at (xmin, ymin), at mapUnitsPerPixel, without any layer
+    """
+
+    mapToolSet = pyqtSignal(object)
+    extentsChanged = pyqtSignal()
+    scaleChanged = pyqtSignal(float)
+
+    def __init__(self, width=800, height=600, xmin=0.0, ymin=0.0, mapUnitsPerPixel=1.0):
+        QWidget.__init__(self)
+        self.resize(width, height)
+        self.viewportWidget = StubViewport(self)
+        self.viewportWidget.resize(width, height)
+        self.renderer = QgsMapRenderer()
+        self.tool = None
+        self.layer = None
+        self.setTransform(xmin, ymin, mapUnitsPerPixel)
+
+    def setTransform(self, xmin, ymin, mapUnitsPerPixel):
+        """
+        Sets the map to pixel transform (as a pan or a zoom would)
+        """
+        (self.xmin, self.ymin, self.mapUnitsPerPixel) = (xmin, ymin, mapUnitsPerPixel)
+        self.mapToPixel = QgsMapToPixel(mapUnitsPerPixel, self.height(), ymin, xmin)
+        #the snapper's tolerances in pixels are converted by the renderer
+        self.renderer.setOutputSize( self.size(), 96 )
+        self.renderer.setExtent( self.extent() )
+        self.extentsChanged.emit()
+        self.scaleChanged.emit(mapUnitsPerPixel)
+
+    def getCoordinateTransform(self):
+        return self.mapToPixel
+
+    def extent(self):
+        return QgsRectangle( self.xmin, self.ymin, self.xmin+self.width()*self.mapUnitsPerPixel, self.ymin+self.height()*self.mapUnitsPerPixel )
+
+    def mapRenderer(self):
+        return self.renderer
+
+    def viewport(self):
+        return self.viewportWidget
+
+    def currentLayer(self):
+        return self.layer
+
+    def mapTool(self):
+        return self.tool
+
+    def setMapTool(self, tool):
+        self.tool = tool
+        self.mapToolSet.emit(tool)
+
+    def refresh(self):
+        pass
+
+
+class StubMessageBar(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def pushMessage(self, title, text, level=0, duration=0):
+        self.messages.append( (title, text) )
+
+
+class StubIface(QObject):
+    """
+    The parts of QgisInterface used by CadInput
+    """
+
+    currentLayerChanged = pyqtSignal(object)
+
+    def __init__(self, canvas):
+        QObject.__init__(self)
+        self.canvas = canvas
+        self.window = QMainWindow()
+        self.bar = StubMessageBar()
+        self.addFeatureAction = QAction("add feature", self.window)
+
+    def mapCanvas(self):
+        return self.canvas
+
+    def mainWindow(self):
+        return self.window
+
+    def messageBar(self):
+        return self.bar
+
+    def activeLayer(self):
+        return self.canvas.currentLayer()
+
+    def setActiveLayer(self, layer):
+        self.canvas.layer = layer
+        self.currentLayerChanged.emit(layer)
+
+    def actionAddFeature(self):
+        return self.addFeatureAction
+
+    def openFeatureForm(self, layer, feature, updateFeatureOnly=False):
+        return True
+
+
+class StubMapTool(object):
+    """
+    An edit tool which reads its points from the mouse events, like the native tools : CadInput snaps it to the technical layer.
+    The points it receives are recorded in vertices (in map units).
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.vertices = []
+
+    def isEditTool(self):
+        return True
+
+    def action(self):
+        return None
+
+    def canvasMoveEvent(self, event):
+        pass
+
+    def canvasPressEvent(self, event):
+        pass
+
+    def canvasReleaseEvent(self, event):
+        self.vertices.append( self.eventPoint(event) )
+
+    def eventPoint(self, event):
+        p = self.canvas.getCoordinateTransform().toMapCoordinates( event.pos() )
+        return (p.x(), p.y())
+
+
+class MapPointsMapTool(StubMapTool):
+    """
+    An edit tool declaring acceptsMapPoints : it reads the exact point from the CadMouseEvents, without the technical layer
+    """
+
+    acceptsMapPoints = True
+
+    def eventPoint(self, event):
+        p = event.mapPoint()
+        return (p.x(), p.y())
+
+
+class RecordingMapTool(MapPointsMapTool):
+    """
+    An edit tool having an addVertex method : CadInput commits the points to it directly, without dispatching the clicks
+    """
+
+    def addVertex(self, point):
+        self.vertices.append( (point.x(), point.y()) )
+
+
+def lineLayer(lines, name="harness lines"):
+    """
+    Returns a memory layer holding one linestring feature per line (list of (x, y) pairs in map units)
+    """
+    layer = QgsVectorLayer("LineString", name, "memory")
+    features = []
+    for line in lines:
+        feature = QgsFeature()
+        feature.setGeometry( QgsGeometry.fromPolyline([QgsPoint(x, y) for (x, y) in line]) )
+        features.append( feature )
+    layer.dataProvider().addFeatures( features )
+    layer.updateExtents()
+    return layer
+
+
+class CadHarness(object):
+    """
+    Builds CadInput's widgets over the stubs, and replays spontaneous mouse events through the whole
+    eventFilter -> _toMapSnap -> _constrain -> paint pipeline.
+
+    The lines are added to the layer registry as a memory layer (the current layer), so that they are snapped by
+    the real CadSnapper, through its CadSnapIndex grid and its CadGeometryBuffer. close() unloads everything.
+
+    The mouse moves are coalesced by the event filter : the timers which the event loop would fire (the move timer and
+    the fields' synchronization) are run by frame(), which replay calls every movesPerFrame moves.
+    The map tool is built by toolClass (see StubMapTool and its subclasses).
+    """
+
+    def __init__(self, lines=(), width=800, height=600, xmin=0.0, ymin=0.0, mapUnitsPerPixel=1.0, toolClass=RecordingMapTool):
+        if QApplication.instance() is None:
+            self.application = QgsApplication([], True)
+            #the providers are needed for the technical (memory) layer
+            QgsApplication.initQgis()
+        else:
+            self.application = QApplication.instance()
+
+        self.canvas = StubMapCanvas(width, height, xmin, ymin, mapUnitsPerPixel)
+        self.iface = StubIface(self.canvas)
+        self.tool = toolClass(self.canvas)
+
+        self.layer = lineLayer(lines)
+        QgsMapLayerRegistry.instance().addMapLayer( self.layer )
+        self.iface.setActiveLayer( self.layer )
+
+        self.snapper = CadSnapper(self.iface)
+        self.inputwidget = CadInputWidget(self.iface)
+        self.eventFilter = CadEventFilter(self.iface, self.inputwidget, self.snapper)
+        self.paintwidget = CadPaintWidget(self.iface, self.inputwidget, self.eventFilter)
+        self.paintwidget.resize(self.canvas.size())
+        self.image = QImage(self.canvas.size(), QImage.Format_ARGB32)
+
+        self.canvas.setMapTool(self.tool)
+        self.inputwidget.enabled = True
+
+        #the memory layer's grid is built right away, the buffer's rebuild is deferred to the event loop
+        self.snapper.prepare()
+        QCoreApplication.processEvents()
+
+    def close(self):
+        """
+        Unloads the event filter (and the snapper with it), and removes the layer
+        """
+        self.eventFilter.unload()
+        QgsMapLayerRegistry.instance().removeMapLayer( self.layer.id() )
+
+    def mouseEvent(self, eventType, x, y, button=Qt.LeftButton):
+        """
+        Sends a spontaneous mouse event at pixel (x, y) to the event filter, as the viewport would.
+        Returns True if the event filter consumed it.
+        """
+        if eventType == QEvent.MouseMove:
+            (button, buttons) = (Qt.NoButton, Qt.NoButton)
+        elif eventType == QEvent.MouseButtonPress:
+            buttons = button
+        else:
+            buttons = Qt.NoButton
+        event = SpontaneousMouseEvent(eventType, QPoint(x, y), button, buttons, Qt.NoModifier)
+        return self.eventFilter.eventFilter(self.canvas.viewport(), event)
+
+    def frame(self):
+        """
+        Runs what the event loop's timers would : the coalesced move is processed, and the fields are synchronized
+        """
+        self.eventFilter.flushMove()
+        self.inputwidget.syncFromModel()
+
+    def paint(self):
+        """
+        Paints the overlay into an offscreen image, and returns it
+        """
+        self.image.fill(0)
+        self.paintwidget.render(self.image)
+        return self.image
+
+    def replay(self, events, paint=True, movesPerFrame=1):
+        """
+        Replays (kind, x, y) events, kind being "move", "press", "release" or "click". A frame (see frame) is run every
+        movesPerFrame moves and after each button event, and is painted if paint.
+        Returns the time spent in the event filter and in painting, in seconds.
+        """
+        types = {"move": [QEvent.MouseMove], "press": [QEvent.MouseButtonPress], "release": [QEvent.MouseButtonRelease],
+                 "click": [QEvent.MouseButtonPress, QEvent.MouseButtonRelease]}
+        (filtering, painting) = (0.0, 0.0)
+        moves = 0
+        for (kind, x, y) in events:
+            for eventType in types[kind]:
+                start = time.time()
+                self.mouseEvent(eventType, x, y)
+                if eventType == QEvent.MouseMove:
+                    moves += 1
+                if eventType != QEvent.MouseMove or moves % movesPerFrame == 0:
+                    self.frame()
+                    filtering += time.time()-start
+                    if paint:
+                        start = time.time()
+                        self.paint()
+                        painting += time.time()-start
+                else:
+                    filtering += time.time()-start
+        self.frame()
+        return (filtering, painting)
+
+
+def readRecording(lines):
+    """
+    Yields the (kind, x, y) events of a recording
+    """
+    for line in lines:
+        values = line.split()
+        if values and not values[0].startswith("#"):
+            yield (values[0], int(values[1]), int(values[2]))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as recording:
+            events = list(readRecording(recording))
+    else:
+        # a default recording : a circle of moves around a square, with a click every 50 moves
+        events = []
+        for i in range(1000):
+            events.append( ("move", int(400+200*math.cos(i/50.0)), int(300+200*math.sin(i/50.0))) )
+            if i % 50 == 49:
+                events.append( ("click",)+events[-1][1:] )
+    for toolClass in (RecordingMapTool, MapPointsMapTool, StubMapTool):
+        harness = CadHarness( lines=[[(200.0, 100.0), (600.0, 100.0), (600.0, 500.0), (200.0, 500.0), (200.0, 100.0)]], toolClass=toolClass )
+        (filtering, painting) = harness.replay(events, movesPerFrame=2)
+        print("%s, %d events : %.1f us per event in the event filter, %.1f us per event painting, %d vertices received" % (
+            toolClass.__name__, len(events), 1e6*filtering/len(events), 1e6*painting/len(events), len(harness.tool.vertices)))
+        harness.close()
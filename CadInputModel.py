@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# This module has no Qt nor QGIS dependency
+
+
+class CadInputModel(object):
+    """
+    This class holds CadInput's constraint state as plain doubles and booleans.
+
+    The CadEventFilter reads and writes it directly, while the CadInputWidget's fields are views
+    that are synchronized from it (see CadInputWidget.syncFromModel). This way, no string needs to be
+    parsed or formatted on the mouse move path.
+    """
+
+    __slots__ = (   'x', 'y', 'a', 'd',         # values
+                    'lx', 'ly', 'la', 'ld',     # locks
+                    'rx', 'ry', 'ra',           # relative modes (the distance is always relative)
+                    'c', 'par', 'per',          # construction, parralel and perpendicular modes
+                    'enabled', 'active'  )
+
+    def __init__(self):
+        self.x = 0.0
+        self.y = 0.0
+        self.a = 0.0
+        self.d = 0.0
+
+        self.lx = False
+        self.ly = False
+        self.la = False
+        self.ld = False
+
+        self.rx = True
+        self.ry = True
+        self.ra = True
+
+        self.c = False
+        self.par = False
+        self.per = False
+
+        self.enabled = False
+        self.active = True
@@ -27,14 +27,23 @@ from qgis.gui import *
 
 import resources
 import math
-import ast
-import operator as op
+
+from CadInputModel import CadInputModel
+from CadExpression import Evaluator
+from CadTraverse import parseLegs
 
 class CadInputWidget(QDockWidget):
     """
     This is CadInput's main GUI widget. It displays the edit fields for entering numerical coordinates.
     """
 
+    valueChanged = pyqtSignal() # emitted when any value, lock or mode changes (so the CadPaintWidget repaints)
+    traverseRequested = pyqtSignal(object, bool) # emitted with the legs (list of pairs) and True for polar legs, when a traverse is applied
+    traverseImportRequested = pyqtSignal(str, bool) # emitted with the path of a file and True for polar legs, when a traverse is imported
+
+    # length of the map units in meters, for the length suffixes of the expressions (those are rejected with the other map units)
+    metersPerUnit = {QGis.Meters: 1.0, QGis.Feet: 0.3048}
+
    
     def __init__(self, iface):
         QWidget.__init__(self)
@@ -47,6 +56,19 @@ class CadInputWidget(QDockWidget):
         # We connect 
         self.iface.mapCanvas().mapToolSet.connect( self.maptoolChanged )
 
+        # The constraint state, of which the fields are views
+        self.model = CadInputModel()
+
+        # The fields are synchronized from the model at most once every syncInterval milliseconds, with the given precision (decimals)
+        self.precision = QSettings().value("/CadInput/precision", 6, type=int)
+        self.syncTimer = QTimer(self)
+        self.syncTimer.setSingleShot(True)
+        self.syncTimer.setInterval( QSettings().value("/CadInput/syncInterval", 16, type=int) )
+        self.syncTimer.timeout.connect( self.syncFromModel )
+
+        # Progress bars of the snap index builds (layer id -> QProgressBar)
+        self.indexBars = dict()
+
 
 
         # Create the widgets
@@ -78,6 +100,23 @@ class CadInputWidget(QDockWidget):
         self.widPer.setCheckable(True)
         self.widPer.setToolTip("P")
 
+        self.widTraverse = QToolButton()
+        self.widTraverse.setText("traverse")
+        self.widTraverse.setCheckable(True)
+
+        ## Traverse
+        self.traverseText = QPlainTextEdit()
+        self.traverseText.setToolTip("One leg per line : distance and angle, or x and y")
+
+        self.traverseMode = QComboBox()
+        self.traverseMode.addItem("d a")
+        self.traverseMode.addItem("x y")
+
+        self.traverseLoad = QPushButton("load...")
+        self.traverseApply = QPushButton("apply")
+        self.traverseImport = QPushButton("import...")
+        self.traverseImport.setToolTip("Imports a (big) file directly, without loading it in the panel")
+
         ## Angular
         self.relD = QToolButton()
         self.relD.setIcon(deltaIcon)
@@ -173,6 +212,25 @@ class CadInputWidget(QDockWidget):
         self.widPar.toggled.connect(lambda state: disableIfEnabled(state,self.widPer))
         self.widPer.toggled.connect(lambda state: disableIfEnabled(state,self.widPar))
 
+        #the traverse panel is only shown when needed
+        self.widTraverse.toggled.connect(lambda state: self.traversePanel.setVisible(state))
+        self.traverseLoad.clicked.connect(self.loadTraverse)
+        self.traverseApply.clicked.connect(self.applyTraverse)
+        self.traverseImport.clicked.connect(self.importTraverse)
+
+        #the model follows the buttons and the edited fields
+        for button, attribute in [(self.widEnab,'enabled'), (self.widC,'c'), (self.widPar,'par'), (self.widPer,'per'), (self.lockD,'ld'), (self.relA,'ra'), (self.lockA,'la'), (self.relX,'rx'), (self.lockX,'lx'), (self.relY,'ry'), (self.lockY,'ly')]:
+            button.toggled.connect(lambda state, attribute=attribute: setattr(self.model, attribute, state))
+        self.fieldAttributes = {self.widD: 'd', self.widA: 'a', self.widX: 'x', self.widY: 'y'}
+        for field in self.fieldAttributes:
+            field.textEdited.connect(lambda text, field=field: self.fieldEdited(field))
+
+        #any change must be repainted
+        for button in [self.widEnab, self.widC, self.widPar, self.widPer, self.relD, self.lockD, self.relA, self.lockA, self.relX, self.lockX, self.relY, self.lockY]:
+            button.toggled.connect(lambda state: self.valueChanged.emit())
+        for field in [self.widD, self.widA, self.widX, self.widY]:
+            field.textChanged.connect(lambda text: self.valueChanged.emit())
+
 
 
         # Layout the widgets
@@ -184,8 +242,22 @@ class CadInputWidget(QDockWidget):
         sublayout.addWidget(self.widC)
         sublayout.addWidget(self.widPar)
         sublayout.addWidget(self.widPer)
+        sublayout.addWidget(self.widTraverse)
         gridLayout.addLayout(sublayout,r,0,1,4 )
 
+        r+=1
+        traverseLayout = QGridLayout()
+        traverseLayout.setContentsMargins( QMargins() )
+        traverseLayout.addWidget(self.traverseText,0,0,1,4 )
+        traverseLayout.addWidget(self.traverseMode,1,0 )
+        traverseLayout.addWidget(self.traverseLoad,1,1 )
+        traverseLayout.addWidget(self.traverseImport,1,2 )
+        traverseLayout.addWidget(self.traverseApply,1,3 )
+        self.traversePanel = QWidget()
+        self.traversePanel.setLayout(traverseLayout)
+        self.traversePanel.setVisible(False)
+        gridLayout.addWidget(self.traversePanel,r,0,1,4 )
+
         r+=1
         gridLayout.addWidget(self.relD,r,0 )
         gridLayout.addWidget(QLabel("d"),r,1 )
@@ -210,6 +282,10 @@ class CadInputWidget(QDockWidget):
         gridLayout.addWidget(self.widY,r,2 )
         gridLayout.addWidget(self.lockY,r,3 )
 
+        r+=1
+        self.indexLayout = QVBoxLayout()
+        gridLayout.addLayout(self.indexLayout,r,0,1,4 )
+
         gridLayout.setRowStretch( r, 1 ) #does not work ?!
         gridLayout.setColumnStretch( 2, 1 )
 
@@ -276,13 +352,71 @@ class CadInputWidget(QDockWidget):
         if s == "":
             lock.setChecked(False)
         else:
-            v = Evaluator.eval_expr(field.text())
+            #the angle field takes the angle suffixes, the other fields the length suffixes
+            angle = self.fieldAttributes[field] == 'a'
+            v = Evaluator.eval_expr(s, self.expressionContext(), None if angle else self.mapMetersPerUnit(), angle)
             if v is None:
                 lock.setChecked(False)
                 field.setText( "" )
             else:
+                setattr(self.model, self.fieldAttributes[field], v)
                 lock.setChecked(True)
-                field.setText( str( v ) )
+                field.setText( "%.*f" % (self.precision, v) )
+
+    def fieldEdited(self, field):
+        """
+        Stores the field's value in the model (this is the only place where the fields' text is parsed)
+        While an expression is being typed, the model keeps its previous value (the expression is evaluated on validation)
+        """
+        try:
+            setattr(self.model, self.fieldAttributes[field], float(field.text()))
+        except ValueError:
+            pass
+
+    def expressionContext(self):
+        """
+        Returns the values the expressions can refer to as x, y, a and d
+        """
+        return {'x': self.model.x, 'y': self.model.y, 'a': self.model.a, 'd': self.model.d}
+
+    def mapMetersPerUnit(self):
+        """
+        Returns the length of the map unit in meters (for the length suffixes), or None if the map unit is not a length
+        """
+        return self.metersPerUnit.get( self.iface.mapCanvas().mapUnits() )
+
+    def scheduleSync(self):
+        """
+        Schedules the synchronisation of the fields (several calls within one syncInterval result in one single synchronisation)
+        """
+        if not self.syncTimer.isActive():
+            self.syncTimer.start()
+
+    def syncFromModel(self):
+        """
+        Updates the fields' text from a snapshot of the model's values (the locks and modes are synchronized as they change)
+        The fields whose displayed text would not change are not touched, nor is the field being typed in.
+        A locked field keeps the user's text as long as it still holds the locked value (it is only rewritten
+        when the value is locked programmatically, e.g. when aligning to a segment).
+        """
+        self.syncTimer.stop()
+        for field, value in [(self.widD, self.model.d), (self.widA, self.model.a), (self.widX, self.model.x), (self.widY, self.model.y)]:
+            if field.hasFocus():
+                continue
+            if getattr(self.model, "l"+self.fieldAttributes[field]) and self._fieldValue(field) == value:
+                continue
+            text = "%.*f" % (self.precision, value)
+            if field.text() != text:
+                field.setText(text)
+
+    def _fieldValue(self, field):
+        """
+        Returns the number typed in the field, or None
+        """
+        try:
+            return float(field.text())
+        except ValueError:
+            return None
 
     def unlockAll(self):
         self.lx = False
@@ -290,70 +424,127 @@ class CadInputWidget(QDockWidget):
         self.la = False
         self.ld = False
 
+    def setIndexProgress(self, layerId, layerName, fraction):
+        """
+        Displays the progress of the snap index build of a layer (the progress bar is removed once done or cancelled)
+        """
+        bar = self.indexBars.get(layerId)
+        if fraction < 0.0 or fraction >= 1.0:
+            if bar is not None:
+                self.indexLayout.removeWidget(bar)
+                bar.deleteLater()
+                del self.indexBars[layerId]
+            return
+
+        if bar is None:
+            bar = QProgressBar()
+            bar.setRange(0,100)
+            bar.setFormat("indexing "+layerName+" : %p%")
+            self.indexLayout.addWidget(bar)
+            self.indexBars[layerId] = bar
+        bar.setValue( int(100*fraction) )
+
+    def loadTraverse(self):
+        """
+        Loads the legs of a traverse from a text file
+        """
+        path = QFileDialog.getOpenFileName(self, "Load traverse", "", "Text files (*.txt *.csv);;All files (*)")
+        if not path:
+            return
+        textFile = QFile(path)
+        if not textFile.open(QIODevice.ReadOnly | QIODevice.Text):
+            self.iface.messageBar().pushMessage("CadInput", "Could not read "+path, QgsMessageBar.WARNING, 5)
+            return
+        self.traverseText.setPlainText( QTextStream(textFile).readAll() )
+        textFile.close()
+
+    def applyTraverse(self):
+        """
+        Parses the legs of the traverse, and requests them to be applied from the last clicked point
+        """
+        try:
+            polar = self.traverseMode.currentIndex() == 0
+            legs = list( parseLegs( self.traverseText.toPlainText().splitlines(), self.expressionContext(), self.mapMetersPerUnit(), polar ) )
+        except ValueError as e:
+            self.iface.messageBar().pushMessage("CadInput", "Invalid traverse, "+str(e), QgsMessageBar.WARNING, 5)
+            return
+        self.traverseRequested.emit( legs, polar )
+
+    def importTraverse(self):
+        """
+        Requests the legs of a traverse to be imported from a file, from the last clicked point
+        """
+        path = QFileDialog.getOpenFileName(self, "Import traverse", "", "Text files (*.txt *.csv);;All files (*)")
+        if path:
+            self.traverseImportRequested.emit( path, self.traverseMode.currentIndex() == 0 )
+
     def maptoolChanged(self):
         self.active = (self.iface.mapCanvas().mapTool() is not None and self.iface.mapCanvas().mapTool().isEditTool())
+        self.valueChanged.emit()
 
 
 
     """
-    Those properties are just to lighten the code in CadEventFilter
+    Those properties are just to lighten the code in CadEventFilter and CadPaintWidget.
+    They are read from the model. The values are written to the model (the fields being updated by syncFromModel),
+    while the locks and modes are written to their buttons (the model following their toggled signal).
     """
 
     # Basic properties
     @property
-    def x(self): return floatOrZero(self.widX.text())
+    def x(self): return self.model.x
     @x.setter
-    def x(self, value): self.widX.setText(str(value))
+    def x(self, value): self.model.x = value
 
     @property
-    def y(self): return floatOrZero(self.widY.text())
+    def y(self): return self.model.y
     @y.setter
-    def y(self, value): self.widY.setText(str(value))
+    def y(self, value): self.model.y = value
 
     @property
-    def d(self): return floatOrZero(self.widD.text())
+    def d(self): return self.model.d
     @d.setter
-    def d(self, value): self.widD.setText(str(value))
+    def d(self, value): self.model.d = value
 
     @property
-    def a(self): return floatOrZero(self.widA.text())
+    def a(self): return self.model.a
     @a.setter
-    def a(self, value): self.widA.setText(str(value))
+    def a(self, value): self.model.a = value
 
     #Lock properties
     @property
-    def lx(self): return self.lockX.isChecked()
+    def lx(self): return self.model.lx
     @lx.setter
     def lx(self, value): self.lockX.setChecked(value)
 
     @property
-    def ly(self): return self.lockY.isChecked()
+    def ly(self): return self.model.ly
     @ly.setter
     def ly(self, value): self.lockY.setChecked(value)
 
     @property
-    def la(self): return self.lockA.isChecked()
+    def la(self): return self.model.la
     @la.setter
     def la(self, value): self.lockA.setChecked(value)
 
     @property
-    def ld(self): return self.lockD.isChecked()
+    def ld(self): return self.model.ld
     @ld.setter
     def ld(self, value): self.lockD.setChecked(value)
 
     #Relative properties
     @property
-    def rx(self): return self.relX.isChecked()
+    def rx(self): return self.model.rx
     @rx.setter
     def rx(self, value): self.relX.setChecked(value)
 
     @property
-    def ry(self): return self.relY.isChecked()
+    def ry(self): return self.model.ry
     @ry.setter
     def ry(self, value): self.relY.setChecked(value)
 
     @property
-    def ra(self): return self.relA.isChecked()
+    def ra(self): return self.model.ra
     @ra.setter
     def ra(self, value): self.relA.setChecked(value)
 
@@ -364,37 +555,32 @@ class CadInputWidget(QDockWidget):
 
     #Misc properties
     @property
-    def enabled(self): return self.widEnab.isChecked()
+    def enabled(self): return self.model.enabled
     @enabled.setter
     def enabled(self, value): self.widEnab.setChecked(value)
 
     @property
-    def active(self): return self.isEnabled()
+    def active(self): return self.model.active
     @active.setter
-    def active(self, value): self.setEnabled(value)
+    def active(self, value):
+        self.model.active = value
+        self.setEnabled(value)
 
     @property
-    def c(self): return self.widC.isChecked()
+    def c(self): return self.model.c
     @c.setter
     def c(self, value): self.widC.setChecked(value)
 
     @property
-    def per(self): return self.widPer.isChecked()
+    def per(self): return self.model.per
     @per.setter
     def per(self, value): self.widPer.setChecked(value)
 
     @property
-    def par(self): return self.widPar.isChecked()
+    def par(self): return self.model.par
     @par.setter
     def par(self, value): self.widPar.setChecked(value)
 
-def floatOrZero(value):
-    """
-    Since float("") throws an error, we need to use this
-    """
-    try: return float(value)
-    except: return 0.0
-
 class QLineEditWithShortcut(QLineEdit):
     """
     This class allows for internal shortcuts inside QLineEdit when they are being edited.
@@ -411,28 +597,3 @@ class QLineEditWithShortcut(QLineEdit):
         if not event.isAccepted():
             QLineEdit.keyPressEvent(self,event)
 
-
-class Evaluator():
-    """
-    Evaluates strings, code from http://stackoverflow.com/a/9558001/2615469
-    """
-
-    # supported operators
-    operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul, ast.Div: op.truediv, ast.Pow: op.pow, ast.BitXor: op.xor}
-
-    @staticmethod
-    def eval_expr(expr):
-        return Evaluator.eval_(ast.parse(expr).body[0].value) # Module(body=[Expr(value=...)])
-
-    @staticmethod
-    def eval_(node):
-        if isinstance(node, ast.Num): # <number>
-            return node.n
-        elif isinstance(node, ast.operator): # <operator>
-            return Evaluator.operators[type(node)]
-        elif isinstance(node, ast.BinOp): # <left> <operator> <right>
-            return Evaluator.eval_(node.op)(Evaluator.eval_(node.left), Evaluator.eval_(node.right))
-        else:
-            return None
-            #raise TypeError(node)
-
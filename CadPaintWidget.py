@@ -41,176 +41,266 @@ class CadPaintWidget(QWidget):
         #Nor with key events
         self.setFocusPolicy(Qt.NoFocus)
 
+        #We only repaint when the state or the canvas transform change, and only the region covering the old and new primitives
+        self.dirtyRect = QRect() #region covered by the primitives painted last time
+        self.eventfilter.stateChanged.connect( self.scheduleRepaint )
+        self.inputwidget.valueChanged.connect( self.scheduleRepaint )
+        self.iface.mapCanvas().extentsChanged.connect( self._extentsChanged )
+        self.iface.mapCanvas().scaleChanged.connect( self._extentsChanged )
+
+        #Cached map to pixel transform (see _transform)
+        self.transform = None
+
+        #The pens are built once
+        self.pLocked = QPen(QColor(100,100,255, 255), 2, Qt.DashLine) 
+        self.pConstruction1 = QPen(QColor(100,255,100, 150), 2, Qt.DashLine)
+        self.pConstruction2 = QPen(QColor(100,255,100, 255), 2, Qt.DashLine)
+        self.pSnap = QPen(QColor(255,175,100,150), 10)
+        self.pSnapLine = QPen(QColor(200,100,50,150), 1, Qt.DashLine)
+        self.pCursor = QPen(QColor(100,255,100, 255), 2)
+
+        #Static primitives, recorded in a QPicture until the values they depend on change (see _staticKey)
+        self.staticPicture = QPicture()
+        self.staticKey = None
+
+
+    ##########################
+    ##### TRANSFORMATION #####
+    ##########################
+
+    def _extentsChanged(self):
+        self.transform = None
+        self.scheduleRepaint()
+
+    def _transform(self):
+        """
+        Returns the canvas' affine transform as (cx, cy, px, py, a, b, d, e), such that the map point (x,y) is
+        at pixel ( px + a*(x-cx) + b*(y-cy) , py + d*(x-cx) + e*(y-cy) ), or None if the canvas is not ready.
+
+        It is derived once from QgsMapToPixel (around the center of the canvas, to keep the precision) and
+        cached until the extent or the scale changes.
+        """
+        if self.transform is None:
+            mapToPixel = self.iface.mapCanvas().getCoordinateTransform()
+            step = 100.0*mapToPixel.mapUnitsPerPixel()
+            center = self.iface.mapCanvas().extent().center()
+            (cx, cy) = (center.x(), center.y())
+            p = mapToPixel.transform( QgsPoint(cx, cy) )
+            pX = mapToPixel.transform( QgsPoint(cx+step, cy) )
+            pY = mapToPixel.transform( QgsPoint(cx, cy+step) )
+            transform = (   cx, cy, p.x(), p.y(),
+                            (pX.x()-p.x())/step, (pY.x()-p.x())/step,
+                            (pX.y()-p.y())/step, (pY.y()-p.y())/step  )
+            if any( math.isnan(v) or math.isinf(v) for v in transform ) or step == 0:
+                #on loading QGIS, it seems QgsMapToPixel is not ready and return NaNs...
+                return None
+            self.transform = transform
+        return self.transform
+
+    def _toScreen(self, points):
+        """
+        Converts a list of (x, y) pairs (or None) to a list of QPointFs (or None) in one batch
+        """
+        (cx, cy, px, py, a, b, d, e) = self._transform()
+        return [ None if p is None else QPointF( px+a*(p[0]-cx)+b*(p[1]-cy), py+d*(p[0]-cx)+e*(p[1]-cy) ) for p in points ]
 
-    def _t(self, qgspoint):
-        return self.iface.mapCanvas().getCoordinateTransform().transform(qgspoint)
     def _tX(self, x):
-        r = self._t(QgsPoint(x,0)).x()
-        return r
+        (cx, cy, px, py, a, b, d, e) = self._transform()
+        return px+a*(x-cx)
     def _tY(self, y):
-        r = self._t(QgsPoint(0,y)).y()
-        return r
+        (cx, cy, px, py, a, b, d, e) = self._transform()
+        return py+e*(y-cy)
     def _f(self, v):
-        r = v/self.iface.mapCanvas().getCoordinateTransform().mapUnitsPerPixel()
-        return r
+        (cx, cy, px, py, a, b, d, e) = self._transform()
+        return v*math.sqrt(a*a+d*d)
 
-    def paintEvent(self, paintEvent):
+    def scheduleRepaint(self):
         """
-        Paints the visual feedback (painting is done in screen coordinates).
+        Invalidates the region covering both the previously painted primitives and the ones to paint now
         """
+        rect = self._overlayRect()
+        self.update( rect.united(self.dirtyRect) )
+        self.dirtyRect = rect
 
-        if math.isnan( self._tX(0) ) or not self.inputwidget.active or not self.inputwidget.enabled:
-            #on loading QGIS, it seems QgsMapToPixel is not ready and return NaNs...
-            return
-
-        #This is used so the whole widget updates rather than just the painEvent region (probably under-optimal since painEvent is probably called twice)
-        self.update()
-
-        painter = QPainter(self)
-        painter.setRenderHints(QPainter.Antialiasing)
- 
-        pLocked = QPen(QColor(100,100,255, 255), 2, Qt.DashLine) 
-        pConstruction1 = QPen(QColor(100,255,100, 150), 2, Qt.DashLine)
-        pConstruction2 = QPen(QColor(100,255,100, 255), 2, Qt.DashLine)
-        pSnap = QPen(QColor(255,175,100,150), 10)
-        pSnapLine = QPen(QColor(200,100,50,150), 1, Qt.DashLine)
-        pCursor = QPen(QColor(100,255,100, 255), 2)
-
-        #Draw snap
-        if self.eventfilter.snapPoint is not None:
-
-            x = self._tX( self.eventfilter.snapPoint.x())
-            y = self._tY( self.eventfilter.snapPoint.y())
-
-            painter.setPen( pSnap )
-            painter.drawEllipse(    x-10,
-                                    y-10,
-                                    20,
-                                    20  )
-
-            painter.setPen( pSnapLine )
-            painter.drawLine(   x,
-                                y,
-                                self._tX( self.eventfilter.p3.x()),
-                                self._tY( self.eventfilter.p3.y())  )
+    def _isPainted(self):
+        return self.inputwidget.active and self.inputwidget.enabled
 
+    def _overlayRect(self):
+        """
+        Returns the bounding rectangle (in pixels) of the primitives painted by paintEvent
+        """
+        if not self._isPainted():
+            return QRect()
+        if self._transform() is None:
+            return self.rect()
 
-        if self.eventfilter.snapSegment is not None:
-            painter.setPen( pSnap )
-
-            painter.drawLine(   self._tX( self.eventfilter.snapSegment[1].x()),
-                                self._tY( self.eventfilter.snapSegment[1].y()),
-                                self._tX( self.eventfilter.snapSegment[2].x()),
-                                self._tY( self.eventfilter.snapSegment[2].y())  )
+        if self.inputwidget.la:
+            #the locked angle line crosses the whole widget
+            return self.rect()
 
+        ef = self.eventfilter
+        segment = ef.snapSegment or (None, None, None)
+        (p1, p2, p3, snapPoint, segment1, segment2) = self._toScreen( [ef.p1, ef.p2, ef.p3, ef.snapPoint, segment[1], segment[2]] )
 
-            painter.setPen( pSnapLine )
-            painter.drawLine(   self._tX( self.eventfilter.snapSegment[1].x()),
-                                self._tY( self.eventfilter.snapSegment[1].y()),
-                                self._tX( self.eventfilter.p3.x()),
-                                self._tY( self.eventfilter.p3.y())  )
+        rect = QRectF()
+        for (point, margin) in [(p1, 5), (p2, 65), (p3, 10), (snapPoint, 20), (segment1, 10), (segment2, 10)]:
+            #p2 has the angle arc and line, the snapPoint has the snap circle
+            if point is not None:
+                rect = rect.united( QRectF(point.x()-margin, point.y()-margin, 2*margin, 2*margin) )
 
+        if self.inputwidget.ld:
+            d = self._f(self.inputwidget.d)
+            rect = rect.united( QRectF(p2.x()-d-5, p2.y()-d-5, 2*d+10, 2*d+10) )
 
-        #Draw segment
-        if (self.inputwidget.per or self.inputwidget.par) and self.eventfilter.snapSegment is not None:
-            painter.setPen( pLocked )
+        if self.inputwidget.lx:
+            x = self._tX( ef.p2[0]+self.inputwidget.x if self.inputwidget.rx else self.inputwidget.x )
+            rect = rect.united( QRectF(x-5, 0, 10, self.height()) )
 
-            painter.drawLine(   self._tX( self.eventfilter.snapSegment[1].x()),
-                                self._tY( self.eventfilter.snapSegment[1].y()),
-                                self._tX( self.eventfilter.snapSegment[2].x()),
-                                self._tY( self.eventfilter.snapSegment[2].y())  )
+        if self.inputwidget.ly:
+            y = self._tY( ef.p2[1]+self.inputwidget.y if self.inputwidget.ry else self.inputwidget.y )
+            rect = rect.united( QRectF(0, y-5, self.width(), 10) )
 
+        return rect.toAlignedRect().intersected( self.rect() )
 
-        #Draw angle
+    def _staticKey(self):
+        """
+        Returns everything the static primitives depend on : the static picture is recorded again only when this changes
+        """
+        iw = self.inputwidget
+        ef = self.eventfilter
+        return (    self.transform, self.width(), self.height(),
+                    ef.p1, ef.p2,
+                    iw.ra, iw.par or iw.per,
+                    iw.la, iw.a if iw.la else None,
+                    iw.ld, iw.d if iw.ld else None,
+                    iw.lx, iw.rx, iw.x if iw.lx else None,
+                    iw.ly, iw.ry, iw.y if iw.ly else None  )
+
+    def _angles(self):
+        """
+        Returns the angle of the reference direction and the angle of the current angle value (in screen orientation)
+        """
         if self.inputwidget.ra:                
-            a0 = math.atan2( -(self.eventfilter.p2.y()-self.eventfilter.p1.y()), self.eventfilter.p2.x()-self.eventfilter.p1.x() )
+            a0 = math.atan2( -(self.eventfilter.p2[1]-self.eventfilter.p1[1]), self.eventfilter.p2[0]-self.eventfilter.p1[0] )
             a = a0-math.radians(self.inputwidget.a)
         else:
             a0 = 0
             a = -math.radians(self.inputwidget.a)
+        return (a0, a)
 
-        painter.setPen( pConstruction2 )
-        painter.drawArc(    self._tX( self.eventfilter.p2.x())-20,
-                            self._tY( self.eventfilter.p2.y())-20,
-                            40, 40,
-                            16*math.degrees(-a0),
-                            16*self.inputwidget.a  )
-        painter.drawLine(   self._tX( self.eventfilter.p2.x()),
-                            self._tY( self.eventfilter.p2.y()),
-                            self._tX( self.eventfilter.p2.x())+60*math.cos(a0),
-                            self._tY( self.eventfilter.p2.y())+60*math.sin(a0)  )
+    def _paintStatic(self, painter, p1, p2):
+        """
+        Paints the primitives which only change on click or when a lock value changes :
+        the angle reference, the locked angle / distance / x / y and the last segment.
+        """
 
-        if self.inputwidget.la:
-            painter.setPen( pLocked )
-            painter.drawLine(   self._tX( self.eventfilter.p2.x())-self.width()*math.cos(a),
-                                self._tY( self.eventfilter.p2.y())-self.width()*math.sin(a),
-                                self._tX( self.eventfilter.p2.x())+self.width()*math.cos(a),
-                                self._tY( self.eventfilter.p2.y())+self.width()*math.sin(a)  )
+        (a0, a) = self._angles()
 
+        #Draw angle reference
+        painter.setPen( self.pConstruction2 )
+        painter.drawLine(   p2,
+                            p2+QPointF(60*math.cos(a0), 60*math.sin(a0))  )
+
+        if self.inputwidget.la:
+            painter.setPen( self.pLocked )
+            painter.drawLine(   p2-QPointF(self.width()*math.cos(a), self.width()*math.sin(a)),
+                                p2+QPointF(self.width()*math.cos(a), self.width()*math.sin(a))  )
 
 
         #Draw distance
         if self.inputwidget.ld:
-            painter.setPen( pLocked )
-            painter.drawEllipse(    self._tX( self.eventfilter.p2.x() - self.inputwidget.d ),
-                                    self._tY( self.eventfilter.p2.y() + self.inputwidget.d ),
-                                    self._f( 2.0*self.inputwidget.d ),
-                                    self._f( 2.0*self.inputwidget.d )  )
+            painter.setPen( self.pLocked )
+            painter.drawEllipse( p2, self._f(self.inputwidget.d), self._f(self.inputwidget.d) )
 
 
         #Draw x
         if self.inputwidget.lx:
-            painter.setPen( pLocked )
+            painter.setPen( self.pLocked )
             if self.inputwidget.rx:
-                x = self._tX( self.eventfilter.p2.x()+self.inputwidget.x )
+                x = self._tX( self.eventfilter.p2[0]+self.inputwidget.x )
             else:   
                 x = self._tX( self.inputwidget.x )
-            painter.drawLine(   x,
-                                0,
-                                x,
-                                self.height() )
+            painter.drawLine( QPointF(x, 0), QPointF(x, self.height()) )
 
         #Draw y
         if self.inputwidget.ly:
-            painter.setPen( pLocked )
+            painter.setPen( self.pLocked )
             if self.inputwidget.ry:
-                y = self._tY( self.eventfilter.p2.y()+self.inputwidget.y )
+                y = self._tY( self.eventfilter.p2[1]+self.inputwidget.y )
             else:   
                 y = self._tY( self.inputwidget.y )
-            painter.drawLine(   0,
-                                y,
-                                self.width(),
-                                y )
+            painter.drawLine( QPointF(0, y), QPointF(self.width(), y) )
 
-        #Draw constr
+        #Draw last segment
         if not self.inputwidget.par and not self.inputwidget.per:
-            painter.setPen( pConstruction2 )
-            painter.drawLine(   self._tX( self.eventfilter.p2.x()),
-                                self._tY( self.eventfilter.p2.y()),
-                                self._tX( self.eventfilter.p3.x()),
-                                self._tY( self.eventfilter.p3.y())  )
+            painter.setPen( self.pConstruction1 )
+            painter.drawLine( p1, p2 )
 
-            painter.setPen( pConstruction1 )
-            painter.drawLine(   self._tX( self.eventfilter.p1.x()),
-                                self._tY( self.eventfilter.p1.y()),
-                                self._tX( self.eventfilter.p2.x()),
-                                self._tY( self.eventfilter.p2.y())  )
+    def paintEvent(self, paintEvent):
+        """
+        Paints the visual feedback (painting is done in screen coordinates).
 
-        painter.setPen( pCursor )
-        painter.drawLine(   self._tX( self.eventfilter.p3.x())-5,
-                            self._tY( self.eventfilter.p3.y())-5,
-                            self._tX( self.eventfilter.p3.x())+5,
-                            self._tY( self.eventfilter.p3.y())+5  )
-        painter.drawLine(   self._tX( self.eventfilter.p3.x())-5,
-                            self._tY( self.eventfilter.p3.y())+5,
-                            self._tX( self.eventfilter.p3.x())+5,
-                            self._tY( self.eventfilter.p3.y())-5  )
+        The static primitives are replayed from a QPicture, only the snaps, the angle arc, the rubber line
+        and the cursor are painted at each frame.
+        """
 
+        if not self._isPainted() or self._transform() is None:
+            return
 
+        #All the points are converted to screen coordinates at once
+        segment = self.eventfilter.snapSegment or (None, None, None)
+        (p1, p2, p3, snapPoint, segment1, segment2) = self._toScreen( [self.eventfilter.p1, self.eventfilter.p2, self.eventfilter.p3, self.eventfilter.snapPoint, segment[1], segment[2]] )
 
+        #Record the static primitives again if needed
+        key = self._staticKey()
+        if key != self.staticKey:
+            self.staticPicture = QPicture()
+            staticPainter = QPainter(self.staticPicture)
+            staticPainter.setRenderHints(QPainter.Antialiasing)
+            self._paintStatic(staticPainter, p1, p2)
+            staticPainter.end()
+            self.staticKey = key
 
+        painter = QPainter(self)
+        painter.setRenderHints(QPainter.Antialiasing)
+
+        painter.drawPicture( 0, 0, self.staticPicture )
+
+        #Draw snap
+        if snapPoint is not None:
+            painter.setPen( self.pSnap )
+            painter.drawEllipse( snapPoint, 10, 10 )
+
+            painter.setPen( self.pSnapLine )
+            painter.drawLine( snapPoint, p3 )
 
 
+        if segment1 is not None:
+            painter.setPen( self.pSnap )
+            painter.drawLine( segment1, segment2 )
 
+            painter.setPen( self.pSnapLine )
+            painter.drawLine( segment1, p3 )
 
 
+        #Draw segment
+        if (self.inputwidget.per or self.inputwidget.par) and segment1 is not None:
+            painter.setPen( self.pLocked )
+            painter.drawLine( segment1, segment2 )
+
+
+        #Draw angle arc
+        (a0, a) = self._angles()
+        painter.setPen( self.pConstruction2 )
+        painter.drawArc(    QRectF(p2.x()-20, p2.y()-20, 40, 40),
+                            int(16*math.degrees(-a0)),
+                            int(16*self.inputwidget.a)  )
+
+        #Draw rubber line
+        if not self.inputwidget.par and not self.inputwidget.per:
+            painter.setPen( self.pConstruction2 )
+            painter.drawLine( p2, p3 )
+
+        painter.setPen( self.pCursor )
+        painter.drawLine( p3+QPointF(-5,-5), p3+QPointF(5,5) )
+        painter.drawLine( p3+QPointF(-5,5), p3+QPointF(5,-5) )
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Import the PyQt and QGIS libraries
+from qgis.core import QgsPoint
+
+
+# The hot path (snapping, constraining, painting) works on (x, y) float pairs : QgsPoints are only created
+# where QGIS needs or returns one, through toQgsPoint and toPair.
+#
+# In debug mode (the /CadInput/debugConversions setting), the calls to toQgsPoint and toPair are counted in
+# conversions, and the CadEventFilter logs their number per mouse event. Only those calls are counted : the
+# QgsPoints QGIS creates by itself (as the results of the QgsSnapper) are not.
+
+debug = False
+conversions = 0
+
+def toQgsPoint(point):
+    """
+    Returns the QgsPoint of an (x, y) pair
+    """
+    global conversions
+    if debug:
+        conversions += 1
+    return QgsPoint(point[0], point[1])
+
+def toPair(qgsPoint):
+    """
+    Returns the (x, y) pair of a QgsPoint received from QGIS
+    """
+    global conversions
+    if debug:
+        conversions += 1
+    return (qgsPoint.x(), qgsPoint.y())
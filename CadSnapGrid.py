@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# This module has no Qt nor QGIS dependency
+
+import os
+import sys
+import math
+import mmap
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left
+
+
+class BuildCancelled(Exception):
+    """
+    Raised by SnapGrid.index and saveGrid when their cancelled callback returns True
+    """
+    pass
+
+
+class SnapGrid(object):
+    """
+    Uniform grid index over the vertices and segments of one layer.
+
+    Vertices are stored in flat coordinate arrays. Each vertex is linked to the next vertex of its part
+    (or to -1), so that a vertex entry also stands for the segment starting at it. Each entry is registered
+    in the cells crossed by its segment (or in its own cell if it ends a part).
+
+    Features are first appended, then index() chooses the cell size from the density of the vertices.
+    Features added after that are registered immediately, and features can be removed or replaced
+    so that edits are patched without rebuilding the whole grid. When the vertex count changes, or the extent
+    grows, by more than driftFactor from what the cell size was chosen for, the grid is indexed again.
+    """
+
+    verticesPerCell = 8 # targeted mean density, used to choose the cell size
+    cellsPerSide = 64 # cell count along the extent of an empty grid
+    driftFactor = 4.0 # the cell size is chosen again when the vertex count changes, or the extent grows, by this factor
+
+    def __init__(self):
+        self.cellSize = None
+        self.xs = array('d')
+        self.ys = array('d')
+        self.nexts = array('l')
+        self.cells = dict() # (i,j) -> array of vertex entries
+        self.features = dict() # feature id -> (first vertex, last vertex + 1)
+        self.garbage = 0 # count of vertices left by removed features
+        self.bounds = None # (xmin, ymin, xmax, ymax) of the vertices added since the last indexing, or None
+        self.indexedCount = 0 # the vertex count and the span the cell size was chosen for
+        self.indexedSpan = 0.0
+
+    def addFeature(self, fid, parts):
+        """
+        Appends a feature given as a list of parts, each part being a list of (x,y) tuples
+        """
+        first = len(self.xs)
+        for part in parts:
+            for (x, y) in part:
+                self.xs.append(x)
+                self.ys.append(y)
+                self.nexts.append(len(self.xs))
+            if part:
+                self.nexts[-1] = -1
+        last = len(self.xs)
+        self.features[fid] = (first, last)
+        if last > first:
+            self._extendBounds(min(self.xs[first:last]), min(self.ys[first:last]), max(self.xs[first:last]), max(self.ys[first:last]))
+
+        if self.cellSize is not None:
+            if self._drifted():
+                self._compact()
+            else:
+                for v in range(first, last):
+                    self._register(v)
+
+    def removeFeature(self, fid):
+        """
+        Unregisters a feature's vertices. Their coordinates are left as garbage until the next compaction.
+        """
+        (first, last) = self.features.pop(fid, (0, 0))
+        if self.cellSize is not None:
+            for v in range(first, last):
+                for cell in self._cellsOf(v):
+                    entries = self.cells[cell]
+                    entries.remove(v)
+                    if len(entries) == 0:
+                        del self.cells[cell]
+        self.garbage += last-first
+        if self.garbage > len(self.xs)//2:
+            self._compact()
+
+    def replaceFeature(self, fid, parts):
+        self.removeFeature(fid)
+        self.addFeature(fid, parts)
+
+    def removeTemporaryFeatures(self):
+        """
+        Removes the features having a temporary id (features added in the edit buffer have negative ids)
+        """
+        for fid in [fid for fid in self.features if fid < 0]:
+            self.removeFeature(fid)
+
+    def _compact(self):
+        """
+        Rebuilds the arrays without the garbage left by the removed features.
+        The cell size is kept, unless the vertex count or the extent drifted too far from what it was chosen for.
+        """
+        xs = self.xs
+        ys = self.ys
+        nexts = self.nexts
+        features = self.features
+
+        self.xs = array('d')
+        self.ys = array('d')
+        self.nexts = array('l')
+        self.cells = dict()
+        self.features = dict()
+        self.garbage = 0
+
+        for fid, (first, last) in features.items():
+            offset = len(self.xs) - first
+            self.xs.extend( xs[first:last] )
+            self.ys.extend( ys[first:last] )
+            self.nexts.extend( (n+offset if n != -1 else -1) for n in nexts[first:last] )
+            self.features[fid] = (first+offset, last+offset)
+
+        if self.cellSize is not None:
+            self.bounds = (min(self.xs), min(self.ys), max(self.xs), max(self.ys)) if self.xs else None
+            if self._drifted():
+                self._chooseCellSize(None)
+            for v in range(len(self.xs)):
+                self._register(v)
+
+    cancelCheckInterval = 4096 # vertices registered between two calls of the cancelled callback
+
+    def index(self, extent=None, cancelled=None):
+        """
+        Chooses the cell size and registers all the vertices in the cells.
+        The (xmin, ymin, xmax, ymax) extent gives the size of the cells of an empty grid (the layer's or the canvas' extent).
+        The cancelled callback (if any) is called regularly : BuildCancelled is raised once it returns True.
+        """
+        self._chooseCellSize(extent)
+        for v in range(len(self.xs)):
+            if cancelled is not None and v % self.cancelCheckInterval == 0 and cancelled():
+                raise BuildCancelled()
+            self._register(v)
+
+    def _chooseCellSize(self, extent):
+        """
+        Chooses the cell size from the density of the vertices, or from the extent if there are none
+        """
+        count = len(self.xs) - self.garbage
+        if count > 0 and self.bounds is not None:
+            (xmin, ymin, xmax, ymax) = self.bounds
+            span = max(xmax-xmin, ymax-ymin, 1e-9)
+            self.cellSize = math.sqrt(span*span * self.verticesPerCell / count)
+        elif extent is not None and max(extent[2]-extent[0], extent[3]-extent[1]) > 0:
+            span = max(extent[2]-extent[0], extent[3]-extent[1])
+            self.cellSize = span / self.cellsPerSide
+        else:
+            span = 0.0
+            self.cellSize = 1.0
+        self.indexedCount = count
+        self.indexedSpan = span
+
+    def _extendBounds(self, xmin, ymin, xmax, ymax):
+        if self.bounds is not None:
+            xmin = min(xmin, self.bounds[0])
+            ymin = min(ymin, self.bounds[1])
+            xmax = max(xmax, self.bounds[2])
+            ymax = max(ymax, self.bounds[3])
+        self.bounds = (xmin, ymin, xmax, ymax)
+
+    def _drifted(self):
+        """
+        Returns whether the vertex count changed, or the extent grew, by more than driftFactor since the cell size was chosen
+        (a grid indexed with less than verticesPerCell*cellsPerSide vertices is only indexed again above that count)
+        """
+        count = len(self.xs) - self.garbage
+        indexedCount = max(self.indexedCount, self.verticesPerCell*self.cellsPerSide)
+        if count > indexedCount*self.driftFactor or count*self.driftFactor < self.indexedCount:
+            return True
+        if self.bounds is None or self.indexedSpan <= 0:
+            return False
+        span = max(self.bounds[2]-self.bounds[0], self.bounds[3]-self.bounds[1])
+        return span > self.indexedSpan*self.driftFactor
+
+    def _cellsOf(self, v):
+        """
+        Returns the cells crossed by the segment starting at vertex v (sampled every half cell)
+        """
+        cs = self.cellSize
+        x1 = self.xs[v]
+        y1 = self.ys[v]
+        n = self.nexts[v]
+        if n == -1:
+            return set([(int(math.floor(x1/cs)), int(math.floor(y1/cs)))])
+        x2 = self.xs[n]
+        y2 = self.ys[n]
+        steps = int(2.0*max(abs(x2-x1), abs(y2-y1))/cs)+1
+        cells = set()
+        for k in range(steps+1):
+            t = float(k)/steps
+            cells.add( (int(math.floor((x1+t*(x2-x1))/cs)), int(math.floor((y1+t*(y2-y1))/cs))) )
+        return cells
+
+    def _register(self, v):
+        for cell in self._cellsOf(v):
+            entries = self.cells.get(cell)
+            if entries is None:
+                entries = array('l')
+                self.cells[cell] = entries
+            entries.append(v)
+
+    def _cellRange(self, x, y, tolerance):
+        """
+        Returns the (i0, i1, j0, j1) range of cells to scan around (x,y)
+        """
+        cs = self.cellSize
+        return (    int(math.floor((x-tolerance)/cs))-1,
+                    int(math.floor((x+tolerance)/cs))+1,
+                    int(math.floor((y-tolerance)/cs))-1,
+                    int(math.floor((y+tolerance)/cs))+1  )
+
+    def close(self):
+        """
+        Releases the resources held by the grid (nothing to do for in-memory grids)
+        """
+        pass
+
+    def _candidates(self, x, y, tolerance):
+        """
+        Yields the vertex entries that may be within tolerance of (x,y).
+        Since segments are sampled every half cell, we look one cell further than the tolerance.
+        """
+        (i0, i1, j0, j1) = self._cellRange(x, y, tolerance)
+
+        if (i1-i0+1)*(j1-j0+1) > len(self.cells):
+            #zoomed out : scanning the occupied cells is cheaper
+            for (i, j), entries in self.cells.items():
+                if i0 <= i <= i1 and j0 <= j <= j1:
+                    for v in entries:
+                        yield v
+        else:
+            for i in range(i0, i1+1):
+                for j in range(j0, j1+1):
+                    entries = self.cells.get((i, j))
+                    if entries is not None:
+                        for v in entries:
+                            yield v
+
+    def nearestVertex(self, x, y, tolerance):
+        """
+        Returns the nearest vertex (x,y) within tolerance, or None
+        """
+        best = None
+        bestD = tolerance*tolerance
+        xs = self.xs
+        ys = self.ys
+        for v in self._candidates(x, y, tolerance):
+            n = self.nexts[v]
+            for w in ((v,) if n == -1 else (v, n)):
+                d = (xs[w]-x)**2 + (ys[w]-y)**2
+                if d <= bestD:
+                    bestD = d
+                    best = (xs[w], ys[w])
+        return best
+
+    def nearestSegment(self, x, y, tolerance):
+        """
+        Returns the nearest segment within tolerance as ((x,y) on segment, (x,y) of start, (x,y) of end), or None
+        """
+        best = None
+        bestD = tolerance*tolerance
+        xs = self.xs
+        ys = self.ys
+        for v in self._candidates(x, y, tolerance):
+            n = self.nexts[v]
+            if n == -1:
+                continue
+            x1 = xs[v]
+            y1 = ys[v]
+            dx = xs[n]-x1
+            dy = ys[n]-y1
+            l = dx*dx+dy*dy
+            if l == 0:
+                continue
+            t = min(1.0, max(0.0, ((x-x1)*dx+(y-y1)*dy)/l))
+            px = x1+t*dx
+            py = y1+t*dy
+            d = (px-x)**2 + (py-y)**2
+            if d <= bestD:
+                bestD = d
+                best = ((px, py), (x1, y1), (xs[n], ys[n]))
+        return best
+
+
+
+
+###########################
+##### PERSISTENT GRIDS ####
+###########################
+
+# Cache file layout (native byte order) :
+# header, key (utf-8), xs (double), ys (double), feature ids (double), nexts (int),
+# cell i keys (int), cell j keys (int), cell offsets (int), cell entries (int)
+# The cells are sorted by (i,j), the entries of cell k being entries[offsets[k]:offsets[k+1]]
+MAGIC = b"CADSNAP1"
+BYTEORDER = sys.byteorder[0].encode("ascii")
+HEADER = struct.Struct("=8scidiii") # magic, byte order, key length, cell size, vertex count, cell count, entry count
+
+def saveGrid(grid, path, key, cancelled=None):
+    """
+    Writes the grid to a cache file that can be memory-mapped by MappedSnapGrid.
+    The file is written aside (to a temporary file of its own, so that concurrent writers don't mix) and then moved,
+    so that a crash never leaves a truncated cache.
+    The cancelled callback (if any) is called before each step : BuildCancelled is raised once it returns True.
+    """
+    def check():
+        if cancelled is not None and cancelled():
+            raise BuildCancelled()
+
+    if grid.garbage:
+        grid._compact()
+    check()
+
+    count = len(grid.xs)
+    fids = array('d', [0.0])*count
+    for fid, (first, last) in grid.features.items():
+        for v in range(first, last):
+            fids[v] = fid
+
+    cells = sorted(grid.cells.items())
+    cellsI = array('i', [cell[0] for cell, entries in cells])
+    cellsJ = array('i', [cell[1] for cell, entries in cells])
+    offsets = array('i', [0])
+    entries = array('i')
+    for cell, cellEntries in cells:
+        entries.extend(array('i', cellEntries))
+        offsets.append(len(entries))
+
+    keyBytes = key.encode("utf-8")
+    check()
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    (fd, tmpPath) = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(path)+".", dir=directory)
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write( HEADER.pack(MAGIC, BYTEORDER, len(keyBytes), grid.cellSize, count, len(cells), len(entries)) )
+            f.write( keyBytes )
+            for data in (grid.xs, grid.ys, fids, array('i', grid.nexts), cellsI, cellsJ, offsets, entries):
+                check()
+                data.tofile(f)
+        finally:
+            f.close()
+        check()
+
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpPath, path)
+    except:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+
+class MappedArray(object):
+    """
+    Read-only sequence over a memory-mapped array : the items are unpacked on access, nothing is copied.
+    """
+
+    def __init__(self, buffer, offset, fmt, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.item = struct.Struct("="+fmt)
+        self.count = count
+
+    def nbytes(self):
+        return self.item.size*self.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.item.unpack_from(self.buffer, self.offset+i*self.item.size)[0]
+
+
+class MappedCells(object):
+    """
+    Sorted sequence of the (i,j) keys of the cells of a MappedSnapGrid (so that it can be bisected)
+    """
+
+    def __init__(self, cellsI, cellsJ):
+        self.cellsI = cellsI
+        self.cellsJ = cellsJ
+
+    def __len__(self):
+        return len(self.cellsI)
+
+    def __getitem__(self, k):
+        return (self.cellsI[k], self.cellsJ[k])
+
+
+class MappedSnapGrid(SnapGrid):
+    """
+    SnapGrid memory-mapped from a cache file written by saveGrid, so that it is available without any rebuild.
+
+    The mapped arrays are read-only : the edits go to an in-memory overlay SnapGrid, and the
+    mapped vertices of the removed (or replaced) features are masked.
+    """
+
+    def __init__(self, path, key):
+        SnapGrid.__init__(self)
+
+        self.file = open(path, "rb")
+        try:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, byteorder, keyLength, cellSize, count, cellCount, entryCount) = HEADER.unpack_from(self.buffer, 0)
+            offset = HEADER.size
+            storedKey = self.buffer[offset:offset+keyLength].decode("utf-8")
+            offset += keyLength
+        except (struct.error, ValueError, EnvironmentError):
+            self.file.close()
+            raise ValueError("invalid snap cache %s" % path)
+
+        if magic != MAGIC or byteorder != BYTEORDER or storedKey != key:
+            self.close()
+            raise ValueError("outdated snap cache %s" % path)
+
+        def mapArray(fmt, count):
+            mapped = MappedArray(self.buffer, mapArray.offset, fmt, count)
+            mapArray.offset += mapped.nbytes()
+            return mapped
+        mapArray.offset = offset
+
+        self.cellSize = cellSize
+        self.xs = mapArray('d', count)
+        self.ys = mapArray('d', count)
+        self.fids = mapArray('d', count)
+        self.nexts = mapArray('i', count)
+        self.mappedCells = MappedCells(mapArray('i', cellCount), mapArray('i', cellCount))
+        self.offsets = mapArray('i', cellCount+1)
+        self.entries = mapArray('i', entryCount)
+
+        if mapArray.offset > len(self.buffer):
+            self.close()
+            raise ValueError("truncated snap cache %s" % path)
+
+        self.overlay = SnapGrid()
+        self.overlay.cellSize = cellSize
+        self.removed = set() # ids of the mapped features that must be ignored
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def addFeature(self, fid, parts):
+        self.overlay.addFeature(fid, parts)
+
+    def removeFeature(self, fid):
+        self.removed.add(fid)
+        self.overlay.removeFeature(fid)
+
+    def removeTemporaryFeatures(self):
+        self.overlay.removeTemporaryFeatures()
+
+    def index(self, extent=None, cancelled=None):
+        pass
+
+    def _candidates(self, x, y, tolerance):
+        (i0, i1, j0, j1) = self._cellRange(x, y, tolerance)
+        cells = self.mappedCells
+        offsets = self.offsets
+        entries = self.entries
+        removed = self.removed
+        fids = self.fids
+
+        if (i1-i0+1)*(j1-j0+1) > len(cells):
+            #zoomed out : scanning the occupied cells is cheaper
+            ks = [k for k in range(len(cells)) if i0 <= cells.cellsI[k] <= i1 and j0 <= cells.cellsJ[k] <= j1]
+        else:
+            #the cells being sorted by (i,j), each row of the range is contiguous
+            ks = []
+            for i in range(i0, i1+1):
+                k = bisect_left(cells, (i, j0))
+                while k < len(cells) and cells[k] <= (i, j1):
+                    ks.append(k)
+                    k += 1
+
+        for k in ks:
+            for e in range(offsets[k], offsets[k+1]):
+                v = entries[e]
+                if not removed or fids[v] not in removed:
+                    yield v
+
+    def nearestVertex(self, x, y, tolerance):
+        return nearest(x, y, SnapGrid.nearestVertex(self, x, y, tolerance), self.overlay.nearestVertex(x, y, tolerance), lambda found: found)
+
+    def nearestSegment(self, x, y, tolerance):
+        return nearest(x, y, SnapGrid.nearestSegment(self, x, y, tolerance), self.overlay.nearestSegment(x, y, tolerance), lambda found: found[0])
+
+
+def nearest(x, y, a, b, position):
+    """
+    Returns the nearest to (x,y) of two query results (any of them may be None)
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    (ax, ay) = position(a)
+    (bx, by) = position(b)
+    return a if (ax-x)**2+(ay-y)**2 <= (bx-x)**2+(by-y)**2 else b
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Import the PyQt and QGIS libraries
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from qgis.core import *
+from qgis.gui import *
+
+import os
+import hashlib
+
+from CadSnapGrid import SnapGrid, MappedSnapGrid, BuildCancelled, saveGrid
+from CadPoints import toQgsPoint, toPair
+
+
+class CadSnapIndex(QObject):
+    """
+    This class keeps an in-memory SnapGrid (in layer coordinates) for each snappable layer.
+
+    It allows CadSnapper to answer nearest vertex and nearest segment queries without going
+    through the QGIS snapper, whose cost grows with the size of the layers.
+
+    The grids are built in the background by SnapGridTasks running on the index's own QThreadPool, so
+    that loading a project never freezes QGIS. Until a layer's grid is ready, CadSnapper falls back
+    to the QgsSnapper for that layer. The grids of file based layers are also saved to an on-disk
+    cache, which is memory-mapped (MappedSnapGrid) the next time the layer is opened.
+
+    The grids follow the layers' edits : only the features reported by the edit signals are patched.
+    """
+
+    progressChanged = pyqtSignal(str, str, float) # layer id, layer name, fraction done (1.0 when ready, -1.0 if cancelled or failed)
+    gridBuilt = pyqtSignal(object, object) # task, grid : emitted by the SnapGridTasks (from the worker threads), the grid is None if the build failed
+    gridProgress = pyqtSignal(object, float) # task, fraction : emitted by the SnapGridTasks (from the worker threads)
+
+    def __init__(self, iface):
+        QObject.__init__(self)
+        self.iface = iface
+        self.grids = dict() # layer id -> SnapGrid
+        self.tasks = dict() # layer id -> SnapGridTask being built
+        self.failed = set() # ids of the layers whose grid could not be built (those stay on the QgsSnapper)
+        self.watched = dict() # id of the layers whose modifications we listen to -> their (signal, slot) connections
+        self.version = 0 # incremented each time the set of ready grids changes
+
+        #a pool of our own, so that unload only waits for our tasks
+        self.pool = QThreadPool()
+
+        #those are emitted from the worker threads, and thus queued to the main thread
+        self.gridBuilt.connect( self._gridBuilt )
+        self.gridProgress.connect( self._gridProgress )
+
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect( self.removeLayers )
+        QgsMapLayerRegistry.instance().removeAll.connect( self.clear )
+
+    unloadTimeout = 2000 # milliseconds to wait for the running tasks on unload (they check their cancellation regularly)
+
+    def unload(self):
+        """
+        Cancels the builds, waits (briefly) for the running tasks, and disconnects from the registry and the layers
+        """
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.disconnect( self.removeLayers )
+        QgsMapLayerRegistry.instance().removeAll.disconnect( self.clear )
+        for layerId in list(self.watched):
+            self._unwatch(layerId)
+        self.clear()
+        self.pool.waitForDone(self.unloadTimeout)
+        self.gridBuilt.disconnect( self._gridBuilt )
+        self.gridProgress.disconnect( self._gridProgress )
+
+    def isReady(self, layer):
+        return layer.id() in self.grids
+
+    def ensureLayers(self, layers):
+        """
+        Schedules the build of the grids of the given layers if they are not built nor being built yet
+        """
+        for layer in layers:
+            if not self.isReady(layer) and layer.id() not in self.tasks and layer.id() not in self.failed:
+                self.buildLayer(layer)
+
+    def buildLayer(self, layer):
+        """
+        Starts building the grid of a layer.
+
+        The features are streamed from a provider of their own in a worker thread. Memory layers can't be
+        opened twice, so those are built right away (they are small anyway).
+        """
+        if layer.id() not in self.watched:
+            self._watch(layer)
+
+        if layer.providerType() == "memory":
+            grid = SnapGrid()
+            request = QgsFeatureRequest().setSubsetOfAttributes([])
+            for feature in layer.getFeatures(request):
+                grid.addFeature(feature.id(), geometryParts(feature.geometry()))
+            grid.index( self._emptyExtent(layer) )
+            self._install(layer, grid)
+            return
+
+        (cachePath, cacheKey) = self._cache(layer)
+        if cachePath is not None and os.path.isfile(cachePath):
+            try:
+                self._install(layer, MappedSnapGrid(cachePath, cacheKey))
+                return
+            except ValueError as e:
+                #outdated or invalid cache : we rebuild it
+                QgsMessageLog.logMessage("WARNING : %s, it will be rebuilt" % e)
+
+        task = SnapGridTask(self, layer.id(), layer.providerType(), layer.source(), layer.subsetString(), cachePath, cacheKey, self._emptyExtent(layer))
+        self.tasks[layer.id()] = task
+        self.progressChanged.emit(layer.id(), layer.name(), 0.0)
+        self.pool.start(task)
+
+    def _emptyExtent(self, layer):
+        """
+        Returns the extent sizing the cells of the layer's grid if it has no vertices, as (xmin, ymin, xmax, ymax) in layer coordinates :
+        the layer's extent, or the canvas' extent if the layer's is empty
+        """
+        extent = layer.extent()
+        if extent.isEmpty():
+            canvas = self.iface.mapCanvas()
+            extent = canvas.mapRenderer().mapToLayerCoordinates( layer, canvas.extent() )
+        return (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+
+    def _cache(self, layer):
+        """
+        Returns the path and the key of the layer's cache file, or (None, None) if the layer can't be cached.
+
+        There is one cache file per data source. Its key (data source, feature count and modification time)
+        tells whether it is still up to date. Only file based layers are cached, since we need their modification time.
+        """
+        path = layer.source().split("|")[0]
+        if not os.path.isfile(path):
+            return (None, None)
+
+        source = layer.source()+"|"+layer.subsetString()
+        key = u"%s|%d|%f" % (source, layer.dataProvider().featureCount(), os.path.getmtime(path))
+        name = hashlib.sha1( source.encode("utf-8") ).hexdigest()+".bin"
+        return (os.path.join(QgsApplication.qgisSettingsDirPath(), "cadinput", "snapcache", name), key)
+
+    def _isCurrent(self, task):
+        """
+        Returns whether the task is the layer's current build : the results of cancelled or superseded tasks are ignored
+        """
+        return not task.cancelled and self.tasks.get(task.layerId) is task
+
+    def _gridProgress(self, task, fraction):
+        layer = QgsMapLayerRegistry.instance().mapLayer(task.layerId)
+        if self._isCurrent(task) and layer is not None:
+            self.progressChanged.emit(task.layerId, layer.name(), fraction)
+
+    def _gridBuilt(self, task, grid):
+        if not self._isCurrent(task):
+            if grid is not None:
+                grid.close()
+            return
+        layerId = task.layerId
+        del self.tasks[layerId]
+        layer = QgsMapLayerRegistry.instance().mapLayer(layerId)
+        if layer is None:
+            return
+        if grid is None:
+            self.failed.add(layerId)
+            self.progressChanged.emit(layerId, layer.name(), -1.0)
+            return
+        self._install(layer, grid)
+
+    def _install(self, layer, grid):
+        """
+        Makes the grid available for snapping, once the edits that are not in the provider yet are applied to it
+        """
+        if layer.isEditable() and layer.editBuffer() is not None:
+            editBuffer = layer.editBuffer()
+            for fid in editBuffer.deletedFeatureIds():
+                grid.removeFeature(fid)
+            for fid, geometry in editBuffer.changedGeometries().items():
+                grid.replaceFeature(fid, geometryParts(geometry))
+            for fid, feature in editBuffer.addedFeatures().items():
+                grid.replaceFeature(fid, geometryParts(feature.geometry()))
+
+        self.grids[layer.id()] = grid
+        self.version += 1
+        self.progressChanged.emit(layer.id(), layer.name(), 1.0)
+
+    def _cancel(self, layerId):
+        task = self.tasks.pop(layerId, None)
+        if task is not None:
+            task.cancelled = True
+            self.progressChanged.emit(layerId, "", -1.0)
+
+    def removeLayers(self, layerIds):
+        for layerId in layerIds:
+            self._cancel(layerId)
+            self._unwatch(layerId)
+            self.failed.discard(layerId)
+            grid = self.grids.pop(layerId, None)
+            if grid is not None:
+                grid.close()
+                self.version += 1
+
+    def clear(self):
+        for layerId in list(self.tasks):
+            self._cancel(layerId)
+        for grid in self.grids.values():
+            grid.close()
+        self.grids = dict()
+        self.watched = dict()
+        self.failed = set()
+        self.version += 1
+
+    def snap(self, layer, mapPoint, tolerance, unitType, grid=None):
+        """
+        Returns the nearest vertex and the nearest segment of the layer within the tolerance, in map coordinates (mapPoint being an (x, y) pair).
+        The vertex is returned as (squared distance, point) and the segment as (squared distance, (point, startPoint, endPoint)), the points
+        being (x, y) pairs, or None if nothing is in range.
+
+        Another structure answering nearestVertex and nearestSegment in layer coordinates (such as the CadGeometryBuffer) may be given instead of the layer's grid.
+        QgsPoints are only involved when the map is reprojected.
+        """
+        renderer = self.iface.mapCanvas().mapRenderer()
+        if grid is None:
+            grid = self.grids[layer.id()]
+
+        if renderer.hasCrsTransformEnabled():
+            layerPoint = toPair( renderer.mapToLayerCoordinates( layer, toQgsPoint(mapPoint) ) )
+            toMap = lambda xy: toPair( renderer.layerToMapCoordinates( layer, toQgsPoint(xy) ) )
+        else:
+            layerPoint = mapPoint
+            toMap = lambda xy: xy
+        layerTolerance = QgsTolerance.toLayerCoordinates( tolerance, layer, renderer, unitType )
+
+        vertex = None
+        found = grid.nearestVertex(layerPoint[0], layerPoint[1], layerTolerance)
+        if found is not None:
+            point = toMap(found[:2])
+            vertex = ((point[0]-mapPoint[0])**2 + (point[1]-mapPoint[1])**2, point)
+
+        segment = None
+        found = grid.nearestSegment(layerPoint[0], layerPoint[1], layerTolerance)
+        if found is not None:
+            point = toMap(found[0])
+            segment = ((point[0]-mapPoint[0])**2 + (point[1]-mapPoint[1])**2, (point, toMap(found[1]), toMap(found[2])))
+
+        return (vertex, segment)
+
+
+    ###############################
+    ##### INCREMENTAL UPDATES #####
+    ###############################
+
+    def _watch(self, layer):
+        """
+        Subscribes to the layer's edit signals, so that its grid is patched rather than rebuilt after each edit
+        """
+        layerId = layer.id()
+        connections = [ (layer.featureAdded, lambda fid: self._featureAdded(layer, fid)),
+                        (layer.featureDeleted, lambda fid: self._featureDeleted(layerId, fid)),
+                        (layer.geometryChanged, lambda fid, geometry: self._geometryChanged(layerId, fid, geometry)),
+                        (layer.committedFeaturesAdded, lambda layerId, features: self._committedFeaturesAdded(layerId, features)),
+                        (layer.editingStopped, lambda: self._editingStopped(layerId)) ]
+        for signal, slot in connections:
+            signal.connect( slot )
+        self.watched[layerId] = connections
+
+    def _unwatch(self, layerId):
+        for signal, slot in self.watched.pop(layerId, []):
+            try:
+                signal.disconnect( slot )
+            except (TypeError, RuntimeError):
+                #the layer may already have been deleted
+                pass
+
+    def _featureAdded(self, layer, fid):
+        grid = self.grids.get(layer.id())
+        if grid is None:
+            return
+        feature = QgsFeature()
+        request = QgsFeatureRequest(fid).setSubsetOfAttributes([])
+        if layer.getFeatures(request).nextFeature(feature):
+            grid.replaceFeature(fid, geometryParts(feature.geometry()))
+
+    def _featureDeleted(self, layerId, fid):
+        grid = self.grids.get(layerId)
+        if grid is not None:
+            grid.removeFeature(fid)
+
+    def _geometryChanged(self, layerId, fid, geometry):
+        grid = self.grids.get(layerId)
+        if grid is not None:
+            grid.replaceFeature(fid, geometryParts(geometry))
+
+    def _committedFeaturesAdded(self, layerId, features):
+        """
+        On commit, the added features get their definitive ids : the temporary (negative) ones are replaced
+        """
+        grid = self.grids.get(layerId)
+        if grid is None:
+            return
+        grid.removeTemporaryFeatures()
+        for feature in features:
+            grid.replaceFeature(feature.id(), geometryParts(feature.geometry()))
+
+    def _editingStopped(self, layerId):
+        """
+        After a commit or a rollback, no temporary feature may remain (the rollback itself emits the featureAdded/featureDeleted/geometryChanged signals)
+
+        If the grid is being built, the provider may have changed under the task, so we restart it.
+        """
+        grid = self.grids.get(layerId)
+        if grid is not None:
+            grid.removeTemporaryFeatures()
+        elif layerId in self.tasks:
+            self._cancel(layerId)
+            layer = QgsMapLayerRegistry.instance().mapLayer(layerId)
+            if layer is not None:
+                self.buildLayer(layer)
+
+
+class SnapGridTask(QRunnable):
+    """
+    Builds a SnapGrid in a worker thread.
+
+    The task opens its own data provider (providers are not meant to be shared between threads) and
+    streams the features in chunks, reporting its progress after each chunk.
+    Once built, the grid is written to the cache file (if the layer can be cached).
+
+    The cancellation is checked while streaming, indexing and saving. A cancelled task emits nothing, and the
+    CadSnapIndex ignores the results of any task which is not the layer's current build anymore.
+    """
+
+    chunkSize = 10000
+
+    def __init__(self, index, layerId, providerKey, source, subsetString, cachePath, cacheKey, emptyExtent):
+        QRunnable.__init__(self)
+        self.setAutoDelete(False) #the CadSnapIndex keeps a reference on the task
+        self.index = index
+        self.layerId = layerId
+        self.providerKey = providerKey
+        self.source = source
+        self.subsetString = subsetString
+        self.cachePath = cachePath
+        self.cacheKey = cacheKey
+        self.emptyExtent = emptyExtent
+        self.cancelled = False
+
+    def run(self):
+        if self.cancelled:
+            #cancelled while queued
+            return
+        try:
+            provider = QgsProviderRegistry.instance().provider(self.providerKey, self.source)
+            if self.subsetString:
+                provider.setSubsetString(self.subsetString)
+            total = max(provider.featureCount(), 1)
+
+            grid = SnapGrid()
+            iterator = provider.getFeatures( QgsFeatureRequest().setSubsetOfAttributes([]) )
+            feature = QgsFeature()
+            count = 0
+            while iterator.nextFeature(feature):
+                if self.cancelled:
+                    return
+                grid.addFeature(feature.id(), geometryParts(feature.geometry()))
+                count += 1
+                if count % self.chunkSize == 0:
+                    self.index.gridProgress.emit(self, min(1.0, float(count)/total))
+            grid.index(self.emptyExtent, self.isCancelled)
+
+            if self.cachePath is not None:
+                try:
+                    saveGrid(grid, self.cachePath, self.cacheKey, self.isCancelled)
+                except EnvironmentError as e:
+                    QgsMessageLog.logMessage("WARNING : could not write the snap cache of layer %s (%s)" % (self.layerId, e))
+        except BuildCancelled:
+            return
+        except Exception as e:
+            QgsMessageLog.logMessage("WARNING : could not build the snap index of layer %s (%s)" % (self.layerId, e))
+            grid = None
+
+        self.index.gridBuilt.emit(self, grid)
+
+    def isCancelled(self):
+        return self.cancelled
+
+
+def geometryParts(geometry):
+    """
+    Returns the parts of a QgsGeometry as lists of (x,y) tuples (each polygon ring is a part)
+    """
+    if geometry is None:
+        return []
+
+    multi = geometry.isMultipart()
+    if geometry.type() == QGis.Point:
+        points = geometry.asMultiPoint() if multi else [geometry.asPoint()]
+        return [[(p.x(), p.y())] for p in points]
+    elif geometry.type() == QGis.Line:
+        lines = geometry.asMultiPolyline() if multi else [geometry.asPolyline()]
+        return [[(p.x(), p.y()) for p in line] for line in lines]
+    elif geometry.type() == QGis.Polygon:
+        polygons = geometry.asMultiPolygon() if multi else [geometry.asPolygon()]
+        return [[(p.x(), p.y()) for p in ring] for polygon in polygons for ring in polygon]
+    return []
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Import the PyQt and QGIS libraries
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from qgis.core import *
+from qgis.gui import *
+
+from CadSnapIndex import CadSnapIndex
+from CadGeometryBuffer import CadGeometryBuffer
+from CadPoints import toPair
+
+
+class CadSnapper(QObject):
+    """
+    This class resolves the snapping for the CadEventFilter.
+
+    Instead of running up to four QgsMapCanvasSnapper queries in a row (current layer vertex, 
+    background vertex, current layer segment, background segment), it runs one single QgsSnapper
+    query on all the snappable layers, collecting both vertex and segment candidates, and ranks them afterwards.
+
+    The snapper's configuration is built once and cached. It is only rebuilt when layers are added
+    or removed, or when the user changes the project's snap settings, so that snapping never needs
+    to touch the QgsProject's settings.
+
+    Layers indexed by the CadSnapIndex are answered from their in-memory SnapGrid,
+    the QgsSnapper only remains as a fallback for the other layers.
+    """
+
+    tolerance = 20 # snapping radius in pixels (hard coded, see README)
+    technicalLayerName = "(cadinput_techical_snap_layer)"
+
+    def __init__(self, iface):
+        QObject.__init__(self)
+        self.iface = iface
+
+        self.snapper = QgsSnapper(self.iface.mapCanvas().mapRenderer())
+        self.snapper.setSnapMode( QgsSnapper.SnapWithResultsWithinTolerances )
+        self.configurationDirty = True
+        self.snapLayers = []
+        self.snapperLayers = []
+        self.indexVersion = None
+
+        self.index = CadSnapIndex(self.iface)
+        self.buffer = CadGeometryBuffer(self.iface)
+
+        #the project's snapping options, stored while they are suspended (see suspendProjectSnapping), else None
+        self.storedSettings = None
+
+        #false once unloaded, so that the calls deferred to the event loop do nothing
+        self.loaded = True
+
+        #we rebuild the configuration only if the layers or the snap settings change
+        QgsMapLayerRegistry.instance().layersAdded.connect( self._layersAdded )
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect( self._layersWillBeRemoved )
+        QgsProject.instance().snapSettingsChanged.connect( self._snapSettingsChanged )
+        QgsProject.instance().writeProject.connect( self._writeProject )
+        QgsMapLayerRegistry.instance().layersAdded.connect( self.invalidate )
+        QgsMapLayerRegistry.instance().layersAdded.connect( self.prepareLater )
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect( self.invalidate )
+        QgsMapLayerRegistry.instance().removeAll.connect( self.invalidate )
+        QgsProject.instance().snapSettingsChanged.connect( self.invalidate )
+
+    def unload(self):
+        """
+        Disconnects from the registry and the project, and unloads the index and the buffer (the project's snapping must have been restored)
+        """
+        QgsMapLayerRegistry.instance().layersAdded.disconnect( self._layersAdded )
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.disconnect( self._layersWillBeRemoved )
+        QgsProject.instance().snapSettingsChanged.disconnect( self._snapSettingsChanged )
+        QgsProject.instance().writeProject.disconnect( self._writeProject )
+        QgsMapLayerRegistry.instance().layersAdded.disconnect( self.invalidate )
+        QgsMapLayerRegistry.instance().layersAdded.disconnect( self.prepareLater )
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.disconnect( self.invalidate )
+        QgsMapLayerRegistry.instance().removeAll.disconnect( self.invalidate )
+        QgsProject.instance().snapSettingsChanged.disconnect( self.invalidate )
+        self.loaded = False
+        self.index.unload()
+        self.buffer.unload()
+
+    def invalidate(self, *args):
+        """
+        Marks the snapper's configuration as outdated, it will be rebuilt at next snap.
+        """
+        self.configurationDirty = True
+
+    def prepare(self):
+        """
+        Rebuilds the configuration if needed, and schedules the index build of the layers that are not indexed yet
+        """
+        if not self.loaded:
+            return
+        if self.configurationDirty:
+            self.snapLayers = self._snapLayers()
+            self.configurationDirty = False
+            self.indexVersion = None
+
+        self.index.ensureLayers( [snapLayer.mLayer for snapLayer in self.snapLayers] )
+
+    def prepareLater(self, *args):
+        """
+        Starts the index builds once the control returns to the event loop (so that loading a project is not delayed)
+        """
+        QTimer.singleShot(0, self.prepare)
+
+    def snap(self, qpoint, mapPoint):
+        """
+        returns the current snapped point (if any) and the current snapped segment (if any) in map coordinates, as (x, y) pairs,
+        qpoint being the mouse position in pixels and mapPoint the same position in map coordinates, as an (x, y) pair
+        The current snapped segment is returned as (snapped point on segment, startPoint, endPoint)
+
+        The candidates are ranked with the following priority :
+        1) a vertex of the current layer
+        2) a vertex of a background layer
+        3) a segment of the current layer
+        4) a segment of a background layer
+        Within the same rank, the nearest candidate wins.
+
+        The current layer is queried through the CadGeometryBuffer when it is ready and either small or the only
+        structure ready, layers having a SnapGrid through the CadSnapIndex, and the others through the QgsSnapper.
+        """
+
+        currentLayer = self.iface.mapCanvas().currentLayer()
+
+        self.prepare()
+        if self.indexVersion != self.index.version:
+            self.snapperLayers = [snapLayer for snapLayer in self.snapLayers if not self.index.isReady(snapLayer.mLayer)]
+            self.snapper.setSnapLayers( self.snapperLayers )
+            self.indexVersion = self.index.version
+
+        candidates = [] # (rank, squared distance, snapPoint, snapSegment)
+
+        for snapLayer in self.snapLayers:
+            layer = snapLayer.mLayer
+            if self.buffer.isReady(layer) and (self.buffer.isSmall() or not self.index.isReady(layer)):
+                (vertex, segment) = self.index.snap(layer, mapPoint, snapLayer.mTolerance, snapLayer.mUnitType, self.buffer)
+            elif self.index.isReady(layer):
+                (vertex, segment) = self.index.snap(layer, mapPoint, snapLayer.mTolerance, snapLayer.mUnitType)
+            else:
+                continue
+            background = 0 if self._isCurrent(layer, currentLayer) else 1
+            if vertex is not None:
+                candidates.append( (0+background, vertex[0], vertex[1], None) )
+            if segment is not None:
+                candidates.append( (2+background, segment[0], None, segment[1]) )
+
+        if self.snapperLayers:
+            (reval, snapped) = self.snapper.snapPoint(qpoint, [])
+            for result in snapped:
+                background = 0 if self._isCurrent(result.layer, currentLayer) else 1
+                point = toPair(result.snappedVertex)
+                distance = (point[0]-mapPoint[0])**2 + (point[1]-mapPoint[1])**2
+                if self._isVertex(result):
+                    candidates.append( (0+background, distance, point, None) )
+                else:
+                    candidates.append( (2+background, distance, None, (point, toPair(result.beforeVertex), toPair(result.afterVertex))) )
+
+        if candidates == []:
+            return (None, None)
+
+        best = min(candidates, key=lambda candidate: (candidate[0], candidate[1]))
+        return (best[2], best[3])
+
+    def _isCurrent(self, layer, currentLayer):
+        return currentLayer is not None and layer is not None and layer.id() == currentLayer.id()
+
+    def _isVertex(self, result):
+        """
+        Segment snapping results have no snapped vertex number
+        """
+        return result.snappedVertexNr != -1
+
+    def _snapLayers(self):
+        """
+        Returns the QgsSnapper.SnapLayer list for all the vector layers (snapping both to vertices and segments)
+
+        Layers whose snapping is enabled in the project keep their tolerance, the others use CadInput's default tolerance
+        (while the project's snapping is suspended, the stored options are used).
+        """
+        snapLayers = []
+        for layer in QgsMapLayerRegistry.instance().mapLayers().values():
+            if layer.type() != QgsMapLayer.VectorLayer or not layer.hasGeometryType() or layer.name() == self.technicalLayerName:
+                continue
+            snapLayer = QgsSnapper.SnapLayer()
+            snapLayer.mLayer = layer
+            (ok, enabled, snapTo, unitType, tolerance, avoidIntersection) = self._snapSettingsForLayer(layer.id())
+            if ok and enabled and tolerance > 0:
+                snapLayer.mTolerance = tolerance
+                snapLayer.mUnitType = unitType
+            else:
+                snapLayer.mTolerance = self.tolerance
+                snapLayer.mUnitType = QgsTolerance.Pixels
+            snapLayer.mSnapTo = QgsSnapper.SnapToVertexAndSegment
+            snapLayers.append(snapLayer)
+        return snapLayers
+
+    def _snapSettingsForLayer(self, layerId):
+        if self.storedSettings is not None and layerId in self.storedSettings:
+            return self.storedSettings[layerId]
+        return QgsProject.instance().snapSettingsForLayer(layerId)
+
+
+    ######################################
+    ##### PROJECT SNAPPING SUSPENSION ####
+    ######################################
+
+    def isSuspended(self):
+        return self.storedSettings is not None
+
+    def suspendProjectSnapping(self):
+        """
+        Stores (for later restoring) and disables the project's snapping options of all the layers (but the technical layer),
+        so that the native tools don't snap to them. This is done once, and not at each click.
+        Layers added while the snapping is suspended are disabled as well.
+        """
+        if self.storedSettings is not None or not self.loaded:
+            return
+        self.storedSettings = dict()
+        self._disableProjectSnapping( QgsMapLayerRegistry.instance().mapLayers().values() )
+
+    def restoreProjectSnapping(self):
+        """
+        Restores the stored snapping options
+        """
+        if self.storedSettings is None:
+            return
+        self.setSnapSettings( self.storedSettings.items() )
+        self.storedSettings = None
+
+    def _disableProjectSnapping(self, layers):
+        """
+        Stores the snapping options of the layers, and disables them
+        """
+        layers = [layer for layer in layers if layer.name() != self.technicalLayerName]
+        for layer in layers:
+            self.storedSettings[layer.id()] = QgsProject.instance().snapSettingsForLayer(layer.id())
+        self.setSnapSettings( [(layer.id(), self.disabledSettings) for layer in layers] )
+
+    disabledSettings = (True, False, 0, 0, 0, False) # (ok, enabled, snapTo, unitType, tolerance, avoidIntersection)
+
+    def _isDisabled(self, options):
+        """
+        Returns True if the options are the ones written by _disableProjectSnapping
+        """
+        return not options[1] and options[4] == 0
+
+    def setSnapSettings(self, items):
+        """
+        Writes (layer id, options) items to the project, without refreshing the snapping UI nor making the project dirty
+        """
+        project = QgsProject.instance()
+        wasDirty = project.isDirty()
+        project.blockSignals(True) #we don't want to refresh the snapping UI
+        for (layerId, options) in items:
+            project.setSnapSettingsForLayer(layerId,options[1],options[2],options[3],options[4],options[5])
+        project.blockSignals(False)
+        if not wasDirty:
+            project.dirty(False)
+
+    def _layersAdded(self, layers):
+        if self.storedSettings is not None:
+            self._disableProjectSnapping(layers)
+
+    def _layersWillBeRemoved(self, layerIds):
+        if self.storedSettings is not None:
+            for layerId in layerIds:
+                self.storedSettings.pop(layerId, None)
+
+    def _snapSettingsChanged(self):
+        """
+        The user changed the snapping options (our own changes don't emit the signal) : the layers whose options
+        are not the disabled ones anymore were changed by the user, those become the options to restore
+        """
+        if self.storedSettings is None:
+            return
+        changed = []
+        for layer in QgsMapLayerRegistry.instance().mapLayers().values():
+            if layer.name() == self.technicalLayerName:
+                continue
+            options = QgsProject.instance().snapSettingsForLayer(layer.id())
+            if not self._isDisabled(options) or layer.id() not in self.storedSettings:
+                changed.append(layer)
+        self._disableProjectSnapping(changed)
+
+    def _writeProject(self, *args):
+        """
+        The project is being saved : the stored options are written (rather than the disabled ones), and suspended again once saved
+        """
+        if self.storedSettings is not None:
+            self.restoreProjectSnapping()
+            QTimer.singleShot(0, self.suspendProjectSnapping)
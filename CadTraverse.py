@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# This module has no Qt nor QGIS dependency
+
+import re
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    #without numpy, traverseArrays falls back to iterTraverse
+    numpy = None
+
+from CadExpression import Evaluator
+from CadConstraints import lockedCoordinate, lastAngle, heading, headingDirection, polarPoint
+
+
+#values are separated by a comma, a semicolon or a tab if the line has one (so that "12 ft, 30 gon" is two values), else by spaces
+separators = re.compile(r"\s*[,;\t]\s*")
+spaces = re.compile(r"\s+")
+
+def parseLegs(lines, context=None, metersPerUnit=None, polar=True):
+    """
+    Yields the legs of a traverse as (v1, v2) pairs of floats, from an iterable of text lines.
+    Each line holds two values (expressions are allowed, see CadExpression, evaluated with the given context and metersPerUnit) separated by a comma, a semicolon or a tab, or by spaces if the line has none of those.
+    Polar legs are a length and an angle, cartesian legs are two lengths : each value only takes the unit suffixes of its kind.
+    Empty lines and lines starting with # are skipped. Raises ValueError (with the line number) on invalid lines.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        if separators.search(line):
+            values = separators.split(line)
+        else:
+            values = spaces.split(line)
+        if len(values) != 2:
+            raise ValueError("line %d : two values expected, got %d" % (number, len(values)))
+        v1 = Evaluator.eval_expr(values[0], context, metersPerUnit, False)
+        if polar:
+            v2 = Evaluator.eval_expr(values[1], context, None, True)
+        else:
+            v2 = Evaluator.eval_expr(values[1], context, metersPerUnit, False)
+        if v1 is None or v2 is None:
+            raise ValueError("line %d : invalid value" % number)
+        yield (v1, v2)
+
+def traverse(p1, p2, legs, polar, ra=True, rx=True, ry=True):
+    """
+    Returns the vertices of a traverse starting at p2 (p1 being the previous point, used for relative angles),
+    the points being (x, y) tuples.
+
+    The legs are applied as the locked values of CadInput would be :
+    - polar legs are (d, a) pairs, the angle being relative to the previous leg if ra
+    - cartesian legs are (x, y) pairs, each coordinate being relative to the previous point if rx / ry
+    """
+    return list( iterTraverse(p1, p2, legs, polar, ra, rx, ry) )
+
+def iterTraverse(p1, p2, legs, polar, ra=True, rx=True, ry=True):
+    """
+    Yields the vertices of a traverse one by one (see traverse), so that the legs can be streamed from a file.
+    The maths are CadConstraints' (the same as for the locked values).
+    """
+    for (v1, v2) in legs:
+        if polar:
+            p3 = polarPoint( p2, headingDirection(heading(v2, lastAngle(p1, p2) if ra else 0.0)), v1 )
+        else:
+            p3 = (lockedCoordinate(v1, p2[0], rx), lockedCoordinate(v2, p2[1], ry))
+        yield p3
+        (p1, p2) = (p2, p3)
+
+def traverseArrays(p1, p2, legs, polar, ra=True, rx=True, ry=True):
+    """
+    Returns the vertices of a traverse (see traverse) as two coordinate arrays (xs, ys), for bulk geometry creation.
+    The legs are given as a (n,2) array (or anything numpy.asarray accepts).
+
+    With numpy, all the legs are computed at once : the headings are the cumulative sum of the relative angles,
+    and the coordinates the cumulative sums of the legs' projections. The results are those of iterTraverse, including
+    its edge cases : a leg with a negative distance turns the next heading by 180°, and a leg of null length resets
+    the next heading's reference to 0 (the direction of a null leg being undefined).
+    Without numpy, the legs are computed one by one and array('d') are returned.
+    """
+    if numpy is None:
+        (xs, ys) = (array('d'), array('d'))
+        for (x, y) in iterTraverse(p1, p2, legs, polar, ra, rx, ry):
+            xs.append(x)
+            ys.append(y)
+        return (xs, ys)
+
+    legs = numpy.asarray(legs, dtype=numpy.float64).reshape(-1, 2)
+    (v1, v2) = (legs[:,0], legs[:,1])
+    (x2, y2) = p2
+
+    # the relative legs are cumulated, the kernel functions of CadConstraints then apply as for a single leg
+    if not polar:
+        xs = lockedCoordinate(numpy.cumsum(v1) if rx else v1.copy(), x2, rx)
+        ys = lockedCoordinate(numpy.cumsum(v2) if ry else v2.copy(), y2, ry)
+        return (xs, ys)
+
+    headings = heading(v2)
+    if ra and len(legs):
+        turns = headings.copy()
+        turns[0] += lastAngle(p1, p2)
+        turns[1:] += numpy.where(v1[:-1] < 0, numpy.pi, 0.0)
+        cumulated = numpy.cumsum(turns)
+        # after a null leg, the headings restart from 0 : we remove what was cumulated up to that leg
+        resets = numpy.full(len(legs), -1, dtype=numpy.int64)
+        resets[1:] = numpy.where(v1[:-1] == 0, numpy.arange(len(legs)-1), -1)
+        resets = numpy.maximum.accumulate(resets)
+        headings = cumulated - numpy.where(resets >= 0, cumulated[numpy.maximum(resets, 0)], 0.0)
+
+    (dxs, dys) = polarPoint( (0.0, 0.0), (numpy.cos(headings), numpy.sin(headings)), v1 )
+    return (lockedCoordinate(numpy.cumsum(dxs), x2, True), lockedCoordinate(numpy.cumsum(dys), y2, True))
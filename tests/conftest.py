@@ -0,0 +1,5 @@
+# The Qt-free modules of the plugin are imported as top-level modules (as QGIS does, the plugin's directory being in the path)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,45 @@
+# Checks that the batch runner reports the failures of single files and goes on with the others
+import io
+
+import CadBatch
+from CadBatch import main, processFile
+
+
+def writeFile(path, text):
+    with io.open(str(path), 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def test_unexpected_errors_only_fail_their_file(tmp_path, monkeypatch):
+    path = tmp_path / "a.txt"
+    writeFile(path, u"1 0\n")
+    def failing(lines, *arguments):
+        raise RecursionError("maximum recursion depth exceeded")
+        yield
+    monkeypatch.setattr(CadBatch, "parseLegs", failing)
+    options = CadBatch.argparse.Namespace(previous=(0.0, 0.0), start=(0.0, 0.0), polar=True, relative=True, metersPerUnit=1.0)
+    (filePath, xs, ys, seconds, error) = processFile(str(path), options)
+    assert xs is None and "RecursionError" in error
+
+def test_batch_goes_on_after_a_failed_file(tmp_path, capsys):
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    writeFile(inputs / "a.txt", u"10 0\n10 90\n")
+    writeFile(inputs / "b.txt", u"1 2 3\n")
+    writeFile(inputs / "c.txt", u"1+" * 100000 + u"1 0\n")
+    writeFile(inputs / "d.txt", u"5 0\n")
+    output = tmp_path / "out.csv"
+
+    assert main([str(inputs), "-o", str(output), "--workers", "1"]) == 1
+
+    report = capsys.readouterr().out
+    assert report.count("\tFAILED\t") == 2
+    assert "4 files, 2 failed" in report
+    with io.open(str(output), encoding='utf-8') as f:
+        rows = f.read().splitlines()
+    #header, then the start and the vertices of a.txt and d.txt
+    assert len(rows) == 1 + 3 + 2
+
+def test_missing_output_dependencies(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(CadBatch, "ogr", None)
+    writeFile(tmp_path / "a.txt", u"1 0\n")
+    assert main([str(tmp_path / "a.txt"), "-o", str(tmp_path / "out.gpkg"), "--workers", "1"]) == 2
@@ -0,0 +1,91 @@
+# Checks the points committed to the edited layers and to the map tools, through CadHarness (needs the PyQt4 and qgis bindings)
+import pytest
+
+pytest.importorskip("PyQt4")
+pytest.importorskip("qgis.core")
+
+from PyQt4.QtCore import Qt
+from qgis.core import QgsVectorLayer, QgsPoint
+
+from CadHarness import CadHarness, StubMapTool, RecordingMapTool
+
+
+@pytest.fixture
+def harness():
+    harness = CadHarness(toolClass=StubMapTool)
+    yield harness
+    harness.close()
+
+def editedLayer(harness, geometryType):
+    """
+    Returns a memory layer being edited, as the current layer
+    """
+    layer = QgsVectorLayer(geometryType, "edited", "memory")
+    layer.startEditing()
+    harness.iface.setActiveLayer(layer)
+    return layer
+
+def points(count, failAt=None):
+    for i in range(count):
+        if i == failAt:
+            raise ValueError("line %d : invalid value" % (i+1))
+        yield (float(i), float(2*i))
+
+def features(layer):
+    return list(layer.getFeatures())
+
+def test_stream_is_added_in_chunks_as_one_command(harness):
+    layer = editedLayer(harness, "Point")
+    committer = harness.eventFilter.committer
+    assert committer.commitPointStream(QgsPoint(0, 0), points(2500), "Traverse imported", chunkSize=1000) == 2500
+    assert len(features(layer)) == 2500
+    assert layer.undoStack().count() == 1
+
+def test_failing_stream_commits_nothing(harness):
+    layer = editedLayer(harness, "Point")
+    committer = harness.eventFilter.committer
+    #the failure comes after the first chunks were added : those are reverted
+    with pytest.raises(ValueError):
+        committer.commitPointStream(QgsPoint(0, 0), points(2500, failAt=1500), "Traverse imported", chunkSize=1000)
+    assert features(layer) == []
+    assert layer.undoStack().count() == 0
+
+def test_stream_makes_one_line(harness):
+    layer = editedLayer(harness, "LineString")
+    committer = harness.eventFilter.committer
+    assert committer.commitPointStream(QgsPoint(-1, -1), points(100), "Traverse imported") == 100
+    [feature] = features(layer)
+    line = feature.geometry().asPolyline()
+    assert len(line) == 101 and (line[0].x(), line[0].y()) == (-1.0, -1.0)
+
+def test_failing_stream_sends_nothing_to_the_tool():
+    harness = CadHarness(toolClass=RecordingMapTool)
+    try:
+        committer = harness.eventFilter.committer
+        with pytest.raises(ValueError):
+            committer.commitPointStream(QgsPoint(0, 0), points(100, failAt=50), "Traverse imported")
+        assert harness.tool.vertices == []
+        assert committer.commitPointStream(QgsPoint(0, 0), points(100), "Traverse imported") == 100
+        assert len(harness.tool.vertices) == 100
+    finally:
+        harness.close()
+
+def test_point_is_added_once_its_form_is_accepted(harness, monkeypatch):
+    layer = editedLayer(harness, "Point")
+    committer = harness.eventFilter.committer
+    #the add feature tool of QGIS
+    monkeypatch.setattr(harness.tool, "action", harness.iface.actionAddFeature)
+    forms = []
+    def openFeatureForm(layer, feature, updateFeatureOnly=False):
+        forms.append( (feature.geometry().asPoint().x(), updateFeatureOnly) )
+        return len(forms) > 1 # the first form is cancelled
+    monkeypatch.setattr(harness.iface, "openFeatureForm", openFeatureForm)
+
+    assert committer.accepts(Qt.LeftButton)
+    assert committer.commitPoint(QgsPoint(1.5, 2.5))
+    assert features(layer) == [] and layer.undoStack().count() == 0
+    assert committer.commitPoint(QgsPoint(3.5, 4.5))
+    [feature] = features(layer)
+    assert feature.geometry().asPoint().x() == 3.5
+    #the form only edits the feature, which is added once
+    assert forms == [(1.5, True), (3.5, True)]
@@ -0,0 +1,62 @@
+# Checks that the compiled constraint plans give the results of the generic constrain function
+import random
+
+from CadConstraints import constrain, compilePlan, planKey
+from CadInputModel import CadInputModel
+
+
+def randomModel(rng):
+    model = CadInputModel()
+    (model.x, model.y, model.a, model.d) = [rng.uniform(-50, 50) for i in range(4)]
+    (model.lx, model.ly, model.la, model.ld) = [rng.random() < 0.4 for i in range(4)]
+    (model.rx, model.ry, model.ra) = [rng.random() < 0.5 for i in range(3)]
+    return model
+
+def copyModel(model):
+    copy = CadInputModel()
+    for attribute in ('x', 'y', 'a', 'd', 'lx', 'ly', 'la', 'ld', 'rx', 'ry', 'ra'):
+        setattr(copy, attribute, getattr(model, attribute))
+    return copy
+
+def test_plan_matches_constrain():
+    rng = random.Random(5)
+    for i in range(5000):
+        generic = randomModel(rng)
+        compiled = copyModel(generic)
+        points = [(rng.uniform(-100, 100), rng.uniform(-100, 100)) for k in range(5)]
+        #vertical and horizontal segments
+        if rng.random() < 0.1:
+            points[4] = (points[3][0], points[4][1])
+        if rng.random() < 0.1:
+            points[4] = (points[4][0], points[3][1])
+        segment = None if rng.random() < 0.3 else (points[3], points[4])
+
+        expected = constrain(generic, points[0], points[1], points[2], segment)
+        result = compilePlan(compiled, points[0], points[1])(points[2], segment)
+
+        assert abs(expected[0]-result[0]) < 1e-9 and abs(expected[1]-result[1]) < 1e-9
+        for attribute in ('x', 'y', 'a', 'd'):
+            assert abs(getattr(generic, attribute)-getattr(compiled, attribute)) < 1e-9
+
+def test_plan_key_follows_the_locks():
+    model = CadInputModel()
+    key = planKey(model, (0.0, 0.0), (1.0, 1.0))
+    assert planKey(model, (0.0, 0.0), (1.0, 1.0)) == key
+    model.la = True
+    assert planKey(model, (0.0, 0.0), (1.0, 1.0)) != key
+    assert planKey(model, (0.0, 0.0), (2.0, 1.0)) != planKey(model, (0.0, 0.0), (1.0, 1.0))
+
+def test_plan_is_reusable_while_the_key_is_unchanged():
+    rng = random.Random(7)
+    for i in range(2000):
+        generic = randomModel(rng)
+        compiled = copyModel(generic)
+        (p1, p2) = [(rng.uniform(-100, 100), rng.uniform(-100, 100)) for k in range(2)]
+        plan = compilePlan(compiled, p1, p2)
+        key = planKey(compiled, p1, p2)
+        for k in range(5):
+            p3 = (rng.uniform(-100, 100), rng.uniform(-100, 100))
+            expected = constrain(generic, p1, p2, p3, None)
+            result = plan(p3, None)
+            assert planKey(compiled, p1, p2) == key
+            assert abs(expected[0]-result[0]) < 1e-9 and abs(expected[1]-result[1]) < 1e-9
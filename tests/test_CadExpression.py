@@ -0,0 +1,37 @@
+# Checks the expressions of the fields : operators, units, rejected inputs
+import math
+
+from CadExpression import Evaluator
+
+
+def test_operators_and_functions():
+    assert Evaluator.eval_expr("1+2*3") == 7.0
+    assert Evaluator.eval_expr("2^10") == Evaluator.eval_expr("2**10") == 1024.0
+    assert abs(Evaluator.eval_expr("sin(30)") - 0.5) < 1e-12
+    assert Evaluator.eval_expr("d*2+a", {'x': 0.0, 'y': 0.0, 'a': 1.0, 'd': 3.0}) == 7.0
+
+def test_units():
+    assert abs(Evaluator.eval_expr("10ft", None, 0.3048) - 10.0) < 1e-12
+    assert abs(Evaluator.eval_expr("100 gon") - 90.0) < 1e-12
+    assert abs(Evaluator.eval_expr("1rad") - 180.0/math.pi) < 1e-12
+    #lengths need the map unit, and angles are only taken where allowed
+    assert Evaluator.eval_expr("10ft") is None
+    assert Evaluator.eval_expr("10m", None, 1.0, False) == 10.0
+    assert Evaluator.eval_expr("100gon", None, 1.0, False) is None
+
+def test_metersPerUnit_is_private():
+    assert Evaluator.eval_expr("metersPerUnit", None, 1.0) is None
+    assert Evaluator.eval_expr(Evaluator.metersPerUnitName, None, 1.0) is None
+    assert Evaluator.eval_expr("2*%s" % Evaluator.metersPerUnitName, None, 1.0) is None
+
+def test_rejected_expressions():
+    for expr in ["", "1+", "foo", "__import__('os')", "1e400", "1e308*10", "1/0", "sqrt(-1)", "(1).real", "True"]:
+        assert Evaluator.eval_expr(expr) is None, expr
+
+def test_pathological_expressions():
+    #too long or too deep for the parser or the closures : rejected, not raised
+    assert Evaluator.eval_expr("1+"*100000 + "1") is None
+    assert Evaluator.eval_expr("("*100000 + "1" + ")"*100000) is None
+    assert Evaluator.eval_expr("-"*100000 + "1") is None
+    #and still rejected from the cache
+    assert Evaluator.eval_expr("1+"*100000 + "1") is None
@@ -0,0 +1,68 @@
+# Replays mouse events through the whole event filter with CadHarness (needs the PyQt4 and qgis bindings)
+import pytest
+
+pytest.importorskip("PyQt4")
+pytest.importorskip("qgis.core")
+
+from PyQt4.QtCore import QEvent
+
+from CadHarness import CadHarness, StubMapTool, MapPointsMapTool, RecordingMapTool
+
+
+# a square in map units : with the default canvas (800x600 pixels, 1 map unit per pixel from (0, 0)),
+# the map point (x, y) is at the pixel (x, 600-y)
+square = [[(200.0, 100.0), (600.0, 100.0), (600.0, 500.0), (200.0, 500.0), (200.0, 100.0)]]
+
+@pytest.fixture(params=[RecordingMapTool, MapPointsMapTool])
+def harness(request):
+    harness = CadHarness(lines=square, toolClass=request.param)
+    yield harness
+    harness.close()
+
+def test_clicks_snap_to_the_layer(harness):
+    #a vertex, then a segment (the vertices having the priority)
+    harness.replay([("move", 190, 510), ("click", 203, 497), ("click", 400, 503)], paint=False)
+    assert harness.tool.vertices == [(200.0, 100.0), (400.0, 100.0)]
+    #the grid (or the buffer) answered, not the QgsSnapper
+    assert harness.snapper.index.isReady(harness.layer)
+    assert harness.snapper.snapperLayers == []
+
+def test_locked_distance_is_applied_from_the_last_click(harness):
+    harness.replay([("click", 100, 100)], paint=False)
+    harness.inputwidget.d = 50.0
+    harness.inputwidget.ld = True
+    harness.replay([("move", 100, 300), ("click", 100, 300)], paint=False)
+    assert harness.tool.vertices[0] == (100.0, 500.0)
+    (x, y) = harness.tool.vertices[1]
+    assert abs(x-100.0) < 1e-9 and abs(y-450.0) < 1e-9
+    #the locks are released by the click
+    assert not harness.inputwidget.ld
+
+def test_moves_are_coalesced_and_painted(harness):
+    events = [("move", 100+i, 100+i) for i in range(50)]
+    (filtering, painting) = harness.replay(events, movesPerFrame=5)
+    #the viewport only gets the moves processed at each frame
+    moves = [received for received in harness.canvas.viewport().received if received[0] == QEvent.MouseMove]
+    assert len(moves) == 10
+    assert harness.eventFilter.p3 == (149.0, 451.0)
+    assert painting > 0.0
+
+def test_native_tools_get_the_points_through_the_technical_layer():
+    harness = CadHarness(lines=square, toolClass=StubMapTool)
+    try:
+        harness.replay([("click", 203, 497)], paint=False)
+        #the native tools read the pixel position of the event
+        [(x, y)] = harness.tool.vertices
+        assert abs(x-200.0) <= 1.0 and abs(y-100.0) <= 1.0
+    finally:
+        harness.close()
+    #the project's snapping is restored
+    assert not harness.snapper.isSuspended()
+
+def test_close_stops_the_snapper():
+    harness = CadHarness(lines=square)
+    harness.replay([("move", 203, 497)], paint=False)
+    harness.close()
+    assert not harness.snapper.loaded
+    assert harness.snapper.index.pool.activeThreadCount() == 0
+    assert harness.snapper.index.grids == {}
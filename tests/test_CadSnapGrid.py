@@ -0,0 +1,151 @@
+# Checks the SnapGrid and the MappedSnapGrid against brute force searches, before and after edits, their cell size, and the cancellation of their builds and saves
+import math
+import random
+
+import pytest
+
+from CadSnapGrid import SnapGrid, MappedSnapGrid, BuildCancelled, saveGrid
+
+
+def randomPart(rng):
+    (x, y) = (rng.uniform(0, 1000), rng.uniform(0, 1000))
+    return [(x+rng.uniform(-5, 5), y+rng.uniform(-5, 5)) for k in range(rng.randint(1, 6))]
+
+def bruteForce(parts, x, y, tolerance):
+    """
+    Returns the distances to the nearest vertex and to the nearest segment within tolerance (or None)
+    """
+    vertex = None
+    segment = None
+    for part in parts:
+        for (vx, vy) in part:
+            d = math.hypot(vx-x, vy-y)
+            if d <= tolerance and (vertex is None or d < vertex):
+                vertex = d
+        for (ax, ay), (bx, by) in zip(part, part[1:]):
+            (dx, dy) = (bx-ax, by-ay)
+            length = dx*dx+dy*dy
+            if length == 0:
+                continue
+            t = min(1.0, max(0.0, ((x-ax)*dx+(y-ay)*dy)/length))
+            d = math.hypot(ax+t*dx-x, ay+t*dy-y)
+            if d <= tolerance and (segment is None or d < segment):
+                segment = d
+    return (vertex, segment)
+
+def checkGrid(grid, features, rng, queries=200):
+    parts = list(features.values())
+    for k in range(queries):
+        (x, y) = (rng.uniform(0, 1000), rng.uniform(0, 1000))
+        tolerance = rng.choice([0.5, 3, 20, 400])
+        (vertex, segment) = bruteForce(parts, x, y, tolerance)
+        found = grid.nearestVertex(x, y, tolerance)
+        assert (found is None) == (vertex is None)
+        if found is not None:
+            assert abs(math.hypot(found[0]-x, found[1]-y)-vertex) < 1e-9
+        found = grid.nearestSegment(x, y, tolerance)
+        assert (found is None) == (segment is None)
+        if found is not None:
+            assert abs(math.hypot(found[0][0]-x, found[0][1]-y)-segment) < 1e-9
+
+def edit(grid, features, rng):
+    """
+    Removes, replaces and adds (temporary) features, as the edit signals would
+    """
+    for fid in list(features)[::5]:
+        grid.removeFeature(fid)
+        del features[fid]
+    for fid in list(features)[1::5]:
+        part = [(rng.uniform(0, 1000), rng.uniform(0, 1000)) for k in range(3)]
+        grid.replaceFeature(fid, [part])
+        features[fid] = part
+    grid.addFeature(-1, [[(10.0, 10.0), (20.0, 20.0)]])
+    grid.removeTemporaryFeatures()
+
+def buildGrid(rng, count):
+    grid = SnapGrid()
+    features = dict()
+    for fid in range(count):
+        features[fid] = randomPart(rng)
+        grid.addFeature(fid, [features[fid]])
+    #a long segment crossing many cells
+    features[count] = [(0.0, 0.0), (1000.0, 1000.0)]
+    grid.addFeature(count, [features[count]])
+    grid.index()
+    return (grid, features)
+
+def test_grid_matches_brute_force():
+    rng = random.Random(1)
+    (grid, features) = buildGrid(rng, 1000)
+    checkGrid(grid, features, rng)
+    edit(grid, features, rng)
+    checkGrid(grid, features, rng)
+
+def test_mapped_grid_matches_brute_force(tmp_path):
+    rng = random.Random(2)
+    (grid, features) = buildGrid(rng, 1000)
+    path = str(tmp_path / "grid.bin")
+    saveGrid(grid, path, u"key")
+
+    with pytest.raises(ValueError):
+        MappedSnapGrid(path, u"other key")
+
+    mapped = MappedSnapGrid(path, u"key")
+    try:
+        checkGrid(mapped, features, rng)
+        edit(mapped, features, rng)
+        checkGrid(mapped, features, rng)
+    finally:
+        mapped.close()
+
+def test_empty_grid_is_sized_from_the_extent():
+    grid = SnapGrid()
+    grid.index((0.0, 0.0, 6400.0, 3200.0))
+    assert grid.cellSize == 6400.0/SnapGrid.cellsPerSide
+
+    grid = SnapGrid()
+    grid.index()
+    assert grid.cellSize == 1.0
+
+def test_grid_is_indexed_again_when_it_drifts():
+    rng = random.Random(4)
+    grid = SnapGrid()
+    grid.index((0.0, 0.0, 10.0, 10.0))
+    features = dict()
+    for fid in range(1500):
+        features[fid] = randomPart(rng)
+        grid.addFeature(fid, [features[fid]])
+    #the cell size follows the density of the vertices, not the extent of the empty layer
+    assert grid.indexedCount > 0 and grid.cellSize > 10.0/SnapGrid.cellsPerSide
+    checkGrid(grid, features, rng, 100)
+
+def test_cancelled_index_and_save(tmp_path):
+    rng = random.Random(6)
+    (grid, features) = buildGrid(rng, 200)
+    grid = SnapGrid()
+    for fid, part in features.items():
+        grid.addFeature(fid, [part])
+    with pytest.raises(BuildCancelled):
+        grid.index(None, lambda: True)
+
+    grid.cells = dict()
+    grid.index()
+    path = str(tmp_path / "grid.bin")
+    with pytest.raises(BuildCancelled):
+        saveGrid(grid, path, u"key", lambda: True)
+    #nothing is left behind, not even the temporary file
+    assert list(tmp_path.iterdir()) == []
+
+def test_concurrent_saves_use_their_own_temporary_file(tmp_path):
+    rng = random.Random(8)
+    (grid, features) = buildGrid(rng, 200)
+    path = str(tmp_path / "grid.bin")
+    temporaries = []
+    def spy():
+        temporaries.extend(p.name for p in tmp_path.iterdir() if p.name.endswith(".tmp"))
+        return False
+    saveGrid(grid, path, u"key", spy)
+    saveGrid(grid, path, u"key", spy)
+    assert len(set(temporaries)) == 2
+    assert [p.name for p in tmp_path.iterdir()] == ["grid.bin"]
+    MappedSnapGrid(path, u"key").close()
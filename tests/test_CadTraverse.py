@@ -0,0 +1,44 @@
+# Checks the vectorized traverse against the leg by leg one, and the parsing of the legs
+import random
+
+import pytest
+
+from CadTraverse import parseLegs, traverse, traverseArrays
+
+
+def test_traverseArrays_matches_traverse():
+    rng = random.Random(3)
+    for trial in range(300):
+        #negative and null distances are edge cases of the relative angles
+        legs = [(rng.choice([0.0, -3.0, rng.uniform(-5, 20), rng.uniform(0, 20)]), rng.uniform(-360, 360)) for i in range(rng.randint(0, 60))]
+        p1 = (rng.uniform(-5, 5), rng.uniform(-5, 5))
+        p2 = rng.choice([p1, (1.0, 2.0)])
+        for polar in (True, False):
+            for ra in (True, False):
+                (rx, ry) = (rng.random() < 0.5, rng.random() < 0.5)
+                expected = traverse(p1, p2, legs, polar, ra, rx, ry)
+                (xs, ys) = traverseArrays(p1, p2, legs, polar, ra, rx, ry)
+                assert len(xs) == len(ys) == len(expected)
+                for (x, y), vx, vy in zip(expected, xs, ys):
+                    assert abs(x-vx) < 1e-9 and abs(y-vy) < 1e-9
+
+def test_parseLegs_separators():
+    lines = ["# comment", "", "1 2", "3;4", "5\t6", "7 , 8", "12 ft, 100 gon"]
+    legs = list(parseLegs(lines, None, 1.0))
+    assert legs[:4] == [(1.0, 2.0), (3.0, 4.0), (5.0, 6.0), (7.0, 8.0)]
+    assert abs(legs[4][0]-12*0.3048) < 1e-12 and abs(legs[4][1]-90.0) < 1e-12
+
+def test_parseLegs_invalid_lines():
+    with pytest.raises(ValueError):
+        list(parseLegs(["1 2 3"]))
+    with pytest.raises(ValueError):
+        list(parseLegs(["1, foo"]))
+    #length suffixes need the map units
+    with pytest.raises(ValueError):
+        list(parseLegs(["12ft 30"]))
+    #a polar leg is a length and an angle
+    with pytest.raises(ValueError):
+        list(parseLegs(["12gon 30"], None, 1.0))
+    with pytest.raises(ValueError):
+        list(parseLegs(["12 30m"], None, 1.0))
+    assert list(parseLegs(["12m 30m"], None, 1.0, False)) == [(12.0, 30.0)]